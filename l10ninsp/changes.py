@@ -4,74 +4,411 @@
 
 from calendar import timegm
 import os
+import time
+try:
+    import json
+except:
+    import simplejson as json
 
 from twisted.python import log, failure
-from twisted.internet import defer, reactor
-from twisted.internet.task import LoopingCall
+from twisted.internet import defer, reactor, threads
+from twisted.internet.task import LoopingCall, deferLater
+from twisted.python.threadpool import ThreadPool
+from twisted.internet.protocol import ServerFactory
+from twisted.protocols.basic import LineOnlyReceiver
 
 from buildbot.changes import base, changes
 
-def createChangeSource(pollInterval=3*60):
-    from life.models import Push, Branch
+import revisions
+
+class PushNotification(LineOnlyReceiver):
+    '''Protocol for the push-log ingester to notify about new pushes.
+
+    Each line is the id of a new push. Any other line just triggers
+    a poll.
+    '''
+    delimiter = '\n'
+
+    def lineReceived(self, line):
+        try:
+            push_id = int(line.split()[0])
+        except (ValueError, IndexError):
+            push_id = None
+        self.factory.source.notify(push_id)
+
+
+class PushNotificationFactory(ServerFactory):
+    protocol = PushNotification
+
+    def __init__(self, source):
+        self.source = source
+
+
+class Replay(object):
+    '''Replay pushes from the database into the master.
+
+    Consecutive pushes to the same repository are coalesced into one
+    batch, if coalesce is set. Up to concurrency batches are submitted
+    at once, after which we wait for all builders to be idle.
+    With dryRun, no changes are submitted, we just count the changes
+    and the batches, each of which would result in one round of
+    buildsets.
+    '''
+    # seconds to give the schedulers to submit their buildsets
+    settle = .5
+    # seconds between progress messages
+    logInterval = 10
+
+    def __init__(self, source, builders, filters, concurrency=1,
+                 coalesce=True, dryRun=False):
+        self.source = source
+        self.builders = builders
+        self.filters = filters
+        self.concurrency = max(1, concurrency)
+        self.coalesce = coalesce
+        self.dryRun = dryRun
+        self.stats = {
+            'total': None,
+            'pushes': 0,
+            'changes': 0,
+            'batches': 0,
+            }
+        # list of [repository, changes, pushes] ready to submit,
+        # and the one we might still add to
+        self.ready = []
+        self.open = None
+        self.after = None
+        self.more = True
+        self.stopped = False
+        self.started = self.lastLog = None
+        self.d = defer.Deferred()
+
+    def start(self):
+        self.started = self.lastLog = time.time()
+        d = self.source.inWorker(self.source.replayCount, self.filters)
+        d.addCallback(self.onCount)
+        d.addErrback(self.fail)
+        return self.d
+
+    def stop(self):
+        self.stopped = True
+
+    def onCount(self, count):
+        self.stats['total'] = count
+        log.msg('replay called for %d pushes%s' %
+                (count, self.dryRun and ' (dry run)' or ''))
+        self.step()
+
+    def step(self, _=None):
+        if self.stopped:
+            return self.finish()
+        if self.more and len(self.ready) < self.concurrency:
+            d = self.source.inWorker(self.source.replayPage,
+                                     self.filters, self.after)
+            d.addCallback(self.onPage)
+            d.addCallback(self.step)
+            d.addErrback(self.fail)
+            return
+        if not self.more and self.open is not None:
+            self.ready.append(self.open)
+            self.open = None
+        if not self.ready:
+            return self.finish()
+        window = self.ready[:self.concurrency]
+        del self.ready[:self.concurrency]
+        for repo, batch, pushes in window:
+            self.stats['batches'] += 1
+            self.stats['pushes'] += pushes
+            self.stats['changes'] += len(batch)
+            if not self.dryRun:
+                for c in batch:
+                    self.source.parent.addChange(c)
+        self.progress()
+        if self.dryRun:
+            reactor.callLater(0, self.step)
+            return
+        bm = self.source.parent.parent.botmaster
+        def waitForIdle():
+            return defer.DeferredList([bm.waitUntilBuilderIdle(b)
+                                       for b in self.builders])
+        d = deferLater(reactor, self.settle, waitForIdle)
+        d.addCallback(self.step)
+        d.addErrback(self.fail)
+
+    def onPage(self, result):
+        items, self.after, self.more = result
+        for repo, batch in items:
+            if (self.coalesce and self.open is not None
+                and self.open[0] == repo):
+                self.open[1] += batch
+                self.open[2] += 1
+                continue
+            if self.open is not None:
+                self.ready.append(self.open)
+            self.open = [repo, list(batch), 1]
+
+    def progress(self, force=False):
+        now = time.time()
+        if not force and now - self.lastLog < self.logInterval:
+            return
+        self.lastLog = now
+        elapsed = max(now - self.started, 1e-6)
+        log.msg('replay: %d/%s pushes, %d changes, %d batches, '
+                '%.1f pushes/s' %
+                (self.stats['pushes'], self.stats['total'],
+                 self.stats['changes'], self.stats['batches'],
+                 self.stats['pushes'] / elapsed))
+
+    def finish(self):
+        self.progress(force=True)
+        log.msg('done replaying')
+        self.d.callback(self.stats)
+
+    def fail(self, f):
+        log.err(f, 'replay failed')
+        self.d.errback(f)
+
+
+def createChangeSource(pollInterval=3*60, notifySocket=None,
+                       maxPollInterval=30*60, stateFile='changesource.state',
+                       pageSize=500):
+    '''Create the change source for the master.
+
+    If notifySocket is given, the change source listens for push
+    notifications on that unix socket, and polls only as a fallback,
+    backing off from pollInterval to maxPollInterval.
+    The id of the last submitted push is stored in stateFile, relative
+    to the master basedir. Pushes are read in pages of pageSize.
+    '''
+    from life.models import Push, Branch, Changeset, File
     from django.db import transaction
+    from django.db.models import Prefetch, Q
+    import django.db.utils
     class MBDBChangeSource(base.ChangeSource):
         debug = True
-        def __init__(self,  pollInterval=30, branch='default'):
+        def __init__(self,  pollInterval=30, branch='default',
+                     stateFile=None, pageSize=500):
             #base.ChangeSource.__init__(self)
             self.pollInterval = pollInterval
             self.latest = None
+            # watermark persisted in stateFile, if given
+            self.stateFile = stateFile
+            self.pageSize = pageSize
+            self.loop = None
             self.branch, created = \
                 Branch.objects.get_or_create(name=branch)
-        
+            # the worker thread doing the database queries, and the
+            # deferred for the currently running poll
+            self.pool = None
+            self.dPoll = None
+            # timing counters for the worker, busy times in seconds
+            self.pollStats = {
+                'polls': 0,
+                'pages': 0,
+                'skipped': 0,
+                'changes': 0,
+                'busy': 0.0,
+                'lastBusy': 0.0,
+                'maxBusy': 0.0,
+                }
+
+        def loadState(self):
+            '''Restore the watermark from stateFile.
+
+            If there's no state, the first poll starts at the latest push.
+            '''
+            if self.stateFile is None or not os.path.exists(self.stateFile):
+                return
+            try:
+                with open(self.stateFile) as f:
+                    self.latest = json.load(f)['latest']
+                log.msg('mbdb changesource resuming after push %d' %
+                        self.latest)
+            except (IOError, ValueError, KeyError):
+                log.err(None, 'failed to read %s' % self.stateFile)
+
+        def saveState(self):
+            '''Write the watermark to stateFile, atomically.'''
+            if self.stateFile is None or self.latest is None:
+                return
+            tmp = self.stateFile + '.tmp'
+            try:
+                with open(tmp, 'w') as f:
+                    json.dump({'latest': self.latest}, f)
+                os.rename(tmp, self.stateFile)
+            except (IOError, OSError):
+                log.err(None, 'failed to write %s' % self.stateFile)
+
         def startService(self):
+            self.loadState()
+            # a single thread, which gets its own django db connection
+            self.pool = ThreadPool(minthreads=1, maxthreads=1,
+                                   name='MBDBChangeSource')
+            self.pool.start()
             self.loop = LoopingCall(self.poll)
             base.ChangeSource.startService(self)
             reactor.callLater(0, self.loop.start, self.pollInterval)
-        
+
         def stopService(self):
-            self.loop.stop()
-            return base.ChangeSource.stopService(self)
+            if self.loop is not None and self.loop.running:
+                self.loop.stop()
+            def stopPool(_):
+                self.pool.stop()
+                self.pool = None
+                return base.ChangeSource.stopService(self)
+            if self.dPoll is None:
+                return stopPool(None)
+            # let the running poll finish, it might be holding a
+            # database connection
+            return self.dPoll.addBoth(stopPool)
 
-        @transaction.atomic
         def poll(self):
             '''Check for new pushes.
+
+            The queries and the creation of the Change objects are run
+            on the worker thread, only the resulting changes are
+            submitted on the reactor. If a poll is still running, this
+            one is skipped.
+            Pushes are read in pages of pageSize, the watermark is
+            saved after each page, and we go back to the reactor before
+            reading the next page.
+            '''
+            if self.dPoll is not None:
+                self.pollStats['skipped'] += 1
+                return
+            if not self.running or self.pool is None:
+                return
+            self.pollStats['polls'] += 1
+            # set dPoll before pollDone can reset it, the page might
+            # already be done
+            self.dPoll = d = self.pollPage()
+            d.addErrback(log.err)
+            d.addBoth(self.pollDone)
+            return d
+
+        def pollPage(self):
+            d = self.inWorker(self.pollInThread, self.latest)
+            d.addCallback(self.onPoll)
+            return d
+
+        def inWorker(self, f, *args):
+            '''Run f on the worker thread, or directly if the
+            service isn't running.
+            '''
+            if self.pool is None:
+                return defer.maybeDeferred(f, *args)
+            return threads.deferToThreadPool(reactor, self.pool, f, *args)
+
+        def pollInThread(self, latest):
+            '''Run a poll on the worker thread.
+
+            Returns the new watermark, the list of changes, the
+            time the worker was busy, whether there are more pushes
+            to read, and the set of repositories that got pushes.
             '''
-            import django.db.utils
+            start = time.time()
+            changes = []
+            more = False
+            repos = set()
             try:
-                if self.latest is None:
-                    try:
-                        self.latest = Push.objects.order_by('-pk')[0].id
-                    except IndexError:
-                        self.latest = 0
-                    return
-                new_pushes = Push.objects.filter(pk__gt=self.latest).order_by('pk')
-                if self.debug:
-                    log.msg('mbdb changesource found %d pushes after %d' % (new_pushes.count(), self.latest))
-                push = None
-                for push in new_pushes:
-                    self.submitChangesForPush(push)
-                if push is not None:
-                    self.latest = push.id
+                latest, changes, more, repos = self.changesSince(latest)
             except django.db.utils.OperationalError:
-                from django import db
                 django.db.connection.close()
                 log.msg('Django database OperationalError caught')
+            return latest, changes, time.time() - start, more, repos
 
-        def submitChangesForPush(self, push):
+        @transaction.atomic
+        def changesSince(self, latest):
+            '''Get the changes for the next page of pushes after latest.
+
+            Returns the new watermark, the list of changes, whether
+            the page was full, and the names of the repositories pushed
+            to.
+            '''
+            if latest is None:
+                try:
+                    latest = Push.objects.order_by('-pk')[0].id
+                except IndexError:
+                    latest = 0
+                return latest, [], False, set()
+            new_pushes = (Push.objects.filter(pk__gt=latest)
+                          .order_by('pk')[:self.pageSize])
+            rv = []
+            repos = set()
+            count = 0
+            for push in self.withChangesets(new_pushes):
+                rv += self.changesForPush(push)
+                for cs in push.changesets.all():
+                    revisions.shortrevs.add(cs.revision, cs.id)
+                repos.add(push.repository.name)
+                latest = push.id
+                count += 1
             if self.debug:
-                log.msg('submitChangesForPush called')
+                log.msg('mbdb changesource found %d pushes, up to %d' %
+                        (count, latest))
+            return latest, rv, count >= self.pageSize, repos
+
+        def onPoll(self, result):
+            latest, changes, busy, more, repos = result
+            # answers for these repositories are outdated now, do this
+            # before the schedulers see the changes
+            for repo in repos:
+                revisions.cache.invalidate(repo)
+            stats = self.pollStats
+            stats['pages'] += 1
+            stats['changes'] += len(changes)
+            stats['busy'] += busy
+            stats['lastBusy'] = busy
+            stats['maxBusy'] = max(stats['maxBusy'], busy)
+            self.latest = latest
+            for c in changes:
+                self.parent.addChange(c)
+            self.saveState()
+            if more:
+                # yield to the reactor before reading the next page
+                return deferLater(reactor, 0, self.pollPage)
+
+        def pollDone(self, result):
+            self.dPoll = None
+            return result
+
+        def withChangesets(self, pushes):
+            '''Join and prefetch all data needed by changesForPush.
+
+            Repositories and forests are joined in, changesets on our
+            branch and their files are prefetched. Iterating over the
+            result costs three queries, independent of the number of
+            pushes.
+            '''
+            files = Prefetch('files', queryset=File.objects.only('path'))
+            changesets = (Changeset.objects
+                          .filter(branch=self.branch)
+                          .order_by('pk')
+                          .prefetch_related(files))
+            return (pushes
+                    .select_related('repository__forest')
+                    .prefetch_related(Prefetch('changesets',
+                                               queryset=changesets)))
+
+        def changesForPush(self, push):
+            '''Create the Change objects for a push.
+
+            The push needs to come from withChangesets, this method
+            doesn't hit the database itself.
+            '''
             repo = push.repository
             if repo.forest is not None:
                 branch = repo.forest.name.encode('utf-8')
                 locale = repo.name[len(branch) + 1:].encode('utf-8')
             else:
                 branch = repo.name.encode('utf-8')
-            for cs in push.changesets.filter(branch=self.branch).order_by('pk'):
-                when = timegm(push.push_date.utctimetuple()) +\
-                    push.push_date.microsecond/1000.0/1000
+            when = timegm(push.push_date.utctimetuple()) +\
+                push.push_date.microsecond/1000.0/1000
+            rv = []
+            for cs in push.changesets.all():
                 c = changes.Change(who=push.user.encode('utf-8'),
-                                    files=map(lambda u: u.encode('utf-8'),
-                                    cs.files.values_list('path', flat=True)),
+                                    files=[f.path.encode('utf-8')
+                                           for f in cs.files.all()],
                                     revision=cs.revision.encode('utf-8'),
                                     comments=cs.description.encode('utf-8'),
                                     when=when,
@@ -79,10 +416,24 @@ def createChangeSource(pollInterval=3*60):
                 if repo.forest is not None:
                     # locale change
                     c.locale = locale
+                rv.append(c)
+            return rv
+
+        def submitChangesForPush(self, push):
+            if self.debug:
+                log.msg('submitChangesForPush called')
+            push = self.withChangesets(Push.objects.filter(pk=push.pk))[0]
+            for c in self.changesForPush(push):
                 self.parent.addChange(c)
 
-        def replay(self, builder, startPush=None, startTime=None, endTime=None):
-            bm = self.parent.parent.botmaster
+        def replay(self, builder, startPush=None, startTime=None,
+                   endTime=None, concurrency=1, coalesce=True,
+                   dryRun=False):
+            '''Replay pushes from the database, see Replay.
+
+            builder is the name of a builder, or a list of names.
+            Returns a deferred that fires with the replay stats.
+            '''
             qd = {}
             if startTime is not None:
                 qd['push_date__gte'] = startTime
@@ -90,23 +441,38 @@ def createChangeSource(pollInterval=3*60):
                 qd['push_date__lte'] = endTime
             if startPush is not None:
                 qd['id__gte'] = startPush
-            q = Push.objects.filter(**qd).order_by('push_date')
-            i = q.iterator()
-            if self.debug:
-                log.msg('replay called for %d pushes' % q.count())
-            def next(_cb):
-                try:
-                    p = i.next()
-                except StopIteration:
-                    log.msg("done iterating")
-                    return
-                self.submitChangesForPush(p)
-                def stumble():
-                    bm.waitUntilBuilderIdle(builder).addCallback(_cb, _cb)
-                reactor.callLater(.5, stumble)
-            def cb(res, _cb):
-                reactor.callLater(.5, next, _cb)
-            next(cb)
+            if isinstance(builder, basestring):
+                builder = [builder]
+            self.replayer = Replay(self, builder, qd,
+                                   concurrency=concurrency,
+                                   coalesce=coalesce,
+                                   dryRun=dryRun)
+            return self.replayer.start()
+
+        def replayCount(self, filters):
+            return Push.objects.filter(**filters).count()
+
+        @transaction.atomic
+        def replayPage(self, filters, after):
+            '''Get the next page of pushes to replay.
+
+            Pushes are ordered by date, after is the (push_date, id) of
+            the last push of the previous page.
+            Returns a list of (repository name, changes) tuples, the
+            new value for after, and whether there are more pushes.
+            '''
+            q = Push.objects.filter(**filters)
+            if after is not None:
+                date, pk = after
+                q = q.filter(Q(push_date__gt=date) |
+                             Q(push_date=date, pk__gt=pk))
+            q = q.order_by('push_date', 'pk')[:self.pageSize]
+            pushes = list(self.withChangesets(q))
+            if pushes:
+                after = (pushes[-1].push_date, pushes[-1].pk)
+            rv = [(push.repository.name, self.changesForPush(push))
+                  for push in pushes]
+            return rv, after, len(pushes) >= self.pageSize
 
         def describe(self):
             return str(self)
@@ -114,5 +480,127 @@ def createChangeSource(pollInterval=3*60):
         def __str__(self):
             return "MBDBChangeSource"
 
-    c = MBDBChangeSource(pollInterval)
+    class NotifiedMBDBChangeSource(MBDBChangeSource):
+        '''MBDBChangeSource driven by push notifications.
+
+        Notifications come in on a unix socket, see PushNotification.
+        Polling is only a fallback for dropped notifications. The
+        interval doubles up to maxPollInterval while fallback polls
+        don't find anything, and goes back to pollInterval once they
+        do. As all polls start at the watermark in self.latest, no push
+        gets submitted twice, no matter which way we learned about it.
+        '''
+        def __init__(self, notifySocket, pollInterval=30,
+                     maxPollInterval=30*60, branch='default',
+                     stateFile=None, pageSize=500):
+            MBDBChangeSource.__init__(self, pollInterval=pollInterval,
+                                      branch=branch, stateFile=stateFile,
+                                      pageSize=pageSize)
+            self.notifySocket = notifySocket
+            self.maxPollInterval = maxPollInterval
+            self.currentInterval = pollInterval
+            self.port = None
+            self.dFallback = None
+            # set if a notification came in during a running poll
+            self.pollAgain = False
+            # set in stopService, no more polls get scheduled then
+            self.stopping = False
+            self.pollStats.update({
+                'notifications': 0,
+                'fallbacks': 0,
+                'missed': 0,
+                })
+
+        def startService(self):
+            self.loadState()
+            self.stopping = False
+            self.pool = ThreadPool(minthreads=1, maxthreads=1,
+                                   name='MBDBChangeSource')
+            self.pool.start()
+            base.ChangeSource.startService(self)
+            if os.path.exists(self.notifySocket):
+                # stale socket from a previous run
+                os.remove(self.notifySocket)
+            self.port = reactor.listenUNIX(self.notifySocket,
+                                           PushNotificationFactory(self))
+            self.dFallback = reactor.callLater(0, self.fallbackPoll)
+
+        def stopService(self):
+            self.stopping = True
+            self.pollAgain = False
+            self.cancelFallback()
+            d = defer.maybeDeferred(self.port.stopListening)
+            d.addCallback(lambda _: MBDBChangeSource.stopService(self))
+            # the running poll might have scheduled a fallback
+            d.addBoth(self.cancelFallback)
+            return d
+
+        def cancelFallback(self, result=None):
+            if self.dFallback is not None and self.dFallback.active():
+                self.dFallback.cancel()
+            self.dFallback = None
+            return result
+
+        def notify(self, push_id):
+            '''Called by PushNotification for each notification.'''
+            self.pollStats['notifications'] += 1
+            if self.stopping:
+                return
+            if (push_id is not None and self.latest is not None
+                and push_id <= self.latest):
+                # we know about this push already
+                return
+            if self.dPoll is not None:
+                self.pollAgain = True
+                return
+            self.scheduleFallback()
+            self.poll()
+
+        def fallbackPoll(self):
+            self.dFallback = None
+            self.pollStats['fallbacks'] += 1
+            previous = self.latest
+            d = self.poll()
+            if d is None:
+                # a poll is running, check again later
+                self.scheduleFallback()
+                return
+            def adapt(_):
+                if previous is not None and self.latest != previous:
+                    # notifications got dropped, poll more often
+                    self.pollStats['missed'] += 1
+                    self.currentInterval = self.pollInterval
+                else:
+                    self.currentInterval = min(self.currentInterval * 2,
+                                               self.maxPollInterval)
+                self.scheduleFallback()
+            d.addCallback(adapt)
+
+        def scheduleFallback(self):
+            if not self.running or self.stopping:
+                return
+            if self.dFallback is not None and self.dFallback.active():
+                self.dFallback.reset(self.currentInterval)
+            else:
+                self.dFallback = reactor.callLater(self.currentInterval,
+                                                   self.fallbackPoll)
+
+        def pollDone(self, result):
+            MBDBChangeSource.pollDone(self, result)
+            if self.pollAgain and not self.stopping:
+                self.pollAgain = False
+                reactor.callLater(0, self.poll)
+            return result
+
+        def __str__(self):
+            return "NotifiedMBDBChangeSource on %s" % self.notifySocket
+
+    if notifySocket is not None:
+        return NotifiedMBDBChangeSource(notifySocket,
+                                        pollInterval=pollInterval,
+                                        maxPollInterval=maxPollInterval,
+                                        stateFile=stateFile,
+                                        pageSize=pageSize)
+    c = MBDBChangeSource(pollInterval, stateFile=stateFile,
+                         pageSize=pageSize)
     return c
@@ -0,0 +1,81 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+'''Master-wide cache of dimension rows, like locales, forests, trees
+and builders.
+
+Each comparison result needs those rows, and they hardly ever change.
+Rows are cached by model and lookup, the least recently used get
+evicted once there are more than maxsize.
+'''
+
+from collections import OrderedDict
+import threading
+
+
+class DimensionCache(object):
+    def __init__(self, maxsize=2000):
+        self.maxsize = maxsize
+        self.entries = OrderedDict()
+        # results can come in on more than one thread
+        self.lock = threading.Lock()
+        self.hits = self.misses = 0
+
+    def key(self, model, lookup):
+        # model instances in lookups are keyed by their primary key
+        return (model._meta.db_table,
+                tuple(sorted((k, getattr(v, 'pk', v))
+                             for k, v in lookup.iteritems())))
+
+    def lookup(self, key):
+        with self.lock:
+            obj = self.entries.pop(key, None)
+            if obj is None:
+                self.misses += 1
+                return None
+            self.entries[key] = obj
+            self.hits += 1
+            return obj
+
+    def store(self, key, obj):
+        with self.lock:
+            self.entries[key] = obj
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+
+    def get(self, model, **lookup):
+        '''Like model.objects.get, raises model.DoesNotExist.'''
+        key = self.key(model, lookup)
+        obj = self.lookup(key)
+        if obj is None:
+            # query outside of the lock
+            obj = model.objects.get(**lookup)
+            self.store(key, obj)
+        return obj
+
+    def get_or_create(self, model, **lookup):
+        '''Like model.objects.get_or_create, returns (object, created).'''
+        key = self.key(model, lookup)
+        obj = self.lookup(key)
+        if obj is not None:
+            return obj, False
+        obj, created = model.objects.get_or_create(**lookup)
+        self.store(key, obj)
+        return obj, created
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def stats(self):
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'size': len(self.entries),
+            'maxsize': self.maxsize,
+            }
+
+
+# master-wide cache, tune through cache.maxsize
+cache = DimensionCache()
@@ -0,0 +1,186 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+'''Index comparison details into Elasticsearch in the background.
+
+The elasticsearch client blocks, so documents are queued on the reactor
+thread, and sent through the bulk API on a worker thread. The queue is
+flushed when it has maxBatch documents, or flushInterval seconds after
+the first document came in. It holds at most maxQueue documents, new
+documents are dropped beyond that.
+'''
+
+from collections import deque
+import time
+
+from twisted.internet import defer, reactor, threads
+from twisted.python import log
+from twisted.python.threadpool import ThreadPool
+
+
+class BulkIndexer(object):
+    def __init__(self, hosts, index, doc_type='comparison',
+                 maxBatch=50, flushInterval=5, maxQueue=1000):
+        self.hosts = hosts
+        self.index = index
+        self.doc_type = doc_type
+        self.maxBatch = maxBatch
+        self.flushInterval = flushInterval
+        self.maxQueue = maxQueue
+        self.queue = deque()
+        self.client = None
+        self.pool = None
+        self.timer = None
+        # Deferred for the bulk request in flight
+        self.dFlush = None
+        self.stats = {
+            'queued': 0,
+            'indexed': 0,
+            'failed': 0,
+            'dropped': 0,
+            'batches': 0,
+            'errors': 0,
+            'maxDepth': 0,
+            'lastFlush': 0.0,
+            }
+
+    def getClient(self):
+        '''The long-lived client, created on first use.'''
+        if self.client is None:
+            import elasticsearch
+            self.client = elasticsearch.Elasticsearch(hosts=self.hosts)
+        return self.client
+
+    def start(self):
+        # a single thread keeps the documents in order
+        self.pool = ThreadPool(minthreads=1, maxthreads=1,
+                               name='BulkIndexer')
+        self.pool.start()
+
+    def stop(self):
+        '''Send the queued documents, and stop the worker thread.'''
+        if self.timer is not None and self.timer.active():
+            self.timer.cancel()
+        self.timer = None
+        d = self.flush(all=True)
+        def stopPool(_):
+            if self.pool is not None:
+                self.pool.stop()
+                self.pool = None
+        return d.addCallback(stopPool)
+
+    def inWorker(self, f, *args):
+        if self.pool is None:
+            return defer.maybeDeferred(f, *args)
+        return threads.deferToThreadPool(reactor, self.pool, f, *args)
+
+    def add(self, id, body):
+        '''Queue a document for indexing.
+
+        Returns False if the document got dropped because the queue
+        is full.
+        '''
+        if len(self.queue) >= self.maxQueue:
+            self.stats['dropped'] += 1
+            log.msg('es indexing queue full, dropping document %s' % id)
+            return False
+        self.queue.append((id, body))
+        self.stats['queued'] += 1
+        self.stats['maxDepth'] = max(self.stats['maxDepth'], len(self.queue))
+        if len(self.queue) >= self.maxBatch:
+            self.flush()
+        elif self.timer is None:
+            self.timer = reactor.callLater(self.flushInterval, self.flush)
+        return True
+
+    def flush(self, all=False):
+        '''Send a batch of queued documents, or all of them.
+
+        Returns a Deferred firing when the batch, or the queue, is done.
+        '''
+        if self.timer is not None:
+            if self.timer.active():
+                self.timer.cancel()
+            self.timer = None
+        if self.dFlush is not None:
+            # one bulk request at a time, queue up behind it
+            d = defer.Deferred()
+            self.dFlush.addBoth(lambda result: d.callback(None) or result)
+            return d.addCallback(lambda _: self.flush(all=all))
+        if not self.queue:
+            return defer.succeed(None)
+        batch = [self.queue.popleft()
+                 for i in xrange(min(self.maxBatch, len(self.queue)))]
+        start = time.time()
+        # set dFlush first, the worker might finish right away
+        self.dFlush = d = defer.Deferred()
+        d.addCallbacks(self.onBulk, self.onBulkError,
+                       callbackArgs=(batch, start),
+                       errbackArgs=(batch,))
+        d.addBoth(self.flushDone)
+        self.inWorker(self.sendBulk, batch).chainDeferred(d)
+        if all:
+            return self.flush(all=True)
+        return d
+
+    def sendBulk(self, batch):
+        '''Runs on the worker thread.'''
+        actions = []
+        for id, body in batch:
+            actions.append({'index': {'_index': self.index,
+                                      '_type': self.doc_type,
+                                      '_id': id}})
+            actions.append(body)
+        return self.getClient().bulk(body=actions)
+
+    def onBulk(self, rv, batch, start):
+        self.stats['batches'] += 1
+        self.stats['lastFlush'] = time.time() - start
+        failed = 0
+        if rv.get('errors'):
+            for item in rv.get('items', []):
+                result = item.get('index', {})
+                if result.get('status', 500) >= 300:
+                    failed += 1
+                    log.msg('es.index failed for %s: %s' %
+                            (result.get('_id'), result.get('error')))
+        self.stats['failed'] += failed
+        self.stats['indexed'] += len(batch) - failed
+
+    def onBulkError(self, failure, batch):
+        self.stats['errors'] += 1
+        self.stats['failed'] += len(batch)
+        log.err(failure, 'es bulk indexing of %d documents failed' %
+                len(batch))
+
+    def flushDone(self, result):
+        self.dFlush = None
+        if len(self.queue) >= self.maxBatch:
+            self.flush()
+        elif self.queue and self.timer is None:
+            self.timer = reactor.callLater(self.flushInterval, self.flush)
+
+    def getStats(self):
+        '''Metrics, including the current queue depth.'''
+        stats = dict(self.stats)
+        stats['depth'] = len(self.queue)
+        return stats
+
+
+# master-wide indexer for comparison details, see getIndexer
+indexer = None
+
+
+def getIndexer():
+    '''Return the master-wide indexer, configured from the django
+    settings ES_COMPARE_HOST and ES_COMPARE_INDEX.
+    '''
+    global indexer
+    if indexer is None:
+        from django.conf import settings
+        indexer = BulkIndexer(settings.ES_COMPARE_HOST,
+                              settings.ES_COMPARE_INDEX)
+        indexer.start()
+        reactor.addSystemEventTrigger('before', 'shutdown', indexer.stop)
+    return indexer
@@ -0,0 +1,256 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+'''Master-wide layer for fetching files from hg web.
+
+Many trees include the same l10n.ini files, like the one for toolkit,
+and load them all at once on startup. Fetcher makes sure each of those
+is requested once at a time, caches the content, and revalidates it
+with conditional requests. Requests are limited per host, time out,
+and get retried with jitter on connection failures and server errors.
+
+With twisted 12.1 and later, requests go through a persistent
+connection pool with keep-alive, accept gzip encoded responses, and
+follow redirects. Older versions open a connection per request.
+'''
+
+from collections import OrderedDict
+import random
+import re
+from urlparse import urlsplit
+
+from twisted.internet import defer, reactor
+from twisted.internet.error import ConnectError, ConnectionLost, TimeoutError
+from twisted.internet.protocol import Protocol
+from twisted.internet.task import deferLater
+from twisted.python import failure, log
+from twisted.web import error
+from twisted.web.client import HTTPClientFactory
+try:
+    from twisted.web.client import (Agent, ContentDecoderAgent, GzipDecoder,
+                                    HTTPConnectionPool, RedirectAgent,
+                                    ResponseDone)
+    from twisted.web.http import PotentialDataLoss
+    from twisted.web.http_headers import Headers
+except ImportError:
+    HTTPConnectionPool = None
+
+# hg web urls for a full changeset hash don't change
+IMMUTABLE = re.compile(r'/(?:raw-file|file|raw-rev)/[0-9a-f]{40}/')
+
+
+class BodyCollector(Protocol):
+    def __init__(self):
+        self.finished = defer.Deferred(self.cancel)
+        self.data = []
+
+    def cancel(self, finished):
+        # like on a timeout, drop the connection
+        if self.transport is not None:
+            self.transport.stopProducing()
+
+    def dataReceived(self, data):
+        self.data.append(data)
+
+    def connectionLost(self, reason):
+        if self.finished.called:
+            # cancelled
+            return
+        if reason.check(ResponseDone, PotentialDataLoss):
+            self.finished.callback(''.join(self.data))
+        else:
+            self.finished.errback(reason)
+
+
+class Fetcher(object):
+    '''Fetch pages, sharing requests and caching their content.
+
+    Returns Deferreds, like twisted.web.client.getPage.
+    '''
+    # failures worth another try
+    retryable = (ConnectError, ConnectionLost, TimeoutError,
+                 getattr(defer, 'CancelledError', TimeoutError))
+
+    def __init__(self, perHost=4, timeout=60, maxsize=500,
+                 retries=2, backoff=1.0):
+        self.perHost = perHost
+        self.timeout = timeout
+        self.maxsize = maxsize
+        self.retries = retries
+        self.backoff = backoff
+        self.pool = self.agent = None
+        # url -> (etag, last-modified, content), least recently used first
+        self.cache = OrderedDict()
+        # url -> Deferreds waiting for the request in flight
+        self.inflight = {}
+        # host -> DeferredSemaphore
+        self.hosts = {}
+        self.stats = {
+            'requests': 0,
+            'fetched': 0,
+            'notModified': 0,
+            'cached': 0,
+            'joined': 0,
+            'errors': 0,
+            'retries': 0,
+            }
+
+    def getAgent(self):
+        '''Create the pooled Agent on first use.'''
+        if self.agent is None and HTTPConnectionPool is not None:
+            self.pool = HTTPConnectionPool(reactor, persistent=True)
+            self.pool.maxPersistentPerHost = self.perHost
+            self.agent = ContentDecoderAgent(
+                RedirectAgent(Agent(reactor, connectTimeout=self.timeout,
+                                    pool=self.pool)),
+                [('gzip', GzipDecoder)])
+        return self.agent
+
+    def close(self):
+        '''Close the idle connections in the pool.'''
+        if self.pool is None:
+            return defer.succeed(None)
+        return self.pool.closeCachedConnections()
+
+    def getPage(self, url):
+        self.stats['requests'] += 1
+        entry = self.cache.pop(url, None)
+        if entry is not None:
+            # most recently used
+            self.cache[url] = entry
+            if IMMUTABLE.search(url):
+                self.stats['cached'] += 1
+                return defer.succeed(entry[2])
+        d = defer.Deferred()
+        if url in self.inflight:
+            self.stats['joined'] += 1
+            self.inflight[url].append(d)
+            return d
+        self.inflight[url] = [d]
+        headers = {}
+        if entry is not None:
+            etag, modified, content = entry
+            if etag:
+                headers['If-None-Match'] = etag
+            if modified:
+                headers['If-Modified-Since'] = modified
+        host = urlsplit(url).netloc
+        if host not in self.hosts:
+            self.hosts[host] = defer.DeferredSemaphore(self.perHost)
+        dRequest = self.hosts[host].run(self.requestWithRetries, url, headers)
+        dRequest.addCallbacks(self.onResponse, self.onError,
+                              callbackArgs=(url,), errbackArgs=(url,))
+        dRequest.addBoth(self.done, url)
+        return d
+
+    def requestWithRetries(self, url, headers, attempt=0):
+        d = self.request(url, headers)
+        def retry(fail):
+            if attempt >= self.retries:
+                return fail
+            if not (fail.check(*self.retryable) or
+                    (fail.check(error.Error) and
+                     fail.value.status.startswith('5'))):
+                return fail
+            self.stats['retries'] += 1
+            delay = self.backoff * 2 ** attempt * random.uniform(.5, 1.5)
+            log.msg('retrying %s in %.1f seconds after %s' %
+                    (url, delay, fail.getErrorMessage()))
+            return deferLater(reactor, delay, self.requestWithRetries,
+                              url, headers, attempt + 1)
+        return d.addErrback(retry)
+
+    def request(self, url, headers):
+        '''Request url, returns a Deferred firing with status, response
+        headers, and body.
+        Other responses than 200 and 304 fail with twisted.web.error.Error.
+        '''
+        agent = self.getAgent()
+        if agent is None:
+            return self.requestWithFactory(url, headers)
+        d = agent.request('GET', url,
+                          Headers(dict((k, [v])
+                                       for k, v in headers.iteritems())))
+        timer = reactor.callLater(self.timeout, d.cancel)
+        def response(response):
+            collector = BodyCollector()
+            response.deliverBody(collector)
+            def body(content):
+                status = str(response.code)
+                if status not in ('200', '304'):
+                    raise error.Error(status, response.phrase, content)
+                return (status,
+                        dict((k.lower(), v) for k, v in
+                             response.headers.getAllRawHeaders()),
+                        content)
+            return collector.finished.addCallback(body)
+        def done(result):
+            if timer.active():
+                timer.cancel()
+            return result
+        return d.addCallback(response).addBoth(done)
+
+    def requestWithFactory(self, url, headers):
+        factory = HTTPClientFactory(url, headers=headers,
+                                    timeout=self.timeout)
+        parts = urlsplit(url)
+        if parts.scheme == 'https':
+            from twisted.internet import ssl
+            reactor.connectSSL(parts.hostname, parts.port or 443, factory,
+                               ssl.ClientContextFactory())
+        else:
+            reactor.connectTCP(parts.hostname, parts.port or 80, factory)
+        def response(body):
+            return factory.status, factory.response_headers, body
+        return factory.deferred.addCallback(response)
+
+    def onResponse(self, (status, headers, body), url, refetch=True):
+        if status == '304':
+            if url in self.cache:
+                self.stats['notModified'] += 1
+                return self.cache[url][2]
+            if refetch:
+                return self.refetch(url)
+            raise error.Error(status, 'Not Modified')
+        self.stats['fetched'] += 1
+        def header(name):
+            values = headers.get(name)
+            return values[0] if values else None
+        etag, modified = header('etag'), header('last-modified')
+        if etag or modified or IMMUTABLE.search(url):
+            self.cache.pop(url, None)
+            self.cache[url] = (etag, modified, body)
+            while len(self.cache) > self.maxsize:
+                self.cache.popitem(last=False)
+        return body
+
+    def onError(self, fail, url, refetch=True):
+        if fail.check(error.Error) and fail.value.status == '304':
+            if url in self.cache:
+                self.stats['notModified'] += 1
+                return self.cache[url][2]
+            if refetch:
+                return self.refetch(url)
+        self.stats['errors'] += 1
+        return fail
+
+    def refetch(self, url):
+        '''The cache entry got evicted while revalidating it, get the
+        content again, unconditionally.
+        '''
+        d = self.requestWithRetries(url, {})
+        d.addCallbacks(self.onResponse, self.onError,
+                       callbackArgs=(url, False), errbackArgs=(url, False))
+        return d
+
+    def done(self, result, url):
+        for d in self.inflight.pop(url):
+            if isinstance(result, failure.Failure):
+                d.errback(result)
+            else:
+                d.callback(result)
+
+
+# master-wide fetcher
+fetcher = Fetcher()
@@ -0,0 +1,87 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+'''Journal of the work an AppScheduler didn't submit yet.
+
+Pending comparisons are stored as (tree, locale, change number) rows,
+and changes waiting for tree builds by their change number. Rows are
+removed when the work gets submitted, so the journal stays as small
+as the in-memory queues. The changes themselves are restored from the
+buildmaster's change store.
+'''
+
+import sqlite3
+from collections import defaultdict
+
+
+class PendingJournal(object):
+    def __init__(self, path):
+        self.path = path
+        self.db = sqlite3.connect(path)
+        # we're on the reactor thread, don't wait for fsync on each write
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        with self.db:
+            self.db.execute('''CREATE TABLE IF NOT EXISTS pending (
+                tree TEXT, locale TEXT, change INTEGER,
+                PRIMARY KEY (tree, locale, change))''')
+            self.db.execute('''CREATE TABLE IF NOT EXISTS gated (
+                change INTEGER PRIMARY KEY, queued REAL)''')
+
+    def addPending(self, tree, locale, numbers):
+        with self.db:
+            self.db.executemany('INSERT OR IGNORE INTO pending '
+                                'VALUES (?, ?, ?)',
+                                [(tree, locale, n) for n in numbers
+                                 if n is not None])
+
+    def removePending(self, keys):
+        '''Remove all rows for the tree/locale tuples in keys.'''
+        with self.db:
+            self.db.executemany('DELETE FROM pending '
+                                'WHERE tree = ? AND locale = ?',
+                                keys)
+
+    def removeChanges(self, tree, locale, numbers):
+        '''Remove the rows for the given changes to a tree/locale, after
+        submitting them.'''
+        with self.db:
+            self.db.executemany('DELETE FROM pending '
+                                'WHERE tree = ? AND locale = ? AND change = ?',
+                                [(tree, locale, n) for n in numbers
+                                 if n is not None])
+
+    def addGated(self, number, queued):
+        if number is None:
+            return
+        with self.db:
+            self.db.execute('INSERT OR REPLACE INTO gated VALUES (?, ?)',
+                            (number, queued))
+
+    def removeGated(self, number):
+        with self.db:
+            self.db.execute('DELETE FROM gated WHERE change = ?', (number,))
+
+    def load(self):
+        '''Return the journalled work.
+
+        That's a dict mapping tree/locale tuples to change numbers, and
+        the list of gated change numbers, in the order they came in.
+        '''
+        pendings = defaultdict(list)
+        for tree, locale, number in self.db.execute(
+            'SELECT tree, locale, change FROM pending '
+            'ORDER BY tree, locale, change'):
+            pendings[(str(tree), str(locale))].append(number)
+        gated = [number for number, in self.db.execute(
+            'SELECT change FROM gated ORDER BY queued, change')]
+        return dict(pendings), gated
+
+    def clear(self):
+        with self.db:
+            self.db.execute('DELETE FROM pending')
+            self.db.execute('DELETE FROM gated')
+
+    def close(self):
+        self.db.close()
@@ -0,0 +1,248 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+'''Resolve the revisions to build from the pushes in the database.
+
+The question we ask is "what's the latest changeset on the default
+branch in repository X, pushed at or before time T". For multiple
+locales and trees, that's asked for many repositories at once, so
+resolve them in batches.
+
+The other way around, comparison results link to the changesets they
+were run on, found by their short revisions. Those are resolved for a
+run at once, with the help of a map of short revisions that the change
+source keeps up to date.
+'''
+
+from collections import defaultdict, OrderedDict
+import threading
+
+
+class RevisionCache(object):
+    '''LRU cache of resolved revisions, keyed by repository.
+
+    Each repository holds the answers for (hg branch, cutoff time)
+    lookups, None for lookups without pushes. The least recently used
+    repositories are evicted once there are more than maxsize answers.
+    MBDBChangeSource invalidates a repository when it sees a new push
+    to it.
+    '''
+    def __init__(self, maxsize=5000):
+        self.maxsize = maxsize
+        self.repos = OrderedDict()
+        self.size = 0
+        self.hits = self.misses = 0
+        self.evictions = self.invalidations = 0
+
+    def get(self, repo, hg_branch, when):
+        '''Return (found, revision) for the given lookup.'''
+        try:
+            entries = self.repos.pop(repo)
+        except KeyError:
+            self.misses += 1
+            return False, None
+        # move to the end, most recently used
+        self.repos[repo] = entries
+        try:
+            rv = entries[(hg_branch, when)]
+        except KeyError:
+            self.misses += 1
+            return False, None
+        self.hits += 1
+        return True, rv
+
+    def set(self, repo, hg_branch, when, revision):
+        entries = self.repos.pop(repo, {})
+        if (hg_branch, when) not in entries:
+            self.size += 1
+        entries[(hg_branch, when)] = revision
+        self.repos[repo] = entries
+        while self.size > self.maxsize and len(self.repos) > 1:
+            _repo, _entries = self.repos.popitem(last=False)
+            self.size -= len(_entries)
+            self.evictions += 1
+
+    def invalidate(self, repo):
+        entries = self.repos.pop(repo, None)
+        if entries is not None:
+            self.size -= len(entries)
+            self.invalidations += 1
+
+    def clear(self):
+        self.repos.clear()
+        self.size = 0
+
+    def stats(self):
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'invalidations': self.invalidations,
+            'size': self.size,
+            'repositories': len(self.repos),
+            'maxsize': self.maxsize,
+            }
+
+
+# master-wide cache, tune through cache.maxsize
+cache = RevisionCache()
+
+
+def resolveRevisions(lookups, hg_branch='default', cache=cache):
+    '''Resolve a set of (repository name, cutoff time) tuples.
+
+    For each, find the latest push to the repository at or before the
+    cutoff that has changesets on hg_branch, and the latest of those
+    changesets. This doesn't need to be the tip of the push, for
+    pushes with heads on multiple branches (bug 602182).
+
+    Returns a dict mapping the lookups to short revisions, lookups
+    without pushes are left out. Without a database, that's all of them.
+    Answers are taken from cache if possible. The rest costs one query
+    per distinct cutoff time, and one for the changesets.
+    '''
+    rv = {}
+    bywhen = defaultdict(set)
+    for repo, when in lookups:
+        if cache is not None:
+            found, revision = cache.get(repo, hg_branch, when)
+            if found:
+                if revision is not None:
+                    rv[(repo, when)] = revision
+                continue
+        bywhen[when].add(repo)
+    if not bywhen:
+        return rv
+    try:
+        resolved = _resolve(bywhen, hg_branch)
+    except ImportError:
+        # no elmo models, like when testing the scheduler on its own
+        return rv
+    rv.update(resolved)
+    if cache is not None:
+        for when, repos in bywhen.iteritems():
+            for repo in repos:
+                cache.set(repo, hg_branch, when, resolved.get((repo, when)))
+    return rv
+
+
+def _resolve(bywhen, hg_branch):
+    from life.models import Push
+    from django.db.models import Max
+    # map push ids to the lookups they answer
+    pushes = defaultdict(list)
+    for when, repos in bywhen.iteritems():
+        q = (Push.objects
+             .filter(repository__name__in=repos,
+                     push_date__lte=when,
+                     changesets__branch__name=hg_branch)
+             .values_list('repository__name')
+             .annotate(Max('pk')))
+        for repo, push_id in q:
+            pushes[push_id].append((repo, when))
+    if not pushes:
+        return {}
+    latest = {}
+    q = (Push.changesets.through.objects
+         .filter(push__in=pushes.keys(),
+                 changeset__branch__name=hg_branch)
+         .values_list('push_id', 'changeset_id', 'changeset__revision'))
+    for push_id, cs_id, revision in q:
+        if push_id not in latest or cs_id > latest[push_id][0]:
+            latest[push_id] = (cs_id, revision)
+    rv = {}
+    for push_id, (cs_id, revision) in latest.iteritems():
+        for lookup in pushes[push_id]:
+            rv[lookup] = str(revision[:12])
+    return rv
+
+
+class ShortRevisions(object):
+    '''Map of short revisions to changeset ids.
+
+    MBDBChangeSource adds the changesets it sees on its worker thread,
+    so this is guarded by a lock. Short revisions that are shared by
+    more than one changeset map to None. The least recently added
+    revisions are evicted once there are more than maxsize.
+    '''
+    def __init__(self, maxsize=100000):
+        self.maxsize = maxsize
+        self.ids = OrderedDict()
+        self.lock = threading.Lock()
+
+    def add(self, revision, cs_id):
+        short = revision[:12]
+        with self.lock:
+            known = self.ids.pop(short, cs_id)
+            self.ids[short] = cs_id if known == cs_id else None
+            while len(self.ids) > self.maxsize:
+                self.ids.popitem(last=False)
+
+    def get(self, short):
+        '''Return (found, changeset id or None if ambiguous).'''
+        with self.lock:
+            if short not in self.ids:
+                return False, None
+            return True, self.ids[short]
+
+    def clear(self):
+        with self.lock:
+            self.ids.clear()
+
+
+# master-wide map, tune through shortrevs.maxsize
+shortrevs = ShortRevisions()
+
+
+def resolveRun(lookups, shortrevs=shortrevs):
+    '''Resolve the revisions of a comparison run.
+
+    lookups is a list of (repository name, short revision) tuples.
+    Returns a dict mapping the short revisions to changeset ids, and
+    the latest of the earliest push dates of the changesets to their
+    repositories, or None.
+    Revisions that aren't in shortrevs cost one query, and the push
+    dates one more.
+    '''
+    from life.models import Changeset, Push
+    from django.db.models import Min, Q
+    ids = {}
+    misses = set()
+    for repo, short in lookups:
+        found, cs_id = shortrevs.get(short)
+        if not found:
+            misses.add(short)
+        elif cs_id is not None:
+            ids[short] = cs_id
+    if misses:
+        matches = defaultdict(list)
+        q = reduce(lambda a, b: a | b,
+                   (Q(revision__startswith=short) for short in misses))
+        for cs_id, revision in (Changeset.objects.filter(q)
+                                .values_list('id', 'revision')):
+            for short in misses:
+                if revision.startswith(short):
+                    matches[short].append(cs_id)
+        for short, cs_ids in matches.iteritems():
+            if len(cs_ids) == 1:
+                ids[short] = cs_ids[0]
+                shortrevs.add(short, cs_ids[0])
+    # the null changeset is in all repositories, it doesn't have a
+    # meaningful push date
+    wanted = set((repo, ids[short]) for repo, short in lookups
+                 if ids.get(short, 1) != 1)
+    if not wanted:
+        return ids, None
+    q = (Push.changesets.through.objects
+         .filter(changeset__in=set(cs_id for repo, cs_id in wanted),
+                 push__repository__name__in=set(repo for repo, cs_id
+                                                in wanted))
+         .values_list('changeset_id', 'push__repository__name')
+         .annotate(Min('push__push_date')))
+    srctime = None
+    for cs_id, repo, push_date in q:
+        if (repo, cs_id) in wanted:
+            srctime = push_date if srctime is None else max(srctime,
+                                                            push_date)
+    return ids, srctime
@@ -2,21 +2,27 @@
 # License, v. 2.0. If a copy of the MPL was not distributed with this
 # file, You can obtain one at http://mozilla.org/MPL/2.0/.
 
-from twisted.python import log
+from twisted.python import log, failure
 from buildbot.scheduler import BaseUpstreamScheduler
 from buildbot.sourcestamp import SourceStamp
 from buildbot import buildset
 from buildbot.process import properties
+from buildbot.status.builder import SKIPPED
 from buildbot.util import ComparableMixin
-from twisted.internet import defer, reactor
-from twisted.web.client import getPage
+from twisted.internet import defer, reactor, task
 
-from collections import defaultdict
+from collections import defaultdict, deque, OrderedDict
 from datetime import datetime
+import itertools
 import os.path
+import time
 from ConfigParser import ConfigParser, NoSectionError, NoOptionError
+try:
+    import json
+except ImportError:
+    import simplejson as json
 
-import logger, util
+import fetch, journal, logger, revisions, treeloader, util
 
 #from bb2mbdb.utils import timeHelper
 def timeHelper(t):
@@ -57,12 +63,287 @@ class Tree(ComparableMixin):
             else:
                 self.l10ninis[branch] = [l10nini]
 
+    snapshot_attrs = ('name', 'repo', 'branches', 'l10ninis', 'all_locales',
+                      'locales', 'branch2dirs', 'tld')
+
+    def toJSON(self):
+        return dict((attr, getattr(self, attr))
+                    for attr in self.snapshot_attrs)
+
+    @classmethod
+    def fromJSON(cls, data):
+        tree = cls.__new__(cls)
+        for attr in cls.snapshot_attrs:
+            setattr(tree, attr, data[attr])
+        return tree
+
+
+class PathRouter(object):
+    '''Path-segment trie resolving file paths to trees.
+
+    Paths are registered with a kind and a set of trees.
+    Kinds in prefixKinds match all files below the registered path,
+    'en-US' matches files in locales/en-US right below the registered
+    path, all other kinds only match the exact path.
+    '''
+    class Node(object):
+        __slots__ = ('children', 'trees')
+        def __init__(self):
+            self.children = {}
+            self.trees = {}
+
+    def __init__(self, prefixKinds=()):
+        self.prefixKinds = prefixKinds
+        self.root = self.Node()
+
+    @staticmethod
+    def segments(path):
+        return [s for s in path.split('/') if s]
+
+    def add(self, path, kind, trees):
+        node = self.root
+        for seg in self.segments(path):
+            child = node.children.get(seg)
+            if child is None:
+                child = node.children[seg] = self.Node()
+            node = child
+        node.trees.setdefault(kind, set()).update(trees)
+
+    def route(self, path):
+        '''Resolve a file path in one walk down the trie.
+
+        Returns a dict mapping kinds to sets of trees, and whether the
+        path is in a toplevel locales/en-US, aka single-module-hg.
+        '''
+        segs = self.segments(path)
+        rv = defaultdict(set)
+        # the first locales/en-US in the path marks the module
+        enUS = None
+        for i in xrange(len(segs) - 1):
+            if segs[i] == 'locales' and segs[i + 1] == 'en-US':
+                enUS = i
+                break
+        node = self.root
+        depth = 0
+        while True:
+            for kind in self.prefixKinds:
+                if kind in node.trees:
+                    rv[kind] |= node.trees[kind]
+            if depth == enUS and depth and 'en-US' in node.trees:
+                rv['en-US'] |= node.trees['en-US']
+            if depth == len(segs):
+                for kind, trees in node.trees.iteritems():
+                    if kind not in self.prefixKinds and kind != 'en-US':
+                        rv[kind] |= trees
+                break
+            node = node.children.get(segs[depth])
+            if node is None:
+                break
+            depth += 1
+        return rv, enUS == 0
+
+
+class UnclaimedBuildSets(object):
+    '''Track the latest comparison BuildSet per key, like tree/locale.
+
+    When a newer BuildSet for the same key comes along while no build
+    got started for the old one, the old one is cancelled, and its
+    changes get merged into the new one. That way, there's at most one
+    pending comparison per key. Cancelled BuildSets finish as SKIPPED.
+    '''
+    def __init__(self, scheduler):
+        self.scheduler = scheduler
+        self.buildsets = {}
+        self.superseded = 0
+
+    def getBuilder(self, name):
+        botmaster = getattr(self.scheduler.parent, 'botmaster', None)
+        if botmaster is None:
+            return None
+        return botmaster.builders.get(name)
+
+    def supersede(self, key, changes):
+        '''Cancel the unclaimed BuildSet for key, if any.
+
+        Returns the list of changes for the new BuildSet.
+        '''
+        bs = self.buildsets.pop(key, None)
+        if bs is None or not bs.requests:
+            return changes
+        if bs.status.isFinished():
+            return changes
+        for req in bs.requests:
+            if req.status.getBuilds():
+                # claimed already
+                return changes
+        builders = [self.getBuilder(req.builderName) for req in bs.requests]
+        if None in builders:
+            return changes
+        # builders might have claimed requests since we checked
+        cancelled = [req for builder, req in zip(builders, bs.requests)
+                     if builder.cancelBuildRequest(req)]
+        if not cancelled:
+            return changes
+        for req in cancelled:
+            bs.requests.remove(req)
+        if bs.requests:
+            # partly claimed, the cancelled builders need the old changes,
+            # the claimed builds finish the old BuildSet
+            logger.debug('scheduler.l10n',
+                         'merging partly claimed build for %s' % str(key))
+        else:
+            self.finishCancelled(bs)
+            self.superseded += 1
+            logger.debug('scheduler.l10n',
+                         'superseding pending build for %s' % str(key))
+        return [c for c in bs.source.changes if c not in changes] + changes
+
+    def finishCancelled(self, bs):
+        '''Finish a BuildSet without requests, so that its watchers fire.'''
+        bs.stillHopeful = False
+        bs.status.setResults(SKIPPED)
+        bs.status.giveUpHope()
+        bs.status.notifySuccessWatchers()
+        bs.status.notifyFinishedWatchers()
+
+    def track(self, key, bs):
+        self.buildsets[key] = bs
+        def finished(_):
+            if self.buildsets.get(key) is bs:
+                del self.buildsets[key]
+        bs.waitUntilFinished().addCallback(finished)
+
+
+class AllLocalesCache(object):
+    '''Parsed all-locales files by repository, branch, path and revision.
+
+    Concurrent requests for the same file share one fetch. Files at a
+    revision don't change, so they're cached, up to maxsize of them.
+    Files on 'default' aren't cached.
+    '''
+    def __init__(self, getPage, maxsize=200):
+        self.getPage = getPage
+        self.maxsize = maxsize
+        self.entries = OrderedDict()
+        self.inflight = {}
+        self.hits = self.fetches = 0
+
+    def get(self, repo, branch, path, rev):
+        '''Returns a Deferred firing with the sorted list of locales.'''
+        key = (repo, branch, path, rev)
+        if key in self.entries:
+            self.hits += 1
+            return defer.succeed(self.entries[key])
+        d = defer.Deferred()
+        if key in self.inflight:
+            self.hits += 1
+            self.inflight[key].append(d)
+            return d
+        self.inflight[key] = [d]
+        self.fetches += 1
+        url = repo + '/' + branch + '/raw-file/' + rev + '/' + path
+        dPage = self.getPage(url)
+        dPage.addCallback(self.parse, key)
+        dPage.addBoth(self.done, key)
+        return d
+
+    def parse(self, page, key):
+        locales = util.parseLocales(page)
+        if key[3] != 'default':
+            self.entries[key] = locales
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+        return locales
+
+    def done(self, result, key):
+        for d in self.inflight.pop(key):
+            if isinstance(result, failure.Failure):
+                d.errback(result)
+            else:
+                d.callback(result)
+
+
+class PriorityPolicy(object):
+    '''Order pending comparisons for submission.
+
+    Comparisons are ordered by priority first, higher values first.
+    Priorities come from the sections in l10nbuilds.ini, with an
+    optional priority for the tree, and priority.<locale> for
+    individual locales, like
+
+      [fx]
+      priority = 10
+      priority.de = 20
+
+    Within one priority, trees take turns, and each tree submits the
+    locale with the oldest completed comparison first.
+
+    Other policies need to implement configure, built, and order.
+    '''
+    def __init__(self, default=0):
+        self.default = default
+        self.treePriority = {}
+        self.localePriority = {}
+        # time of the last completed comparison per tree/locale
+        self.lastBuilt = {}
+
+    def configure(self, cp):
+        '''Read priorities from the ConfigParser for l10nbuilds.ini'''
+        self.treePriority.clear()
+        self.localePriority.clear()
+        for section in cp.sections():
+            for option, value in cp.items(section):
+                try:
+                    if option == 'priority':
+                        self.treePriority[section] = int(value)
+                    elif option.startswith('priority.'):
+                        # ConfigParser lowercases option names
+                        locale = option[len('priority.'):]
+                        self.localePriority[(section, locale)] = int(value)
+                except ValueError:
+                    log.msg('bad priority %s for %s' % (value, section))
+
+    def priority(self, key):
+        tree, locale = key
+        try:
+            return self.localePriority[(tree, locale.lower())]
+        except KeyError:
+            return self.treePriority.get(tree, self.default)
+
+    def built(self, key, when):
+        '''Called when a comparison for key completed.'''
+        self.lastBuilt[key] = when
+
+    def staleness(self, key):
+        # never built sorts first
+        return self.lastBuilt.get(key, 0)
+
+    def order(self, keys):
+        '''Return the tree/locale keys in the order to submit them.'''
+        classes = defaultdict(lambda: defaultdict(list))
+        for key in keys:
+            classes[self.priority(key)][key[0]].append(key)
+        rv = []
+        for prio in sorted(classes, reverse=True):
+            queues = [deque(sorted(pertree,
+                                   key=lambda k: (self.staleness(k), k)))
+                      for pertree in classes[prio].itervalues()]
+            while queues:
+                # in each round, the tree with the stalest locale goes first
+                queues.sort(key=lambda q: (self.staleness(q[0]), q[0]))
+                for q in queues:
+                    rv.append(q.popleft())
+                queues = [q for q in queues if q]
+        return rv
+
 
 class AppScheduler(BaseUpstreamScheduler):
     """Scheduler used for app compare-locales builds.
     """
 
-    compare_attrs = ('name', 'builderNames', 'treebuilder', 'inipath', 'trees')
+    compare_attrs = ('name', 'builderNames', 'treebuilder', 'inipath', 'trees',
+                     'coalesceWindow', 'maxDelay', 'snapshotFile',
+                     'journalFile', 'treeConcurrency', 'auditTrees')
 
     class BranchData:
         '''Helper class that caches the data of all trees per hg branch.
@@ -72,18 +353,80 @@ class AppScheduler(BaseUpstreamScheduler):
             self.dirs = defaultdict(list)
             self.topleveltrees = set()
             self.all_locales = defaultdict(set)
+            self.router = None
         def addDirs(self, tree, dirs):
             for d in dirs:
                 self.dirs[d].append(tree)
+        def route(self, path):
+            '''Return the trees affected by path by kind, 'en-US' and
+            'all_locales', and whether path is a toplevel en-US file.
+            The router is compiled on first use after invalidate().
+            '''
+            if self.router is None:
+                router = PathRouter()
+                for d, trees in self.dirs.iteritems():
+                    router.add(d, 'en-US', trees)
+                for path_, trees in self.all_locales.iteritems():
+                    router.add(path_, 'all_locales', trees)
+                self.router = router
+            return self.router.route(path)
+        def invalidate(self):
+            self.router = None
+        def removeDirs(self, tree, dirs):
+            for d in dirs:
+                if d not in self.dirs:
+                    continue
+                self.dirs[d] = [t for t in self.dirs[d] if t != tree]
+                if not self.dirs[d]:
+                    del self.dirs[d]
+        def removeInis(self, tree, inis):
+            for ini in inis:
+                if ini not in self.inis:
+                    continue
+                self.inis[ini] = [t for t in self.inis[ini] if t != tree]
+                if not self.inis[ini]:
+                    del self.inis[ini]
+        def removeAllLocales(self, tree, path):
+            if path not in self.all_locales:
+                return
+            self.all_locales[path].discard(tree)
+            if not self.all_locales[path]:
+                del self.all_locales[path]
+        def isEmpty(self):
+            return not (self.inis or self.dirs or self.topleveltrees or
+                        self.all_locales)
 
     class L10nDirs(defaultdict):
         def __init__(self):
             defaultdict.__init__(self, set)
+            self.router = None
+        def route(self, path):
+            '''Return the set of trees with a module containing path.
+            The router is compiled on first use after invalidate().
+            '''
+            if self.router is None:
+                router = PathRouter(prefixKinds=('l10n',))
+                for d, trees in self.iteritems():
+                    router.add(d, 'l10n', trees)
+                self.router = router
+            return self.router.route(path)[0]['l10n']
+        def invalidate(self):
+            self.router = None
         def addDirs(self, tree, dirs):
             for d in dirs:
                 self[d].add(tree) 
+        def removeDirs(self, tree, dirs):
+            for d in dirs:
+                if d not in self:
+                    continue
+                self[d].discard(tree)
+                if not self[d]:
+                    del self[d]
 
-    def __init__(self, name, builderNames, inipath, treebuildername):
+    def __init__(self, name, builderNames, inipath, treebuildername,
+                 coalesceWindow=0, maxDelay=None, policy=None,
+                 snapshotFile=None, journalFile=None,
+                 treeConcurrency=None, auditTrees=False):
         """
         @param name: the name of this Scheduler
         @param builderNames: a list of Builder names. When this Scheduler
@@ -92,6 +435,20 @@ class AppScheduler(BaseUpstreamScheduler):
         @param inipath: path to l10nbuilds.ini, describing the apps
         @param treebuildername: the name of the builder that collects
                                 tree info from remote l10n.ini files
+        @param coalesceWindow: seconds to wait for more changes to the
+                               same tree and locale before comparing
+        @param maxDelay: maximum seconds a change waits for more changes,
+                         defaults to 4 times coalesceWindow
+        @param policy: orders pending comparisons, defaults to a
+                       PriorityPolicy
+        @param snapshotFile: local file to keep the tree data in, to
+                             schedule right away after a master restart
+        @param journalFile: local SQLite file to keep the pending work
+                            in, to pick it up after a master restart
+        @param treeConcurrency: load trees in the scheduler, this many at
+                                a time, instead of on the tree builder
+        @param auditTrees: with treeConcurrency, still run tree builds,
+                           as a record of the loaded tree data
         """
 
         BaseUpstreamScheduler.__init__(self, name)
@@ -102,18 +459,167 @@ class AppScheduler(BaseUpstreamScheduler):
             assert os.path.exists(inipath)
         self.inipath = inipath
         self.treebuilder = treebuildername
+        self.treeConcurrency = treeConcurrency
+        self.auditTrees = auditTrees
+        if treeConcurrency:
+            self.treeSemaphore = defer.DeferredSemaphore(treeConcurrency)
+        # when startService started loading trees, and how long it took
+        self.treeLoadStart = None
+        self.treeLoadTime = None
+        self.treeLoadFetches = 0
+        self.snapshotFile = snapshotFile
+        # pending snapshot write, and whether the trees changed since
+        # the last one
+        self.dSaveSnapshot = None
+        self.snapshotDirty = False
+        self.journalFile = journalFile
         self.trees = {}
+        # options per section in l10nbuilds.ini, to diff on reloadIni
+        self.sections = {}
         # just volatile data below
         # cache tree data per hg repo branch
         self.branches = defaultdict(self.BranchData)
         self.l10nbranches = defaultdict(self.L10nDirs)
         # map tree/locale tuples to list of changes
         self.pendings = defaultdict(list)
+        # tree/locale tuples that are done waiting for more changes,
+        # and the debounce timers and first arrival for the others
+        self.coalesceWindow = coalesceWindow
+        if maxDelay is None:
+            maxDelay = 4 * coalesceWindow
+        self.maxDelay = maxDelay
+        self.ready = set()
+        self.debounce = {}
+        self.unclaimed = UnclaimedBuildSets(self)
+        if policy is None:
+            policy = PriorityPolicy()
+        self.policy = policy
+        self.coalesceStats = {
+            'merged': 0,
+            'submitted': 0,
+            'maxDelayed': 0,
+            }
         self.dSubmitBuildsets = None
-        # deferred that's non-None if a tree builds are currently running
+        # deferred that's non-None while the initial tree builds are running
         self.waitOnTree = None
-        self.pendingChanges = []
+        # number of running tree builds per tree name, changes for those
+        # trees wait in pendingChanges, together with the time they came in
+        self.loadingTrees = defaultdict(int)
+        self.pendingChanges = deque()
+        self.pendingStats = {
+            'queued': 0,
+            'maxDepth': 0,
+            'waited': 0.0,
+            'maxWait': 0.0,
+            }
         self.treesToDo = set() # trees that changed on a tree build
+        # en-US fan-out and buildset submission run as cooperative
+        # tasks, doing workBudget steps per reactor iteration
+        self.workBudget = 20
+        self.cooperator = None
+        # number of running fan-outs, ready comparisons wait for them,
+        # to be ordered by priority all together
+        self.fanOuts = 0
+        # parsed all-locales files
+        self.allLocales = AllLocalesCache(lambda url: self.getPage(url))
+        # PendingJournal, and the work from the last run to replay once
+        # we know our trees
+        self.journal = None
+        self.journalReplay = None
+
+    def workUnits(self):
+        '''Termination predicate factory for our Cooperator.'''
+        steps = itertools.count(1)
+        return lambda: steps.next() >= self.workBudget
+
+    def stopService(self):
+        if self.cooperator is not None:
+            # stopping ends the running fan-outs, fanOutDone checks
+            # for the cooperator to not schedule submissions anymore
+            cooperator, self.cooperator = self.cooperator, None
+            cooperator.stop()
+        # don't wait for more changes, submit with the ready ones below
+        for key in self.debounce.keys():
+            self.readyBuild(key)
+        if self.dSubmitBuildsets is not None:
+            # don't lose ready builds on reconfig
+            if self.dSubmitBuildsets.active():
+                self.dSubmitBuildsets.cancel()
+            self.dSubmitBuildsets = None
+        if self.ready:
+            for _ in self.iterBuildsets(*self.takeReady()):
+                pass
+        if self.snapshotDirty:
+            # don't lose tree data on reconfig, even if the write
+            # waits for tree loads
+            self.saveSnapshot()
+        if self.journal is not None:
+            self.journal.close()
+            self.journal = None
+        return BaseUpstreamScheduler.stopService(self)
+
+    def openJournal(self):
+        '''Open the journal, and take the work of the last run from it.
+
+        The rows stay in the journal until the work got submitted again,
+        so that they survive a restart before the replay.
+        '''
+        if self.journalFile is None:
+            return
+        self.journal = journal.PendingJournal(self.journalFile)
+        self.journalReplay = self.journal.load()
+
+    def replayJournal(self):
+        '''Schedule the work from the journal of the last run.
+
+        Needs the trees, pending comparisons for trees we don't have
+        anymore are dropped. The journal keeps the replayed rows until
+        their work is submitted, only dropped work is removed.
+        '''
+        if self.journalReplay is None:
+            return
+        pendings, gated = self.journalReplay
+        self.journalReplay = None
+        change_svc = getattr(self.parent, 'change_svc', None)
+        if change_svc is None:
+            log.msg('no change source, dropping journalled work')
+            return
+        missing = []
+        def getChanges(numbers):
+            changes = []
+            for n in numbers:
+                change = change_svc.getChangeNumbered(n)
+                if change is None:
+                    missing.append(n)
+                else:
+                    changes.append(change)
+            return changes
+        replayed = 0
+        dropped = []
+        for (tree, locale), numbers in sorted(pendings.iteritems()):
+            if tree not in self.trees:
+                dropped.append((tree, locale))
+                continue
+            changes = getChanges(numbers)
+            found = set(c.number for c in changes)
+            self.journal.removeChanges(tree, locale,
+                                       [n for n in numbers if n not in found])
+            if changes:
+                self.compareBuild(tree, locale, changes)
+                replayed += 1
+        self.journal.removePending(dropped)
+        for n in gated:
+            change = change_svc.getChangeNumbered(n)
+            if change is None:
+                missing.append(n)
+                self.journal.removeGated(n)
+                continue
+            self.fixupLocale(change)
+            if not self.gateChange(change):
+                self.releaseChange(change)
+        log.msg('replayed %d comparisons and %d changes from %s, '
+                '%d changes missing' %
+                (replayed, len(gated), self.journalFile, len(missing)))
 
     def listBuilderNames(self):
         return self.builderNames + [self.treebuilder]
@@ -123,6 +629,11 @@ class AppScheduler(BaseUpstreamScheduler):
 
     def addTree(self, tree, changes=None):
         '''Callback that is passed to the TreeLoader step'''
+        if self.inipath is not None and tree.name not in self.sections:
+            # tree build for a section that got removed since
+            logger.debug('scheduler.l10n',
+                         'Ignoring tree info for dropped %s' % tree.name)
+            return
         if tree.name in self.trees:
             if self.trees[tree.name] == tree:
                 # we allready got that tree, all good
@@ -130,42 +641,194 @@ class AppScheduler(BaseUpstreamScheduler):
                              'Tree info for %s loaded, unchanged' % tree.name)
                 return
             # updated tree. Add this to treesToDo, which will be picked up
-            # by checkEnUS, called after the buildset is done
+            # by checkEnUS for the change that loaded it, called after
+            # the buildset is done, or by onTreesBuilt after a reload
             self.treesToDo.add(tree.name)
+        old = self.trees.get(tree.name)
         self.trees[tree.name] = tree
         logger.debug("scheduler.l10n", "updated tree " + tree.name)
         try:
-            # update caches of tree data
-            self.branches.clear()
-            self.l10nbranches.clear()
-            for _n, _t in self.trees.iteritems():
-                for _b, dirs in _t.branch2dirs.iteritems():
-                    self.branches[_b].addDirs(_n, dirs)
-                    self.l10nbranches[_t.branches['l10n']].addDirs(_n, dirs)
-                for _b, inis in _t.l10ninis.iteritems():
-                    for ini in inis:
-                        self.branches[_b].inis[ini].append(_n)
-                if _t.tld is not None:
-                    self.l10nbranches[_t.branches['l10n']].addDirs(_n, [_t.tld])
-                    self.branches[_t.branches['en']].topleveltrees.add(_n)
-                if _t.all_locales is not None:
-                    self.branches[_t.branches['en']].all_locales[_t.all_locales].add(_n)
+            # update caches of tree data, only for this tree
+            if old is not None:
+                self.retractTree(old)
+            self.contributeTree(tree)
+            # path routers get recompiled on their next use
+            for branchdata in self.branches.itervalues():
+                branchdata.invalidate()
+            for l10ndirs in self.l10nbranches.itervalues():
+                l10ndirs.invalidate()
         except Exception, e:
             log.msg(str(e))
         logger.debug("scheduler.l10n", "branch data cache updated")
+        self.snapshotLater()
+
+    def snapshotLater(self):
+        '''Save the snapshot once the running tree loads are done, or
+        in the next reactor turn if there aren't any.
+        '''
+        if self.snapshotFile is None:
+            return
+        self.snapshotDirty = True
+        if (self.dSaveSnapshot is None and self.treeLoadStart is None and
+            not self.loadingTrees):
+            self.dSaveSnapshot = reactor.callLater(0, self.saveSnapshot)
+
+    def saveSnapshot(self):
+        '''Write the tree data to snapshotFile, atomically.
+
+        The branch caches are derived from the trees, and get rebuilt
+        on restore.
+        '''
+        if self.dSaveSnapshot is not None:
+            if self.dSaveSnapshot.active():
+                self.dSaveSnapshot.cancel()
+            self.dSaveSnapshot = None
+        self.snapshotDirty = False
+        if self.snapshotFile is None:
+            return
+        tmp = self.snapshotFile + '.tmp'
+        try:
+            with open(tmp, 'w') as f:
+                json.dump({'trees': [t.toJSON()
+                                     for t in self.trees.itervalues()]},
+                          f)
+            os.rename(tmp, self.snapshotFile)
+        except (IOError, OSError):
+            log.err(None, 'failed to write %s' % self.snapshotFile)
+
+    def restoreSnapshot(self, sections):
+        '''Load the trees in sections from snapshotFile, and
+        rebuild the branch caches for them.
+
+        Returns the names of the restored trees.
+        '''
+        if self.snapshotFile is None or not os.path.exists(self.snapshotFile):
+            return set()
+        try:
+            with open(self.snapshotFile) as f:
+                trees = [Tree.fromJSON(data)
+                         for data in json.load(f)['trees']]
+        except (IOError, ValueError, KeyError, TypeError):
+            log.err(None, 'failed to read %s' % self.snapshotFile)
+            return set()
+        restored = set()
+        for tree in trees:
+            # trees removed from l10nbuilds.ini stay out
+            if tree.name not in sections:
+                continue
+            self.trees[tree.name] = tree
+            self.contributeTree(tree)
+            restored.add(tree.name)
+        log.msg('restored trees %s from %s' %
+                (', '.join(sorted(restored)), self.snapshotFile))
+        return restored
+
+    def contributeTree(self, _t):
+        '''Add the data of a tree to the branch data caches.'''
+        _n = _t.name
+        for _b, dirs in _t.branch2dirs.iteritems():
+            self.branches[_b].addDirs(_n, dirs)
+            self.l10nbranches[_t.branches['l10n']].addDirs(_n, dirs)
+        for _b, inis in _t.l10ninis.iteritems():
+            for ini in inis:
+                self.branches[_b].inis[ini].append(_n)
+        if _t.tld is not None:
+            self.l10nbranches[_t.branches['l10n']].addDirs(_n, [_t.tld])
+            self.branches[_t.branches['en']].topleveltrees.add(_n)
+        if _t.all_locales is not None:
+            self.branches[_t.branches['en']].all_locales[_t.all_locales].add(_n)
+
+    def retractTree(self, _t):
+        '''Remove the data of a tree from the branch data caches.
+
+        This is the reverse of contributeTree, and prunes entries that
+        become empty, so that "branch in self.branches" stays accurate.
+        '''
+        _n = _t.name
+        l10nbranch = _t.branches['l10n']
+        enbranch = _t.branches['en']
+        touched = set([enbranch])
+        for _b, dirs in _t.branch2dirs.iteritems():
+            touched.add(_b)
+            if _b in self.branches:
+                self.branches[_b].removeDirs(_n, dirs)
+            if l10nbranch in self.l10nbranches:
+                self.l10nbranches[l10nbranch].removeDirs(_n, dirs)
+        for _b, inis in _t.l10ninis.iteritems():
+            touched.add(_b)
+            if _b in self.branches:
+                self.branches[_b].removeInis(_n, inis)
+        if enbranch in self.branches:
+            branchdata = self.branches[enbranch]
+            if _t.tld is not None:
+                branchdata.topleveltrees.discard(_n)
+            if _t.all_locales is not None:
+                branchdata.removeAllLocales(_n, _t.all_locales)
+        if _t.tld is not None and l10nbranch in self.l10nbranches:
+            self.l10nbranches[l10nbranch].removeDirs(_n, [_t.tld])
+        for _b in touched:
+            if _b in self.branches and self.branches[_b].isEmpty():
+                del self.branches[_b]
+        if (l10nbranch in self.l10nbranches and
+            not self.l10nbranches[l10nbranch]):
+            del self.l10nbranches[l10nbranch]
 
     def startService(self):
         BaseUpstreamScheduler.startService(self)
         log.msg("starting l10n scheduler")
+        self.cooperator = task.Cooperator(
+            terminationPredicateFactory=self.workUnits)
+        self.openJournal()
         if self.inipath is None:
             # testing, don't trigger tree builds
             return
         # trigger tree builds for our trees, clear() first
         cp = ConfigParser()
         cp.read(self.inipath)
+        self.policy.configure(cp)
+        self.sections = self.readSections(cp)
         self.trees.clear()
+        self.branches.clear()
+        self.l10nbranches.clear()
+        restored = self.restoreSnapshot(cp.sections())
+        # the tree builds revalidate the restored trees, addTree applies
+        # the differences
+        self.treeLoadStart = time.time()
+        self.treeLoadFetches = fetch.fetcher.stats['fetched']
+        d = self.buildTrees(cp.sections())
+        d.addCallback(self.onTreesBuilt)
+        if restored.issuperset(cp.sections()):
+            # we know all our trees, don't hold back changes
+            log.msg('scheduling on restored trees, revalidating')
+            self.replayJournal()
+            return
+        self.waitOnTree = d
+
+    def getPage(self, url):
+        return fetch.fetcher.getPage(url)
+
+    def buildTrees(self, names, change=None):
+        '''Load the given trees, returns a Deferred firing when they're
+        all done.
+
+        With treeConcurrency, the trees are loaded in-process and passed
+        to addTree, and tree builds only run as a record if auditTrees
+        is set. Those have the audit property, and don't call back into
+        addTree. Otherwise, tree builds on the tree builder load them.
+        '''
         _ds = []
-        for tree in cp.sections():
+        if self.treeConcurrency:
+            cp = ConfigParser()
+            cp.read(self.inipath)
+            for tree in names:
+                loader = treeloader.TreeLoader(cp, tree, getPage=self.getPage)
+                d = self.treeSemaphore.run(loader.load)
+                d.addCallbacks(self.addTree, self.treeFailed,
+                               errbackArgs=(tree,))
+                _ds.append(d)
+            if not self.auditTrees:
+                return defer.DeferredList(_ds)
+        for tree in names:
             # create a BuildSet, submit it to the BuildMaster
             props = properties.Properties()
             props.update({
@@ -173,48 +836,236 @@ class AppScheduler(BaseUpstreamScheduler):
                     'l10nbuilds': self.inipath,
                     },
                          "Scheduler")
+            if self.treeConcurrency:
+                props.setProperty('audit', True, "Scheduler")
+            if change is None:
+                ss = SourceStamp()
+            else:
+                ss = SourceStamp(branch=change.branch, changes=[change])
             bs = buildset.BuildSet([self.treebuilder],
-                                   SourceStamp(),
+                                   ss,
                                    properties=props)
             self.submitBuildSet(bs)
-            _ds.append(bs.waitUntilFinished())
-        d = defer.DeferredList(_ds)
-        d.addCallback(self.onTreesBuilt)
-        self.waitOnTree = d
+            if not self.treeConcurrency:
+                _ds.append(bs.waitUntilFinished())
+        return defer.DeferredList(_ds)
+
+    def treeFailed(self, failure, tree):
+        log.msg('failed to load tree %s' % tree)
+        log.err(failure)
+
+    @staticmethod
+    def readSections(cp):
+        '''The options per section in l10nbuilds.ini that affect the
+        tree data. Priorities don't, they're just for our policy.
+        '''
+        return dict((section,
+                     dict((k, v) for k, v in cp.items(section)
+                          if not k.startswith('priority')))
+                    for section in cp.sections())
+
+    def reloadIni(self):
+        '''Re-read l10nbuilds.ini and apply the differences.
 
-    def onTreesBuilt(self, res, branchdata=None, change=None):
-        '''Callback used when all tree-builder buildsets are done.
+        Only new or changed sections get tree builds, removed sections
+        drop their trees and pending comparisons. Changes for changed
+        trees wait for their tree builds.
+        Returns a Deferred firing when the tree builds are done.
+        '''
+        cp = ConfigParser()
+        cp.read(self.inipath)
+        self.policy.configure(cp)
+        sections = self.readSections(cp)
+        removed = set(self.sections) - set(sections)
+        changed = set(_n for _n, options in sections.iteritems()
+                      if self.sections.get(_n) != options)
+        self.sections = sections
+        log.msg('reloaded %s, building trees %s, dropping %s' %
+                (self.inipath, ', '.join(sorted(changed)) or 'none',
+                 ', '.join(sorted(removed)) or 'none'))
+        for _n in removed:
+            self.dropTree(_n)
+        for _n in changed:
+            self.loadingTrees[_n] += 1
+        d = self.buildTrees(sorted(changed))
+        d.addCallback(self.onTreesBuilt, trees=changed)
+        return d
+
+    def dropTree(self, name):
+        '''Forget about a tree and its pending comparisons.'''
+        tree = self.trees.pop(name, None)
+        if tree is not None:
+            self.retractTree(tree)
+            for branchdata in self.branches.itervalues():
+                branchdata.invalidate()
+            for l10ndirs in self.l10nbranches.itervalues():
+                l10ndirs.invalidate()
+        self.treesToDo.discard(name)
+        keys = set(key for key in self.pendings if key[0] == name)
+        keys.update(key for key in self.ready if key[0] == name)
+        for key in keys:
+            self.pendings.pop(key, None)
+            self.ready.discard(key)
+            if key in self.debounce:
+                timer, first = self.debounce.pop(key)
+                if timer.active():
+                    timer.cancel()
+        if self.journal is not None:
+            self.journal.removePending(keys)
+        self.snapshotLater()
+
+    def onTreesBuilt(self, res, branchdata=None, change=None, trees=None):
+        '''Callback used when tree-builder buildsets are done.
         If change is None, this is called from startService, otherwise
-        it's called as a follow up from a change-based build. If so,
-        call into checkEnUS.
-        After that, process all pending changes, as long as we're not
-        doing more tree builds again.
+        it's called as a follow up from a change-based build of trees.
+        If so, call into checkEnUS.
+        After that, process the pending changes that don't wait for
+        trees anymore.
         '''
         # res is either None or list of tuple build sets
         logger.debug('scheduler.l10n',
                      'pending trees got built' + (change is not None and ", change given" or ""))
-        # trees for the last change are built, wait no longer
-        self.waitOnTree = None
+        if trees is None:
+            # initial tree builds are done, wait no longer
+            self.waitOnTree = None
+            if self.treeLoadStart is not None:
+                self.treeLoadTime = time.time() - self.treeLoadStart
+                self.treeLoadStart = None
+                log.msg('loaded %d trees in %.1f seconds, fetched %d files' %
+                        (len(self.trees), self.treeLoadTime,
+                         fetch.fetcher.stats['fetched'] -
+                         self.treeLoadFetches))
+            self.replayJournal()
+        else:
+            for _n in trees:
+                self.loadingTrees[_n] -= 1
+                if self.loadingTrees[_n] <= 0:
+                    del self.loadingTrees[_n]
+        if self.snapshotDirty:
+            # once per round of tree loads
+            self.saveSnapshot()
+        if change is None:
+            # revalidated and reloaded trees don't wait for an en-US change
+            self.fanOutTrees(self.trees.keys() if trees is None else trees)
+        d = None
         if change is not None and branchdata is not None:
-            self.checkEnUS(res, branchdata, change)
-        while self.waitOnTree is None and self.pendingChanges:
-            c = self.pendingChanges.pop(0)
-            self.addChange(c)
+            # the tree builds might have replaced the branch data
+            branchdata = self.branches.get(change.branch, branchdata)
+            d = self.checkEnUS(res, branchdata, change, trees=trees)
+        self.processPendingChanges()
+        return d
+
+    def changeTrees(self, change):
+        '''Return the names of the trees a change routes to.'''
+        trees = set()
+        if not change.locale:
+            if change.branch not in self.branches:
+                return trees
+            branchdata = self.branches[change.branch]
+            for f in change.files:
+                if f in branchdata.inis:
+                    trees.update(branchdata.inis[f])
+                routes, toplevel = branchdata.route(f)
+                for _trees in routes.itervalues():
+                    trees.update(_trees)
+                if toplevel:
+                    trees.update(branchdata.topleveltrees)
+            return trees
+        if change.branch not in self.l10nbranches:
+            return trees
+        l10ndirs = self.l10nbranches[change.branch]
+        for f in change.files:
+            trees |= l10ndirs.route(f)
+        return trees
+
+    def isWaiting(self, change):
+        '''Whether a change needs to wait for trees to be loaded.'''
+        if self.waitOnTree is not None:
+            # initial tree builds, we don't know our trees yet
+            return True
+        if not self.loadingTrees:
+            return False
+        return bool(self.changeTrees(change) & set(self.loadingTrees))
+
+    def processPendingChanges(self):
+        '''Handle the pending changes that aren't waiting anymore,
+        keep the others in order.
+        '''
+        for i in xrange(len(self.pendingChanges)):
+            change, queued = self.pendingChanges.popleft()
+            if self.isWaiting(change):
+                self.pendingChanges.append((change, queued))
+                continue
+            waited = time.time() - queued
+            self.pendingStats['waited'] += waited
+            self.pendingStats['maxWait'] = max(self.pendingStats['maxWait'],
+                                               waited)
+            self.releaseChange(change)
+
+    def releaseChange(self, change):
+        '''Handle a change that waited for trees.
+
+        It stays in the journal until the comparisons for it are
+        journalled, or submitted as tree builds.
+        '''
+        d = defer.maybeDeferred(self.handleChange, change)
+        def release(_):
+            if self.journal is not None:
+                self.journal.removeGated(change.number)
+        d.addCallback(release)
+        d.addErrback(log.err, 'failed to handle change %s' % change.number)
+        return d
+
+    def getPendingStats(self):
+        '''Metrics about changes waiting for tree builds.'''
+        stats = dict(self.pendingStats)
+        stats['depth'] = len(self.pendingChanges)
+        if self.pendingChanges:
+            stats['oldest'] = time.time() - self.pendingChanges[0][1]
+        else:
+            stats['oldest'] = 0
+        return stats
 
     def addChange(self, change):
         '''Main entry point for the scheduler, this is called by the 
         buildmaster.
         '''
-        if self.waitOnTree is not None:
-            # a tree build is currently running, wait with this
-            # until we're done with it
-            self.pendingChanges.append(change)
+        self.fixupLocale(change)
+        if self.gateChange(change):
             return
-        # fixup change.locale if property is given
+        self.handleChange(change)
+
+    @staticmethod
+    def fixupLocale(change):
+        '''Set change.locale from the properties, if given.'''
         if not hasattr(change, 'locale') or not change.locale:
             if 'locale' in change.properties:
                 change.locale = change.properties['locale']
-        if not hasattr(change, 'locale') or not change.locale:
+            else:
+                change.locale = None
+
+    def gateChange(self, change):
+        '''Queue the change if it needs to wait for trees, returns
+        whether it does.
+        '''
+        if not self.isWaiting(change):
+            return False
+        # trees for this change are being loaded, wait with this
+        # until we're done with them
+        queued = time.time()
+        self.pendingChanges.append((change, queued))
+        if self.journal is not None:
+            self.journal.addGated(change.number, queued)
+        self.pendingStats['queued'] += 1
+        self.pendingStats['maxDepth'] = max(self.pendingStats['maxDepth'],
+                                            len(self.pendingChanges))
+        return True
+
+    def handleChange(self, change):
+        '''Schedule the comparisons for a change. Returns a Deferred if
+        some of that happens later, in tree builds or a fan-out.
+        '''
+        if not change.locale:
             # check branch, l10n.inis
             # if l10n.inis are found, callback to all-locales, locales/en-US
             # otherwise just check those straight away
@@ -229,134 +1080,225 @@ class AppScheduler(BaseUpstreamScheduler):
             if tree_triggers:
                 # trigger tree builds, wait for them to finish
                 # and check the change for en-US builds
-                _ds = []
                 for _n in tree_triggers:
-                    _t = self.trees[_n]
-                    props = properties.Properties()
-                    props.update({
-                            'tree': _n,
-                            'l10nbuilds': self.inipath,
-                            },
-                                 "Scheduler")
-                    bs = buildset.BuildSet([self.treebuilder],
-                                           SourceStamp(branch=change.branch,
-                                                       changes=[change]),
-                                           properties=props)
-                    self.submitBuildSet(bs)
-                    _ds.append(bs.waitUntilFinished())
-                d = defer.DeferredList(_ds)
+                    self.loadingTrees[_n] += 1
+                d = self.buildTrees(tree_triggers, change=change)
                 d.addCallback(self.onTreesBuilt,
-                              branchdata = branchdata, change = change)
-                self.waitOnTree = d
-                return
-            self.checkEnUS(None, branchdata, change)
-            return
+                              branchdata = branchdata, change = change,
+                              trees = tree_triggers)
+                return d
+            return self.checkEnUS(None, branchdata, change)
         # check l10n changesets
         if change.branch not in self.l10nbranches:
             return
         l10ndirs = self.l10nbranches[change.branch]
         trees = set()
         for f in change.files:
-            for mod, _trees in l10ndirs.iteritems():
-                if f.startswith(mod):
-                    trees |= _trees
+            trees |= l10ndirs.route(f)
         for _n in trees:
             if change.locale in self.trees[_n].locales:
                 self.compareBuild(_n, change.locale, [change])
         return
 
-    def checkEnUS(self, result, branchdata, change):
+    def checkEnUS(self, result, branchdata, change, trees=None):
         """Factored part of change handling that's either called
         from onChange, or from onTreesBuilt.
+        trees are the trees that got loaded for this change, if any.
         """
         # ignore result, either None or list of build sets
         logger.debug('scheduler.l10n',
                      'checking en-US for change %d' % change.number)
         all_locales = set()
-        # pick up trees from onTreesBuilt
-        en_US = set(self.treesToDo)
-        self.treesToDo.clear()
+        # pick up the trees this change loaded from onTreesBuilt,
+        # changed trees loaded for other changes are theirs
+        en_US = self.treesToDo & set(trees or ())
+        self.treesToDo -= en_US
         for f in change.files:
-            if f in branchdata.all_locales:
-                all_locales.update(branchdata.all_locales[f])
-            if 'locales/en-US' in f:
-                mod = f.split('locales/en-US', 1)[0]
-                if mod:
-                    mod = mod.rstrip('/') # common case for non-single
-                if not mod:
-                    # single-module-hg, aka mobile
-                    for _n in branchdata.topleveltrees:
-                        for l in self.trees[_n].locales:
-                            self.compareBuild(_n, l, [change])
-                else:
-                    if mod in branchdata.dirs:
-                        en_US.update(branchdata.dirs[mod])
-        # load all-locales files
+            routes, toplevel = branchdata.route(f)
+            all_locales.update(routes['all_locales'])
+            if toplevel:
+                # single-module-hg, aka mobile
+                en_US.update(branchdata.topleveltrees)
+            en_US.update(routes['en-US'])
+        # load all-locales files, trees sharing one load it once
         rev = 'default'
+        if change.revision is not None:
+            rev = change.revision
         for _n in all_locales:
-            if change.revision is not None:
-                rev = change.revision
             _t = self.trees[_n]
-            url = _t.repo + '/' + _t.branches['en'] + '/raw-file/' + rev
-            url += '/' + _t.all_locales
-            d = getPage(url)
+            d = self.allLocales.get(_t.repo, _t.branches['en'],
+                                    _t.all_locales, rev)
             d.addCallback(self.onAllLocales, _n, change)
+            d.addErrback(log.err, 'failed to load all-locales for %s' % _n)
         # trigger all locales for all trees
-        for _n in en_US:
-            _t = self.trees[_n]
-            for l in _t.locales:
-                self.compareBuild(_n, l, [change])
+        return self.fanOut(((_n, l) for _n in en_US
+                            for l in self.trees[_n].locales),
+                           change)
+
+    def fanOutTrees(self, names):
+        '''Compare all locales of the trees in names that changed when
+        they got loaded again.
+        '''
+        en_US = self.treesToDo & set(names)
+        self.treesToDo -= en_US
+        if not en_US:
+            return
+        log.msg('trees %s changed, comparing all locales' %
+                ', '.join(sorted(en_US)))
+        self.fanOut(((_n, l) for _n in en_US for l in self.trees[_n].locales),
+                    None)
 
-    def onAllLocales(self, page, tree, change = None):
-        newlocs = util.parseLocales(page)
+    def fanOut(self, pairs, change):
+        '''Trigger compareBuild for each (tree, locale) in pairs.
+
+        The first workBudget builds are triggered right away, the rest
+        is done as a cooperative task, workBudget at a time per reactor
+        iteration. Ready comparisons are held back until all fan-outs
+        are done, so that the policy orders them all together.
+        change can be None, for trees that changed without one.
+        '''
+        changes = [change] if change is not None else []
+        pairs = iter(pairs)
+        self.fanOuts += 1
+        for tree, locale in itertools.islice(pairs, self.workBudget):
+            self.compareBuild(tree, locale, changes)
+        try:
+            pairs = itertools.chain([pairs.next()], pairs)
+        except StopIteration:
+            # all done already
+            self.fanOutDone(None)
+            return defer.succeed(None)
+        def work():
+            for tree, locale in pairs:
+                self.compareBuild(tree, locale, changes)
+                yield None
+        d = self.cooperator.coiterate(work())
+        return d.addBoth(self.fanOutDone)
+
+    def fanOutDone(self, result):
+        '''Submit the comparisons that waited for a fan-out.'''
+        self.fanOuts -= 1
+        if self.cooperator is None:
+            # stopping, stopService submits what's ready
+            return result
+        if not self.fanOuts and self.ready and self.dSubmitBuildsets is None:
+            self.dSubmitBuildsets = reactor.callLater(0, self.submitBuildsets)
+        return result
+
+    def onAllLocales(self, newlocs, tree, change = None):
+        if newlocs == self.trees[tree].locales:
+            # nothing changed
+            return
         added = set(newlocs) - set(self.trees[tree].locales)
         logger.debug('scheduler.l10n.all-locales',
                      "had %s; got %s; new are %s" % 
                      (', '.join(self.trees[tree].locales),
                       ', '.join(list(newlocs)),
                       ', '.join(list(added))))
-        self.trees[tree].locales = newlocs
+        self.trees[tree].locales = newlocs[:]
+        self.snapshotLater()
         for loc in added:
             self.compareBuild(tree, loc, [change])
 
     def compareBuild(self, tree, locale, changes):
-        cs = self.pendings[(tree, locale)]
+        key = (tree, locale)
+        if key in self.pendings:
+            # one comparison less
+            self.coalesceStats['merged'] += 1
+        cs = self.pendings[key]
         if changes is not None:
             cs += changes
-        if self.dSubmitBuildsets is None:
+            if self.journal is not None:
+                self.journal.addPending(tree, locale,
+                                        [c.number for c in changes])
+        if not self.coalesceWindow or key in self.ready:
+            self.readyBuild(key)
+            return
+        now = time.time()
+        if key not in self.debounce:
+            timer = reactor.callLater(self.coalesceWindow,
+                                      self.readyBuild, key)
+            self.debounce[key] = (timer, now)
+            return
+        # wait another coalesceWindow, but not beyond maxDelay
+        timer, first = self.debounce[key]
+        delay = min(self.coalesceWindow, first + self.maxDelay - now)
+        if delay < self.coalesceWindow:
+            self.coalesceStats['maxDelayed'] += 1
+        timer.reset(max(delay, 0))
+
+    def readyBuild(self, key):
+        '''Mark a tree/locale as ready to be submitted.'''
+        if key in self.debounce:
+            timer, first = self.debounce.pop(key)
+            if timer.active():
+                timer.cancel()
+        self.ready.add(key)
+        if self.cooperator is None:
+            # stopped, don't schedule anything anymore
+            return
+        if self.dSubmitBuildsets is None and not self.fanOuts:
             self.dSubmitBuildsets = reactor.callLater(0, self.submitBuildsets)
 
     def submitBuildsets(self):
-        for tpl, changes in self.pendings.iteritems():
+        self.dSubmitBuildsets = None
+        if self.fanOuts:
+            # fanOutDone submits
+            return defer.succeed(None)
+        jobs, resolved = self.takeReady()
+        return self.cooperator.coiterate(self.iterBuildsets(jobs, resolved))
+
+    def takeReady(self):
+        '''Take the ready builds in policy order, and resolve their
+        revisions.
+
+        Returns the jobs and the resolved revisions for iterBuildsets.
+        '''
+        # collect the repositories and cutoff times of all pending
+        # builds first, and resolve their revisions in one go
+        jobs = []
+        lookups = set()
+        for tpl in self.policy.order(self.ready):
+            changes = self.pendings.pop(tpl)
             tree, locale = tpl
             _t = self.trees[tree]
-            props = properties.Properties()
             # figure out the latest change
             try:
                 when = timeHelper(max(filter(None, (c.when for c in changes))))
-                from life.models import Push
-            except (ValueError, ImportError):
+            except ValueError:
                 when = None
+            repos = {}
             for k, v in _t.branches.iteritems():
-                props.setProperty(k+"_branch", v, "Scheduler")
-                _r = "default"
+                if k == 'l10n':
+                    repos[k] = '%s/%s' % (v, locale)
+                else:
+                    repos[k] = v
                 if when is not None:
-                    if k == 'l10n':
-                        repo = '%s/%s' % (v, locale)
-                    else:
-                        repo = v
-                    q = Push.objects.filter(repository__name=repo,
-                                            push_date__lte=when,
-                                            changesets__branch__name='default')
-                    try:
-                        # get the latest changeset on the 'default' branch
-                        #  not strictly .tip, for pushes with heads on
-                        #  multiple branches (bug 602182)
-                        _c = q.order_by('-pk')[0].changesets.order_by('-pk')
-                        _r = str(_c.filter(branch__name='default')[0].shortrev)
-                    except IndexError:
-                        # no pushes, update to empty repo 000000000000
-                        _r = "default"
+                    lookups.add((repos[k], when))
+            jobs.append((tree, locale, changes, when, repos))
+        self.ready.clear()
+        self.coalesceStats['submitted'] += len(jobs)
+        resolved = {}
+        if lookups:
+            resolved = revisions.resolveRevisions(lookups)
+        return jobs, resolved
+
+    def iterBuildsets(self, jobs, resolved):
+        '''Generator submitting one BuildSet per step.'''
+        for tree, locale, changes, when, repos in jobs:
+            if tree not in self.trees:
+                # dropped since submitBuildsets
+                if self.journal is not None:
+                    self.journal.removeChanges(tree, locale,
+                                               [c.number for c in changes])
+                continue
+            _t = self.trees[tree]
+            changes = self.unclaimed.supersede((tree, locale), changes)
+            props = properties.Properties()
+            for k, v in _t.branches.iteritems():
+                props.setProperty(k+"_branch", v, "Scheduler")
+                # no pushes, update to empty repo 000000000000
+                _r = resolved.get((repos[k], when), "default")
                 props.setProperty(k+"_revision", _r, "Scheduler")
             props.update({"tree": tree,
                           "locale": locale,
@@ -368,8 +1310,22 @@ class AppScheduler(BaseUpstreamScheduler):
                                    SourceStamp(changes=changes),
                                    properties=props)
             self.submitBuildSet(bs)
-        self.dSubmitBuildsets = None
-        self.pendings.clear()
+            if self.journal is not None:
+                # submitted, don't replay
+                self.journal.removeChanges(tree, locale,
+                                           [c.number for c in changes])
+            self.unclaimed.track((tree, locale), bs)
+            self.watchBuildSet((tree, locale), bs)
+            yield None
+
+    def watchBuildSet(self, key, bs):
+        '''Tell the policy when the comparison for key is done.'''
+        def finished(status):
+            if status.getResults() == SKIPPED:
+                # superseded, the new BuildSet compares
+                return
+            self.policy.built(key, time.time())
+        bs.waitUntilFinished().addCallback(finished)
         
 
 class DirScheduler(BaseUpstreamScheduler):
@@ -378,10 +1334,10 @@ class DirScheduler(BaseUpstreamScheduler):
     """
   
     compare_attrs = ('name', 'builderNames', 'branch', 'tree', 'locales',
-                     'properties')
+                     'properties', 'indexTTL')
   
     def __init__(self, name, tree, branch, builderNames, repourl,
-                 locales=None, enBranch=None):
+                 locales=None, enBranch=None, indexTTL=5*60):
         BaseUpstreamScheduler.__init__(self, name)
         self.tree = tree
         self.branch = branch
@@ -389,12 +1345,41 @@ class DirScheduler(BaseUpstreamScheduler):
         self.builderNames = builderNames
         self.repourl = repourl
         self.locales = locales
+        self.unclaimed = UnclaimedBuildSets(self)
+        # locales from the repository index, and when we got them
+        self.indexTTL = indexTTL
+        self.indexLocales = None
+        self.indexLoaded = None
+        # Deferreds waiting for the index fetch in flight
+        self.indexWaiters = None
+        self.indexStats = {'fetches': 0, 'hits': 0, 'waits': 0}
+        # locale -> changes, submitted together in the next reactor turn
+        self.pendings = {}
+        self.dSubmitBuildsets = None
+
+    def stopService(self):
+        if self.dSubmitBuildsets is not None:
+            # don't lose queued builds on reconfig
+            self.dSubmitBuildsets.cancel()
+            self.submitBuildsets()
+        return BaseUpstreamScheduler.stopService(self)
 
     def getPage(self, url):
-        return getPage(url)
+        return fetch.fetcher.getPage(url)
 
     # Internal helper
     def queueBuild(self, locale, change):
+        self.pendings.setdefault(locale, []).append(change)
+        if self.dSubmitBuildsets is None:
+            self.dSubmitBuildsets = reactor.callLater(0, self.submitBuildsets)
+
+    def submitBuildsets(self):
+        self.dSubmitBuildsets = None
+        pendings, self.pendings = self.pendings, {}
+        for locale in sorted(pendings):
+            self.submitBuildset(locale, pendings[locale])
+
+    def submitBuildset(self, locale, changes):
         props = properties.Properties()
         props.update({'locale': locale,
                       'tree': self.tree,
@@ -408,23 +1393,60 @@ class DirScheduler(BaseUpstreamScheduler):
                       'l10n_branch': self.branch,
                       },
                      'Scheduler')
-        ss = SourceStamp(changes=[change])
+        ss = SourceStamp(changes=self.unclaimed.supersede(locale, changes))
         bs = buildset.BuildSet(self.builderNames, ss,
                                reason = "%s %s" % (self.tree, locale),
                                properties = props)
         self.submitBuildSet(bs)
+        self.unclaimed.track(locale, bs)
 
+    def getLocales(self):
+        """Get the locales in the repository index.
+
+        The index is cached for indexTTL seconds, and concurrent requests
+        share a single fetch.
+        """
+        if (self.indexLocales is not None and
+            time.time() - self.indexLoaded < self.indexTTL):
+            self.indexStats['hits'] += 1
+            return defer.succeed(self.indexLocales)
+        d = defer.Deferred()
+        if self.indexWaiters is not None:
+            self.indexStats['waits'] += 1
+            self.indexWaiters.append(d)
+            return d
+        self.indexWaiters = [d]
+        self.indexStats['fetches'] += 1
+        dIndex = self.getPage(str(self.repourl + self.branch + '?style=raw'))
+        dIndex.addCallback(self.onRepoIndex)
+        dIndex.addBoth(self.indexDone)
+        return d
 
-    def onRepoIndex(self, indexText, change):
+    def onRepoIndex(self, indexText):
         """Callback used when loading the index of the repository list
         to get the list of locales to trigger.
         """
         locales = map(lambda s: s.rsplit('/',2)[1], indexText.strip().split())
+        self.indexLocales = [loc for loc in locales if loc != "en-US"]
+        self.indexLoaded = time.time()
+        return self.indexLocales
+
+    def indexDone(self, result):
+        waiters, self.indexWaiters = self.indexWaiters, None
+        for d in waiters:
+            if isinstance(result, failure.Failure):
+                d.errback(result)
+            else:
+                d.callback(result)
+
+    def queueBuilds(self, locales, change):
         for loc in locales:
-            if loc == "en-US":
-                continue
             self.queueBuild(loc, change)
 
+    def failedRepo(self, fail):
+        log.msg("failed to load the repository index for %s" % self.branch)
+        log.err(fail)
+
 
     # Implement IScheduler
     def addChange(self, change):
@@ -443,13 +1465,12 @@ class DirScheduler(BaseUpstreamScheduler):
             if self.locales:
                 # we don't need to trigger a directory index,
                 # we know our locales
-                for loc in self.locales:
-                    self.queueBuild(loc, change)
+                self.queueBuilds(self.locales, change)
             else:
                 # trigger all builds, load repo index
-                d = self.getPage(str(self.repourl + self.branch + '?style=raw'))
-                d.addCallback(self.onRepoIndex, change)
-                #d.addErrback(self.failedRepo)
+                d = self.getLocales()
+                d.addCallback(self.queueBuilds, change)
+                d.addErrback(self.failedRepo)
             return
         if change.branch != self.branch:
             return
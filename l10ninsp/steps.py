@@ -6,7 +6,6 @@ import warnings
 
 from twisted.python import log
 from twisted.internet import reactor
-from twisted.web.client import getPage
 from buildbot.process.buildstep import BuildStep, LoggingBuildStep, LoggedRemoteCommand
 from buildbot.status.builder import SUCCESS, WARNINGS, FAILURE, SKIPPED, \
     Results
@@ -18,15 +17,11 @@ try:
     import json
 except:
     import simplejson as json
-from ConfigParser import ConfigParser, NoSectionError, NoOptionError
-from cStringIO import StringIO
+from ConfigParser import ConfigParser
 
 from bb2mbdb.utils import timeHelper
 
-import logger, util
-import elasticsearch
-
-from django.conf import settings
+import dimensions, esindex, logger, revisions, treeloader
 
 class ResultRemoteCommand(LoggedRemoteCommand):
     """
@@ -42,55 +37,50 @@ class ResultRemoteCommand(LoggedRemoteCommand):
             return
         from l10nstats.models import Run, Build
         from life.models import Tree, Forest, Locale
-        loc, isnew = Locale.objects.get_or_create(code=self.args['locale'])
-        forest, isnew = Forest.objects.get_or_create(name=self.step.build.getProperty('l10n_branch'))
+        from mbdb.models import Builder
+        # locales, forests, trees and builders hardly change, cache them
+        dims = dimensions.cache
+        loc, isnew = dims.get_or_create(Locale, code=self.args['locale'])
+        forest, isnew = dims.get_or_create(Forest, name=self.step.build.getProperty('l10n_branch'))
         if isnew:
             log.msg(("WARNING: Forest %s created in status, not expected " +
                      "outside of tests") % forest.name)
-        tree, isnew = Tree.objects.get_or_create(code=self.args['tree'],
-                                                 l10n=forest)
+        tree, isnew = dims.get_or_create(Tree, code=self.args['tree'],
+                                         l10n=forest)
         buildername = self.step.build.getProperty('buildername')
         buildnumber = self.step.build.getProperty('buildnumber')
         try:
-            build = Build.objects.get(builder__master__name = self.step.master,
-                                      builder__name = buildername,
+            builder = dims.get(Builder, master__name = self.step.master,
+                               name = buildername)
+            build = Build.objects.get(builder = builder,
                                       buildnumber = buildnumber)
-        except Build.DoesNotExist:
+        except (Builder.DoesNotExist, Build.DoesNotExist):
             build = None
         self.dbrun = Run.objects.create(locale = loc,
                                         tree = tree,
                                         build = build)
         self.dbrun.activate()
-        from life.models import Changeset, Push
         revs = self.step.build.getProperty('revisions')
-        srctime = None
+        lookups = []
         for rev in revs:
             branch = self.step.build.getProperty('%s_branch' % rev)
             if rev == 'l10n':
                 # l10n repo, append locale to branch
                 branch += '/' + loc.code
             ident = self.step.build.getProperty('%s_revision' % rev)
-            cs = None
-            try:
-                cs = Changeset.objects.get(revision__startswith=ident[:12])
-                self.dbrun.revisions.add(cs)
-            except (Changeset.DoesNotExist, Changeset.MultipleObjectsReturned):
-                log.msg("no changeset found for %s=%s" % (rev, ident))
-                pass
-            if cs is not None and cs.id is not 1:
-                try:
-                    _st = Push.objects.filter(repository__name=branch,
-                                              changesets=cs).order_by('push_date')[0].push_date
-                    if srctime is None:
-                        srctime = _st
-                    else:
-                        srctime = max(srctime, _st)
-                except (Push.DoesNotExist, IndexError):
-                    log.msg("no srctime found for %s=%s" % (rev, ident))
-                    pass
+            lookups.append((branch, ident[:12]))
+        # resolve all revisions and their push dates in one go
+        ids, srctime = revisions.resolveRun(lookups)
+        for rev, (branch, short) in zip(revs, lookups):
+            if short not in ids:
+                log.msg("no changeset found for %s=%s" % (rev, short))
+        if ids:
+            self.dbrun.revisions.add(*set(ids.values()))
         if srctime is not None:
             self.dbrun.srctime = srctime
             self.dbrun.save()
+        else:
+            log.msg("no srctime found for %s" % self.dbrun)
 
     def remoteUpdate(self, update):
         log.msg("remoteUpdate called with keys: " + ", ".join(update.keys()))
@@ -136,16 +126,15 @@ class ResultRemoteCommand(LoggedRemoteCommand):
                            if k in summary])
         self.logs['stdio'].addEntry(5, json.dumps(result, indent=2))
         self.addSummary(summary)
-        es = elasticsearch.Elasticsearch(hosts=settings.ES_COMPARE_HOST)
         # create our ES document to index in ES
         # details from result, and self.dbrun was created in addSummary above
         body = {
             'run': self.dbrun.id,
             'details': result['details']
         }
-        rv = es.index(index=settings.ES_COMPARE_INDEX, body=body,
-                      doc_type='comparison', id=self.dbrun.id)
-        log.msg('es.index: ' + json.dumps(rv))
+        # indexed in the background, in bulk
+        if esindex.getIndexer().add(self.dbrun.id, body):
+            log.msg('es.index: queued run %d' % self.dbrun.id)
 
     def addStats(self, stats):
         self.ensureDBRun()
@@ -342,24 +331,24 @@ class GetRevisions(BuildStep):
         changes = self.build.allChanges()
         if not changes:
             return SKIPPED
-        from life.models import Push
         when = timeHelper(max(map(lambda c: c.when, changes)))
         loog = self.addLog("stdio")
         loog.addStdout("Timestamps for %s:\n\n" % when)
         revs = self.build.getProperty('revisions')[:]
+        branches = {}
         for rev in revs:
             branch = self.build.getProperty('%s_branch' % rev)
             if rev == 'l10n':
                 # l10n repo, append locale to branch
                 branch += '/' + self.build.getProperty('locale')
-            try:
-                q = Push.objects.filter(repository__name=branch,
-                                        push_date__lte=when,
-                                        changesets__branch__name=self.hg_branch)
-                to_set = str(q.order_by('-pk')[0].tip.shortrev)
-            except IndexError:
-                # no pushes, update to the requested hg branch
-                to_set = self.hg_branch
+            branches[rev] = branch
+        resolved = revisions.resolveRevisions(
+            set((branch, when) for branch in branches.itervalues()),
+            hg_branch=self.hg_branch)
+        for rev in revs:
+            branch = branches[rev]
+            # no pushes, update to the requested hg branch
+            to_set = resolved.get((branch, when), self.hg_branch)
             self.build.setProperty('%s_revision' % rev, to_set, 'Build')
             loog.addStdout("%s: %s\n" % (branch, to_set))
         reactor.callLater(0, self.finished, SUCCESS)
@@ -380,7 +369,8 @@ class TreeLoader(BuildStep):
         '''Create a TreeLoader step. In addition to the standard arguments,
         treename is the name of the tree,
         l10nbuilds is the local ini file describing the builds,
-        cb is a callback with signature (tree, changes=None)
+        cb is a callback with signature (tree, changes=None),
+        not called for builds with the audit property
         '''
         BuildStep.__init__(self, **kwargs)
         self.addFactoryArguments(treename = treename,
@@ -391,149 +381,33 @@ class TreeLoader(BuildStep):
         self.cb = cb
 
     def start(self):
-        from scheduler import Tree
         loog = self.addLog('stdio')
-        self.pending = 0
         properties = self.build.getProperties()
         self.rendered_tree = tree = properties.render(self.treename)
         l10nbuilds = properties.render(self.l10nbuilds)
         cp = ConfigParser()
         cp.read(l10nbuilds)
-        repo = cp.get(tree, 'repo')
-        branch = cp.get(tree, 'mozilla')
-        path = cp.get(tree, 'l10n.ini')
-        l10nbranch = cp.get(tree, 'l10n')
-        locales = cp.get(tree, 'locales')
-        if locales == 'all':
-            alllocales = "yes"
-        else:
-            alllocales = "no"
-            properties.update({'locales': filter(None, locales.split())},
-                              "Build")
-        self.tree = Tree(self.rendered_tree, repo, branch, l10nbranch, path)
-        loog.addStdout('Loading l10n.inis for %s\n' % self.rendered_tree)
-        logger.debug('scheduler.l10n.tree',
-                     'Loading l10n.inis for %s, alllocales: %s' %
-                     (self.rendered_tree, alllocales))
-        self.loadIni(repo, branch, path, alllocales)
-
-    def loadIni(self, repo, branch, path, alllocales="no"):
-        url = repo + '/' + branch + '/raw-file/default/' + path
-        self.getLog('stdio').addStdout('\nloading %s\n' % url)
         self.step_status.setText(['loading', 'l10n.ini'])
-        self.step_status.setText2([repo, branch, path])
-        self.pending += 1
-        d = getPage(url)
-        d.addCallbacks(self.onL10niniLoad, self.onL10niniFail,
-                       callbackArgs=[repo, branch, path, alllocales])
-
-    def onL10niniLoad(self, inicontent, repo, branch, path, alllocales):
-        self.pending -= 1
-        logger.debug('scheduler.l10n.tree',
-                     'Loaded %s, alllocales: %s' % (path,alllocales))
-        self.step_status.setText(['loaded', 'l10n.ini'])
-        loog = self.getLog('stdio')
-        cp = ConfigParser()
-        cp.readfp(StringIO(inicontent), path)
-        try:
-            dirs = cp.get('compare', 'dirs').split()
-        except (NoOptionError, NoSectionError):
-            dirs = []
-        try:
-            dirs += cp.get('extras', 'dirs').split()
-        except (NoOptionError, NoSectionError):
-            pass
-        try:
-            tld = cp.get('compare', 'tld')
-            # remove tld from comparison dirs
-            if tld in dirs:
-                dirs.remove(tld)
-        except (NoOptionError, NoSectionError):
-            tld = None
-
-        if dirs:
-            loog.addStdout("adding %s on branch %s for %s\n" % 
-                           (", ".join(dirs), branch, self.rendered_tree))
-        if tld is not None:
-            loog.addStdout("adding a tld compare for %s on %s\n" % (tld, branch))
-
-        self.tree.addData(branch, path, dirs, tld)
-
-        try:
-            for title, _path in cp.items('includes'):
-                try:
-                    # check if the load details are overloaded
-                    details = dict(cp.items('include_%s' % title))
-                    if details['type'] != 'hg':
-                        continue
-                    loog.addStdout("need to load %s from %s on %s, %s\n" %
-                                   (title, details['l10n.ini'], details['repo'],
-                                    details['mozilla']))
-                    # check if we got the en-US branch already, if not
-                    # we're likely loading toolkit off a different repo
-                    enbranch = details['mozilla']
-                    if enbranch not in self.tree.branches.values():
-                        self.tree.branches[title] = enbranch
-                    self.loadIni(details['repo'], details['mozilla'],
-                                 details['l10n.ini'])
-                except NoSectionError:
-                    loog.addStdout("need to load %s from %s\n" % (title, _path))
-                    self.loadIni(repo, branch, _path)
-        except NoSectionError:
-            pass
-        try:
-            if alllocales == 'yes':
-                allpath = cp.get('general','all')
-                self.tree.all_locales = allpath
-                logger.debug('scheduler.l10n.tree',
-                             'loading all-locales for %s from %s' % 
-                             (self.tree.name, allpath))
-                self.pending += 1
-                d = getPage(repo + '/' + branch + '/raw-file/default/' + allpath)
-                d.addCallbacks(self.allLocalesLoaded,
-                               self.allLocalesFailed)
-        except NoSectionError:
-            pass
-        self.endLoad()
-
-    def onL10niniFail(self, failure):
-        self.pending -= 1
-        loog = self.getLog('stdio')
-        loog.addStderr(failure.getErrorMessage())
-        if self.pending <= 0:
-            self.step_status.setText(['configure', self.rendered_tree,'failed'])
-            self.step_status.setText2([])
-            self.finished(FAILURE)
-        return failure
-
-    def allLocalesLoaded(self, page):
-        self.pending -= 1
-        locales = util.parseLocales(page)
-        self.build.setProperty('locales', locales,
-                               'Build')
-        logger.debug('scheduler.l10n.tree',
-                     'all-locales loaded, found %s' %
-                     str(locales))
-        self.endLoad()
-
-    def allLocalesFailed(self, page):
-        self.pending -= 1
-        if self.pending <= 0:
-            self.step_status.setText(['configure', self.rendered_tree,'failed'])
-            self.step_status.setText2([])
-            self.finished(FAILURE)
-        return failure
-
-    def endLoad(self):
-        logger.debug('scheduler.l10n.tree',
-                     'load ended, pending jobs: %d' % self.pending)
-        if self.pending <= 0:
-            self.step_status.setText(['configured', self.rendered_tree])
-            self.step_status.setText2([])
-            if self.cb is not None:
-                try:
-                    self.tree.locales = self.build.getProperties().getProperty('locales',[])[:]
-                    self.cb(self.tree, changes=self.build.allChanges())
-                except Exception, e:
-                    logger.debug('scheduler.l10n.tree', str(e))
-            self.finished(SUCCESS)
+        self.step_status.setText2([tree])
+        loader = treeloader.TreeLoader(cp, tree, log=loog.addStdout)
+        d = loader.load()
+        d.addCallbacks(self.onTreeLoaded, self.onTreeFailed)
+
+    def onTreeLoaded(self, tree):
+        self.tree = tree
+        self.build.setProperty('locales', tree.locales[:], 'Build')
+        self.step_status.setText(['configured', self.rendered_tree])
+        self.step_status.setText2([])
+        audit = self.build.getProperties().getProperty('audit', False)
+        if self.cb is not None and not audit:
+            try:
+                self.cb(self.tree, changes=self.build.allChanges())
+            except Exception, e:
+                logger.debug('scheduler.l10n.tree', str(e))
+        self.finished(SUCCESS)
+
+    def onTreeFailed(self, failure):
+        self.getLog('stdio').addStderr(failure.getErrorMessage())
+        self.step_status.setText(['configure', self.rendered_tree,'failed'])
+        self.step_status.setText2([])
+        self.finished(FAILURE)
@@ -0,0 +1,367 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+from datetime import datetime, timedelta
+
+from twisted.trial import unittest
+from twisted.internet import defer, reactor, task
+
+from django.conf import settings
+
+if not settings.configured:
+    settings.configure(DATABASES = {'default':{'ENGINE':'django.db.backends.sqlite3'}},
+                       INSTALLED_APPS = ('life',
+                                         'mbdb',
+                                         'l10nstats',
+                                         ),
+                       BUILDMASTER_BASE = 'basedir')
+
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+
+from l10ninsp import revisions
+from l10ninsp.changes import createChangeSource, Replay
+
+
+class FakeParent(object):
+    def __init__(self):
+        self.changes = []
+    def addChange(self, change):
+        self.changes.append(change)
+
+
+class ChangeSourceMixin(object):
+    old_name = settings.DATABASES['default'].get('NAME')
+
+    def setUp(self):
+        self._db = connection.creation.create_test_db()
+        # master-wide caches, filled by polls
+        revisions.cache.clear()
+        revisions.shortrevs.clear()
+        from life.models import Forest, Repository, Branch
+        self.source = createChangeSource(pollInterval=60)
+        self.source.parent = FakeParent()
+        self.default = Branch.objects.get(name='default')
+        self.other, _ = Branch.objects.get_or_create(name='other')
+        forest = Forest.objects.create(name='l10n-central')
+        self.repos = [
+            Repository.objects.create(name='mozilla-central'),
+            Repository.objects.create(name='l10n-central/de', forest=forest),
+            Repository.objects.create(name='l10n-central/fr', forest=forest),
+        ]
+        self.nextrev = 0
+        self.when = datetime(2010, 1, 1)
+
+    def tearDown(self):
+        revisions.cache.clear()
+        revisions.shortrevs.clear()
+        connection.creation.destroy_test_db(self.old_name)
+
+    def createPushes(self, count):
+        from life.models import Push, Changeset, File
+        for i in xrange(count):
+            repo = self.repos[i % len(self.repos)]
+            self.when += timedelta(minutes=1)
+            push = Push.objects.create(repository=repo, user='jane@example',
+                                       push_date=self.when, push_id=i + 1)
+            for branch in (self.default, self.default, self.other):
+                self.nextrev += 1
+                cs = Changeset.objects.create(revision='%040x' % self.nextrev,
+                                              description='change %d' % i,
+                                              branch=branch)
+                for path in ('app/file%d.dtd' % i, 'app/common.dtd'):
+                    f, _ = File.objects.get_or_create(path=path)
+                    cs.files.add(f)
+                push.changesets.add(cs)
+
+    def poll(self):
+        # run both halves of a poll in this thread, the test database
+        # isn't shared with the worker thread
+        with CaptureQueriesContext(connection) as queries:
+            result = self.source.pollInThread(self.source.latest)
+        self.source.onPoll(result)
+        return len(queries)
+
+
+class MBDBChangeSource(ChangeSourceMixin, unittest.TestCase):
+    def test_changes(self):
+        self.source.latest = 0
+        self.createPushes(3)
+        self.poll()
+        changes = self.source.parent.changes
+        # two default-branch changesets per push
+        self.assertEqual(len(changes), 6)
+        self.assertEqual(changes[0].branch, 'mozilla-central')
+        self.failIf(hasattr(changes[0], 'locale'))
+        self.assertEqual(changes[2].branch, 'l10n-central')
+        self.assertEqual(changes[2].locale, 'de')
+        self.assertEqual(changes[4].locale, 'fr')
+        self.assertEqual(sorted(changes[0].files),
+                         ['app/common.dtd', 'app/file0.dtd'])
+        self.assertEqual(changes[0].revision, '%040x' % 1)
+        from life.models import Push
+        self.assertEqual(self.source.latest,
+                         Push.objects.order_by('-pk')[0].id)
+
+    def test_constant_queries(self):
+        self.source.latest = 0
+        self.createPushes(2)
+        few = self.poll()
+        self.createPushes(20)
+        many = self.poll()
+        self.assertEqual(len(self.source.parent.changes), 44)
+        self.assertEqual(few, many)
+
+    def test_overlap(self):
+        from twisted.internet import defer
+        self.source.dPoll = defer.Deferred()
+        self.assertEqual(self.source.poll(), None)
+        self.assertEqual(self.source.pollStats['skipped'], 1)
+        self.assertEqual(self.source.pollStats['polls'], 0)
+
+    def test_stats(self):
+        self.source.latest = 0
+        self.createPushes(2)
+        self.poll()
+        stats = self.source.pollStats
+        self.assertEqual(stats['pages'], 1)
+        self.assertEqual(stats['changes'], 4)
+        self.assert_(stats['maxBusy'] >= stats['lastBusy'] > 0)
+
+    def test_pages(self):
+        self.source.latest = 0
+        self.source.pageSize = 4
+        self.createPushes(6)
+        latest, changes, busy, more, repos = self.source.pollInThread(0)
+        self.assertEqual(len(changes), 8)
+        self.failUnless(more)
+        self.assertEqual(repos, set(r.name for r in self.repos))
+        latest, changes, busy, more, repos = self.source.pollInThread(latest)
+        self.assertEqual(len(changes), 4)
+        self.failIf(more)
+
+    def test_invalidate(self):
+        self.source.latest = 0
+        revisions.cache.set('l10n-central/de', 'default', 1, 'abc')
+        revisions.cache.set('l10n-central/it', 'default', 1, 'def')
+        self.createPushes(2)
+        self.poll()
+        self.assertEqual(revisions.cache.get('l10n-central/de', 'default', 1),
+                         (False, None))
+        self.assertEqual(revisions.cache.get('l10n-central/it', 'default', 1),
+                         (True, 'def'))
+
+    def test_state(self):
+        self.source.stateFile = 'test_state.json'
+        self.source.latest = 0
+        self.createPushes(2)
+        self.poll()
+        latest = self.source.latest
+        source = createChangeSource(pollInterval=60,
+                                    stateFile='test_state.json')
+        self.assertEqual(source.latest, None)
+        source.loadState()
+        self.assertEqual(source.latest, latest)
+
+
+class NotifiedMBDBChangeSource(ChangeSourceMixin, unittest.TestCase):
+    def setUp(self):
+        ChangeSourceMixin.setUp(self)
+        self.source = createChangeSource(pollInterval=60,
+                                         notifySocket='notify.sock')
+        self.source.parent = FakeParent()
+        self.polls = 0
+        def poll():
+            self.polls += 1
+        self.source.poll = poll
+
+    def test_known_push(self):
+        self.source.latest = 5
+        self.source.notify(3)
+        self.source.notify(5)
+        self.assertEqual(self.polls, 0)
+        self.source.notify(6)
+        self.assertEqual(self.polls, 1)
+        self.assertEqual(self.source.pollStats['notifications'], 3)
+
+    def test_poll_again(self):
+        from twisted.internet import defer
+        self.source.latest = 5
+        self.source.dPoll = defer.Deferred()
+        self.source.notify(6)
+        self.source.notify(None)
+        self.assertEqual(self.polls, 0)
+        self.failUnless(self.source.pollAgain)
+
+
+class FakePool(object):
+    def stop(self):
+        pass
+
+
+class FakePort(object):
+    def stopListening(self):
+        pass
+
+
+class NotifiedPolling(ChangeSourceMixin, unittest.TestCase):
+    '''Fallback polls and re-polls, driven by a fake clock.
+
+    Pages are read by pollPage below, the pushes in the database are
+    just the ids up to self.pushes, submitted as changes.
+    '''
+    def setUp(self):
+        ChangeSourceMixin.setUp(self)
+        self.clock = task.Clock()
+        self.patch(reactor, 'callLater', self.clock.callLater)
+        self.source = createChangeSource(pollInterval=60,
+                                         maxPollInterval=300,
+                                         notifySocket='notify.sock')
+        self.source.parent = FakeParent()
+        self.source.pollPage = self.pollPage
+        self.source.pool = FakePool()
+        self.source.port = FakePort()
+        self.source.running = True
+        self.source.latest = 0
+        self.pushes = 0
+        # running pages, with the watermark they started at
+        self.pages = []
+
+    def pollPage(self):
+        d = defer.Deferred()
+        self.pages.append((d, self.source.latest))
+        return d
+
+    def finishPage(self):
+        d, latest = self.pages.pop(0)
+        for push_id in xrange(latest + 1, self.pushes + 1):
+            self.source.parent.addChange(push_id)
+        self.source.latest = max(latest, self.pushes)
+        d.callback(None)
+
+    def fallback(self, interval):
+        self.clock.advance(interval)
+        self.assertEqual(len(self.pages), 1)
+        self.finishPage()
+
+    def test_backoff(self):
+        self.source.scheduleFallback()
+        intervals = []
+        for i in xrange(4):
+            self.fallback(self.source.currentInterval)
+            intervals.append(self.source.currentInterval)
+        self.assertEqual(intervals, [120, 240, 300, 300])
+        self.assertEqual(self.source.pollStats['fallbacks'], 4)
+        self.assertEqual(self.source.dFallback.getTime(),
+                         self.clock.seconds() + 300)
+
+    def test_missed(self):
+        self.source.scheduleFallback()
+        self.fallback(60)
+        self.fallback(120)
+        self.assertEqual(self.source.currentInterval, 240)
+        # a push without a notification
+        self.pushes = 2
+        self.fallback(240)
+        self.assertEqual(self.source.currentInterval, 60)
+        self.assertEqual(self.source.pollStats['missed'], 1)
+        self.assertEqual(self.source.parent.changes, [1, 2])
+
+    def test_poll_again(self):
+        self.pushes = 1
+        self.source.notify(1)
+        self.assertEqual(len(self.pages), 1)
+        # a notification during the running poll
+        self.pushes = 2
+        self.source.notify(2)
+        self.failUnless(self.source.pollAgain)
+        self.assertEqual(len(self.pages), 1)
+        self.finishPage()
+        self.failIf(self.source.pollAgain)
+        self.assertEqual(self.source.dPoll, None)
+        self.clock.advance(0)
+        self.assertEqual(len(self.pages), 1)
+        self.finishPage()
+        self.assertEqual(self.source.pollStats['polls'], 2)
+        self.assertEqual(self.source.parent.changes, [1, 2])
+
+    def test_overlapping_fallback(self):
+        self.pushes = 1
+        self.source.notify(1)
+        # the fallback timer fires while the notified poll runs
+        self.clock.advance(60)
+        self.assertEqual(len(self.pages), 1)
+        self.assertEqual(self.source.pollStats['skipped'], 1)
+        self.finishPage()
+        self.clock.advance(60)
+        self.finishPage()
+        self.assertEqual(self.source.parent.changes, [1])
+
+    def test_stop(self):
+        self.pushes = 1
+        self.source.notify(1)
+        self.source.notify(None)
+        self.failUnless(self.source.pollAgain)
+        d = self.source.stopService()
+        self.failIf(d.called)
+        self.finishPage()
+        self.failUnless(d.called)
+        self.assertEqual(self.source.dFallback, None)
+        self.clock.advance(1000)
+        self.assertEqual(self.pages, [])
+        self.assertEqual(self.source.parent.changes, [1])
+        # notifications that were in flight don't poll anymore
+        self.source.notify(2)
+        self.assertEqual(self.pages, [])
+
+
+class FakeReplaySource(object):
+    '''Stand-in for MBDBChangeSource, serving pages from a list of
+    (repository, changes) tuples.
+    '''
+    pageSize = 3
+    def __init__(self, items):
+        self.items = items
+        self.parent = FakeParent()
+    def inWorker(self, f, *args):
+        from twisted.internet import defer
+        return defer.maybeDeferred(f, *args)
+    def replayCount(self, filters):
+        return len(self.items)
+    def replayPage(self, filters, after):
+        after = after or 0
+        page = self.items[after:after + self.pageSize]
+        return page, after + len(page), after + len(page) < len(self.items)
+
+
+class ReplayTest(unittest.TestCase):
+    items = [('l10n/de', ['de1']),
+             ('l10n/de', ['de2', 'de3']),
+             ('l10n/fr', ['fr1']),
+             # page boundary
+             ('l10n/fr', ['fr2']),
+             ('l10n/de', ['de4']),
+             ('central', ['c1']),
+             ('central', ['c2'])]
+
+    def replay(self, **kw):
+        source = FakeReplaySource(self.items)
+        r = Replay(source, ['compare'], {}, dryRun=True, **kw)
+        d = r.start()
+        d.addCallback(lambda stats: (stats, source))
+        return d
+
+    def test_dryrun_coalesce(self):
+        def check((stats, source)):
+            self.assertEqual(stats['pushes'], 7)
+            self.assertEqual(stats['changes'], 8)
+            self.assertEqual(stats['batches'], 4)
+            self.assertEqual(source.parent.changes, [])
+        return self.replay(concurrency=2).addCallback(check)
+
+    def test_dryrun_no_coalesce(self):
+        def check((stats, source)):
+            self.assertEqual(stats['pushes'], 7)
+            self.assertEqual(stats['batches'], 7)
+        return self.replay(coalesce=False).addCallback(check)
@@ -10,6 +10,7 @@ from twisted.trial import unittest
 from twisted.internet import reactor, defer
 from twisted.python import util, log
 from l10ninsp.slave import InspectCommand, InspectDirsCommand
+from l10ninsp import dimensions, revisions
 from buildbot import interfaces
 from buildbot.process.base import BuildRequest
 from buildbot.sourcestamp import SourceStamp
@@ -298,6 +299,9 @@ class MasterSide(RunMixin, unittest.TestCase):
 
     def setUp(self):
         self._db = connection.creation.create_test_db()
+        # cached rows are from other test databases
+        dimensions.cache.clear()
+        revisions.shortrevs.clear()
         return RunMixin.setUp(self)
 
     def tearDown(self):
@@ -0,0 +1,63 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+from twisted.trial import unittest
+
+from django.conf import settings
+
+if not settings.configured:
+    settings.configure(DATABASES = {'default':{'ENGINE':'django.db.backends.sqlite3'}},
+                       INSTALLED_APPS = ('life',
+                                         'mbdb',
+                                         'l10nstats',
+                                         ),
+                       BUILDMASTER_BASE = 'basedir')
+
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+
+from l10ninsp.dimensions import DimensionCache
+
+
+class DimensionCacheTest(unittest.TestCase):
+    old_name = settings.DATABASES['default'].get('NAME')
+
+    def setUp(self):
+        self._db = connection.creation.create_test_db()
+
+    def tearDown(self):
+        connection.creation.destroy_test_db(self.old_name)
+
+    def test_cache(self):
+        from life.models import Forest, Locale, Tree
+        cache = DimensionCache()
+        de, created = cache.get_or_create(Locale, code='de')
+        self.failUnless(created)
+        forest, created = cache.get_or_create(Forest, name='l10n-central')
+        tree, created = cache.get_or_create(Tree, code='fx', l10n=forest)
+        with CaptureQueriesContext(connection) as queries:
+            self.failUnlessEqual(cache.get_or_create(Locale, code='de'),
+                                 (de, False))
+            # lookups by model instance are keyed by pk
+            same = Forest.objects.get(pk=forest.pk)
+            self.failUnlessEqual(cache.get_or_create(Tree, code='fx',
+                                                     l10n=same),
+                                 (tree, False))
+        # just the Forest query in the test
+        self.failUnlessEqual(len(queries), 1)
+        self.failUnlessEqual(cache.stats()['hits'], 2)
+
+    def test_get(self):
+        from life.models import Locale
+        cache = DimensionCache(maxsize=2)
+        self.assertRaises(Locale.DoesNotExist, cache.get, Locale, code='de')
+        for code in ('de', 'fr', 'it'):
+            Locale.objects.create(code=code)
+            cache.get(Locale, code=code)
+        # de got evicted
+        self.failUnlessEqual(len(cache.entries), 2)
+        with CaptureQueriesContext(connection) as queries:
+            cache.get(Locale, code='it')
+            cache.get(Locale, code='de')
+        self.failUnlessEqual(len(queries), 1)
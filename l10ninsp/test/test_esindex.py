@@ -0,0 +1,156 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+try:
+    import json
+except ImportError:
+    import simplejson as json
+
+from twisted.trial import unittest
+from twisted.internet import defer, reactor, task
+from twisted.web import resource, server
+
+from l10ninsp.esindex import BulkIndexer
+
+try:
+    import elasticsearch
+except ImportError:
+    elasticsearch = None
+
+
+class FakeES(resource.Resource):
+    '''Local stand-in for Elasticsearch, answering the bulk API.
+    Records the documents of each bulk request, and fails to index
+    the ids in failing.
+    '''
+    isLeaf = True
+
+    def __init__(self):
+        resource.Resource.__init__(self)
+        self.bulks = []
+        self.failing = set()
+
+    def render_GET(self, request):
+        request.setHeader('content-type', 'application/json')
+        request.setHeader('x-elastic-product', 'Elasticsearch')
+        return json.dumps({'version': {'number': '5.6.0'},
+                           'tagline': 'You Know, for Search'})
+
+    def render_HEAD(self, request):
+        return self.render_GET(request)
+
+    def render_POST(self, request):
+        request.setHeader('content-type', 'application/json')
+        request.setHeader('x-elastic-product', 'Elasticsearch')
+        lines = filter(None, request.content.read().splitlines())
+        pairs = [(json.loads(lines[i]), json.loads(lines[i + 1]))
+                 for i in xrange(0, len(lines), 2)]
+        self.bulks.append([(action['index']['_id'], doc)
+                           for action, doc in pairs])
+        items = []
+        for action, doc in pairs:
+            id = action['index']['_id']
+            if id in self.failing:
+                items.append({'index': {'_id': id, 'status': 400,
+                                        'error': 'mapper_parsing_exception'}})
+            else:
+                items.append({'index': {'_id': id, 'status': 201}})
+        return json.dumps({'took': 1, 'errors': bool(self.failing),
+                           'items': items})
+
+
+class BulkIndexerTest(unittest.TestCase):
+    '''Queueing and flushing, with a client that the test inspects.'''
+    class Client(object):
+        def __init__(self):
+            self.bulks = []
+        def bulk(self, body):
+            self.bulks.append([a['index']['_id'] for a in body[::2]])
+            return {'errors': False, 'items': []}
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.patch(reactor, 'callLater', self.clock.callLater)
+        self.indexer = BulkIndexer('es', 'compare', maxBatch=3,
+                                   flushInterval=5, maxQueue=5)
+        self.indexer.client = self.Client()
+
+    def test_batch(self):
+        for id in xrange(4):
+            self.indexer.add(id, {'run': id})
+        self.failUnlessEqual(self.indexer.client.bulks, [[0, 1, 2]])
+        self.failUnlessEqual(self.indexer.getStats()['depth'], 1)
+        # the rest goes after flushInterval
+        self.clock.advance(5)
+        self.failUnlessEqual(self.indexer.client.bulks, [[0, 1, 2], [3]])
+        stats = self.indexer.getStats()
+        self.failUnlessEqual(stats['indexed'], 4)
+        self.failUnlessEqual(stats['batches'], 2)
+        self.failUnlessEqual(stats['depth'], 0)
+
+    def test_bounded(self):
+        # one request at a time, the rest waits in the queue
+        self.indexer.dFlush = blocker = defer.Deferred()
+        added = [self.indexer.add(id, {'run': id}) for id in xrange(7)]
+        self.failUnlessEqual(added, [True] * 5 + [False] * 2)
+        stats = self.indexer.getStats()
+        self.failUnlessEqual(stats['dropped'], 2)
+        self.failUnlessEqual(stats['maxDepth'], 5)
+        self.indexer.dFlush = None
+        blocker.callback(None)
+        self.failUnlessEqual(self.indexer.client.bulks, [[0, 1, 2], [3, 4]])
+
+    def test_error(self):
+        def bulk(body):
+            raise IOError('connection refused')
+        self.indexer.client.bulk = bulk
+        for id in xrange(3):
+            self.indexer.add(id, {'run': id})
+        self.flushLoggedErrors(IOError)
+        stats = self.indexer.getStats()
+        self.failUnlessEqual(stats['errors'], 1)
+        self.failUnlessEqual(stats['failed'], 3)
+        self.failUnlessEqual(stats['indexed'], 0)
+
+
+class FakeESTest(unittest.TestCase):
+    if elasticsearch is None:
+        skip = 'needs elasticsearch'
+
+    def setUp(self):
+        self.es = FakeES()
+        self.port = reactor.listenTCP(0, server.Site(self.es),
+                                      interface='127.0.0.1')
+        self.indexer = BulkIndexer('127.0.0.1:%d' % self.port.getHost().port,
+                                   'compare', maxBatch=2, flushInterval=.1)
+        self.indexer.start()
+
+    def tearDown(self):
+        d = self.indexer.stop()
+        d.addCallback(lambda _: self.port.stopListening())
+        return d
+
+    @defer.inlineCallbacks
+    def test_bulk(self):
+        self.es.failing.add(3)
+        for id in xrange(1, 4):
+            self.indexer.add(id, {'run': id, 'details': {}})
+        yield self.indexer.flush(all=True)
+        self.failUnlessEqual([[id for id, doc in bulk]
+                              for bulk in self.es.bulks],
+                             [[1, 2], [3]])
+        self.failUnlessEqual(self.es.bulks[0][0][1],
+                             {'run': 1, 'details': {}})
+        stats = self.indexer.getStats()
+        self.failUnlessEqual(stats['indexed'], 2)
+        self.failUnlessEqual(stats['failed'], 1)
+        self.failUnlessEqual(stats['batches'], 2)
+
+    @defer.inlineCallbacks
+    def test_interval(self):
+        self.indexer.add(1, {'run': 1})
+        self.failUnlessEqual(self.es.bulks, [])
+        yield task.deferLater(reactor, .5, lambda: None)
+        self.failUnlessEqual(len(self.es.bulks), 1)
+        self.failUnlessEqual(self.indexer.getStats()['depth'], 0)
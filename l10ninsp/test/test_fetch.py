@@ -0,0 +1,240 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+from cStringIO import StringIO
+import gzip
+
+from twisted.trial import unittest
+from twisted.internet import defer, reactor
+from twisted.web import error, resource, server
+
+from l10ninsp import fetch
+from l10ninsp.fetch import Fetcher
+
+
+class FakeFetcher(Fetcher):
+    '''Fetcher with requests that the test answers.'''
+    def __init__(self, **kw):
+        Fetcher.__init__(self, **kw)
+        self.requests = []
+    def request(self, url, headers):
+        d = defer.Deferred()
+        self.requests.append((url, headers, d))
+        return d
+
+
+class FetcherTest(unittest.TestCase):
+    url = 'http://hg/central/raw-file/default/toolkit/locales/l10n.ini'
+
+    def test_shared(self):
+        fetcher = FakeFetcher()
+        results = []
+        for i in xrange(3):
+            fetcher.getPage(self.url).addCallback(results.append)
+        self.failUnlessEqual(len(fetcher.requests), 1)
+        url, headers, d = fetcher.requests.pop()
+        d.callback(('200', {'etag': ['"abc"']}, 'content'))
+        self.failUnlessEqual(results, ['content'] * 3)
+        self.failUnlessEqual(fetcher.stats['joined'], 2)
+        self.failUnlessEqual(fetcher.stats['fetched'], 1)
+
+    def test_revalidate(self):
+        fetcher = FakeFetcher()
+        results = []
+        fetcher.getPage(self.url).addCallback(results.append)
+        url, headers, d = fetcher.requests.pop()
+        self.failUnlessEqual(headers, {})
+        d.callback(('200', {'etag': ['"abc"'],
+                            'last-modified': ['Mon, 01 Mar 2010 10:00:00 GMT']},
+                    'content'))
+        fetcher.getPage(self.url).addCallback(results.append)
+        url, headers, d = fetcher.requests.pop()
+        self.failUnlessEqual(headers,
+                             {'If-None-Match': '"abc"',
+                              'If-Modified-Since':
+                              'Mon, 01 Mar 2010 10:00:00 GMT'})
+        d.errback(error.Error('304', 'Not Modified'))
+        self.failUnlessEqual(results, ['content', 'content'])
+        self.failUnlessEqual(fetcher.stats['notModified'], 1)
+        # changed content
+        fetcher.getPage(self.url).addCallback(results.append)
+        url, headers, d = fetcher.requests.pop()
+        d.callback(('200', {'etag': ['"def"']}, 'new content'))
+        self.failUnlessEqual(results[-1], 'new content')
+        self.failUnlessEqual(fetcher.cache[self.url][0], '"def"')
+
+    def test_evicted(self):
+        fetcher = FakeFetcher()
+        results = []
+        fetcher.getPage(self.url)
+        fetcher.requests.pop()[2].callback(('200', {'etag': ['"abc"']},
+                                            'content'))
+        fetcher.getPage(self.url).addCallback(results.append)
+        url, headers, d = fetcher.requests.pop()
+        self.failUnlessEqual(headers, {'If-None-Match': '"abc"'})
+        # evicted while revalidating, get it again
+        fetcher.cache.clear()
+        d.callback(('304', {}, ''))
+        url, headers, d = fetcher.requests.pop()
+        self.failUnlessEqual(headers, {})
+        d.callback(('200', {'etag': ['"abc"']}, 'content'))
+        self.failUnlessEqual(results, ['content'])
+
+    def test_immutable(self):
+        fetcher = FakeFetcher()
+        url = 'http://hg/central/raw-file/%s/l10n.ini' % ('a' * 40)
+        fetcher.getPage(url)
+        fetcher.requests.pop()[2].callback(('200', {}, 'content'))
+        results = []
+        fetcher.getPage(url).addCallback(results.append)
+        self.failUnlessEqual(fetcher.requests, [])
+        self.failUnlessEqual(results, ['content'])
+        self.failUnlessEqual(fetcher.stats['cached'], 1)
+
+    def test_errors(self):
+        fetcher = FakeFetcher()
+        failures = []
+        fetcher.getPage(self.url).addErrback(failures.append)
+        fetcher.getPage(self.url).addErrback(failures.append)
+        fetcher.requests.pop()[2].errback(error.Error('404', 'Not Found'))
+        self.failUnlessEqual(len(failures), 2)
+        self.failUnlessEqual(fetcher.stats['errors'], 1)
+        # not cached, try again
+        fetcher.getPage(self.url)
+        self.failUnlessEqual(len(fetcher.requests), 1)
+
+    def test_per_host(self):
+        fetcher = FakeFetcher(perHost=2)
+        for i in xrange(4):
+            fetcher.getPage('http://hg/file%d' % i)
+        fetcher.getPage('http://other/file')
+        self.failUnlessEqual([r[0] for r in fetcher.requests],
+                             ['http://hg/file0', 'http://hg/file1',
+                              'http://other/file'])
+        fetcher.requests.pop(0)[2].callback(('200', {}, ''))
+        self.failUnlessEqual(fetcher.requests[-1][0], 'http://hg/file2')
+
+    def test_lru(self):
+        fetcher = FakeFetcher(maxsize=2)
+        for i in xrange(3):
+            fetcher.getPage('http://hg/file%d' % i)
+            fetcher.requests.pop()[2].callback(('200', {'etag': ['"%d"' % i]},
+                                                ''))
+        self.failUnlessEqual(fetcher.cache.keys(),
+                             ['http://hg/file1', 'http://hg/file2'])
+
+
+class HgWeb(resource.Resource):
+    '''Local stand-in for hg web, serving files with an ETag, and
+    gzipped if the client asks for it. Records the connection for
+    each request, and fails the first request for paths starting with
+    flaky with a 503. Paths in redirects get redirected, and slow
+    never finishes its response.
+    '''
+    isLeaf = True
+
+    def __init__(self, files):
+        resource.Resource.__init__(self)
+        self.files = files
+        self.channels = []
+        self.gzipped = 0
+        self.flaky = set()
+        self.redirects = {}
+
+    def render_GET(self, request):
+        self.channels.append(request.channel)
+        path = request.path.lstrip('/')
+        if path in self.redirects:
+            request.setResponseCode(301)
+            request.setHeader('location', 'http://127.0.0.1:%d/%s' %
+                              (request.getHost().port, self.redirects[path]))
+            return ''
+        if path == 'slow':
+            request.write('partial content')
+            return server.NOT_DONE_YET
+        if path.startswith('flaky') and path not in self.flaky:
+            self.flaky.add(path)
+            request.setResponseCode(503)
+            return 'try again'
+        if path not in self.files:
+            request.setResponseCode(404)
+            return 'not found'
+        content = self.files[path]
+        etag = '"%x"' % hash(content)
+        request.setHeader('etag', etag)
+        if request.getHeader('if-none-match') == etag:
+            request.setResponseCode(304)
+            return ''
+        if 'gzip' in (request.getHeader('accept-encoding') or ''):
+            self.gzipped += 1
+            buf = StringIO()
+            f = gzip.GzipFile(fileobj=buf, mode='wb')
+            f.write(content)
+            f.close()
+            request.setHeader('content-encoding', 'gzip')
+            return buf.getvalue()
+        return content
+
+
+class PooledFetcherTest(unittest.TestCase):
+    if fetch.HTTPConnectionPool is None:
+        skip = 'needs twisted.web.client.HTTPConnectionPool'
+
+    def setUp(self):
+        self.hgweb = HgWeb({'l10n.ini': '[compare]\ndirs = browser\n',
+                            'all-locales': 'de\nfr\n',
+                            'flaky.ini': '[general]\n'})
+        self.port = reactor.listenTCP(0, server.Site(self.hgweb),
+                                      interface='127.0.0.1')
+        self.base = 'http://127.0.0.1:%d/' % self.port.getHost().port
+        self.hgweb.redirects['moved.ini'] = 'l10n.ini'
+        self.fetcher = Fetcher(backoff=.01)
+
+    def tearDown(self):
+        d = self.fetcher.close()
+        d.addCallback(lambda _: self.port.stopListening())
+        return d
+
+    @defer.inlineCallbacks
+    def test_keep_alive(self):
+        content = yield self.fetcher.getPage(self.base + 'l10n.ini')
+        self.failUnlessEqual(content, '[compare]\ndirs = browser\n')
+        content = yield self.fetcher.getPage(self.base + 'all-locales')
+        self.failUnlessEqual(content, 'de\nfr\n')
+        # revalidated
+        content = yield self.fetcher.getPage(self.base + 'l10n.ini')
+        self.failUnlessEqual(content, '[compare]\ndirs = browser\n')
+        self.failUnlessEqual(self.fetcher.stats['notModified'], 1)
+        # all on one connection, gzipped
+        self.failUnlessEqual(len(self.hgweb.channels), 3)
+        self.failUnlessEqual(len(set(self.hgweb.channels)), 1)
+        self.failUnlessEqual(self.hgweb.gzipped, 2)
+
+    @defer.inlineCallbacks
+    def test_retry(self):
+        content = yield self.fetcher.getPage(self.base + 'flaky.ini')
+        self.failUnlessEqual(content, '[general]\n')
+        self.failUnlessEqual(self.fetcher.stats['retries'], 1)
+
+    @defer.inlineCallbacks
+    def test_redirect(self):
+        content = yield self.fetcher.getPage(self.base + 'moved.ini')
+        self.failUnlessEqual(content, '[compare]\ndirs = browser\n')
+
+    def test_timeout(self):
+        self.fetcher.timeout = .2
+        self.fetcher.retries = 0
+        d = self.fetcher.getPage(self.base + 'slow')
+        def check(fail):
+            fail.trap(defer.CancelledError)
+            self.failIf(self.flushLoggedErrors(defer.AlreadyCalledError))
+        return d.addCallbacks(lambda _: self.fail('no timeout'), check)
+
+    def test_not_found(self):
+        d = self.fetcher.getPage(self.base + 'missing')
+        def check(fail):
+            fail.trap(error.Error)
+            self.failUnlessEqual(fail.value.status, '404')
+            self.failUnlessEqual(self.fetcher.stats['retries'], 0)
+        return d.addCallbacks(lambda _: self.fail('no 404'), check)
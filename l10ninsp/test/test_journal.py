@@ -0,0 +1,33 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+from twisted.trial import unittest
+
+from l10ninsp.journal import PendingJournal
+
+
+class PendingJournalTest(unittest.TestCase):
+    def test_journal(self):
+        j = PendingJournal('journal.db')
+        j.addPending('fx', 'de', [3, 1])
+        j.addPending('fx', 'de', [1, None])
+        j.addPending('fx', 'fr', [2])
+        j.addGated(5, 20.0)
+        j.addGated(4, 10.0)
+        j.addGated(None, 30.0)
+        self.failUnlessEqual(j.load(),
+                             ({('fx', 'de'): [1, 3], ('fx', 'fr'): [2]},
+                              [4, 5]))
+        j.removePending([('fx', 'de')])
+        j.removeGated(4)
+        j.addPending('fx', 'it', [6, 7])
+        j.removeChanges('fx', 'it', [6, None])
+        j.close()
+        # reopen
+        j = PendingJournal('journal.db')
+        self.failUnlessEqual(j.load(), ({('fx', 'fr'): [2], ('fx', 'it'): [7]},
+                                        [5]))
+        j.clear()
+        self.failUnlessEqual(j.load(), ({}, []))
+        j.close()
@@ -0,0 +1,161 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+from datetime import datetime, timedelta
+
+from twisted.trial import unittest
+
+from django.conf import settings
+
+if not settings.configured:
+    settings.configure(DATABASES = {'default':{'ENGINE':'django.db.backends.sqlite3'}},
+                       INSTALLED_APPS = ('life',
+                                         'mbdb',
+                                         'l10nstats',
+                                         ),
+                       BUILDMASTER_BASE = 'basedir')
+
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+
+from l10ninsp import revisions
+
+
+class ResolveRevisions(unittest.TestCase):
+    old_name = settings.DATABASES['default'].get('NAME')
+
+    def setUp(self):
+        self._db = connection.creation.create_test_db()
+        from life.models import Repository, Branch
+        self.default, _ = Branch.objects.get_or_create(name='default')
+        self.other, _ = Branch.objects.get_or_create(name='other')
+        self.repos = dict((name, Repository.objects.create(name=name))
+                          for name in ('central', 'l10n/de', 'l10n/fr'))
+        self.start = datetime(2010, 1, 1)
+        self.nextrev = 0
+
+    def tearDown(self):
+        connection.creation.destroy_test_db(self.old_name)
+
+    def push(self, repo, minutes, *branches):
+        from life.models import Push, Changeset
+        push = Push.objects.create(repository=self.repos[repo],
+                                   user='jane@example',
+                                   push_date=self.start +
+                                   timedelta(minutes=minutes),
+                                   push_id=minutes)
+        revs = []
+        for branch in branches:
+            self.nextrev += 1
+            rev = '%040x' % self.nextrev
+            cs = Changeset.objects.create(revision=rev, branch=branch)
+            push.changesets.add(cs)
+            revs.append(rev[:12])
+        return revs
+
+    def test_resolve(self):
+        c1, c2 = self.push('central', 1, self.default, self.default)
+        c3, = self.push('central', 5, self.default)
+        de1, de_other = self.push('l10n/de', 2, self.default, self.other)
+        fr_other, = self.push('l10n/fr', 3, self.other)
+        early = self.start + timedelta(minutes=3)
+        late = self.start + timedelta(minutes=10)
+        lookups = set([('central', early), ('central', late),
+                       ('l10n/de', early), ('l10n/fr', early),
+                       ('l10n/it', late)])
+        cache = revisions.RevisionCache()
+        with CaptureQueriesContext(connection) as queries:
+            rv = revisions.resolveRevisions(lookups, cache=cache)
+        # one per cutoff time, one for the changesets
+        self.assertEqual(len(queries), 3)
+        self.assertEqual(rv, {
+            ('central', early): c2,
+            ('central', late): c3,
+            ('l10n/de', early): de1,
+            })
+        # all answers, including the missing ones, are cached now
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(revisions.resolveRevisions(lookups, cache=cache),
+                             rv)
+        self.assertEqual(len(queries), 0)
+        self.assertEqual(cache.stats()['hits'], 5)
+        # a new push invalidates the cache for its repository
+        de2, = self.push('l10n/de', 3, self.default)
+        cache.invalidate('l10n/de')
+        with CaptureQueriesContext(connection) as queries:
+            rv = revisions.resolveRevisions(lookups, cache=cache)
+        self.assertEqual(len(queries), 2)
+        self.assertEqual(rv[('l10n/de', early)], de2)
+
+
+    def test_resolve_run(self):
+        from life.models import Push, Changeset
+        c1, = self.push('central', 1, self.default)
+        c2, = self.push('central', 4, self.default)
+        de1, = self.push('l10n/de', 2, self.default)
+        # c1 got pushed again, later
+        push = Push.objects.create(repository=self.repos['central'],
+                                   user='jane@example',
+                                   push_date=self.start +
+                                   timedelta(minutes=5),
+                                   push_id=5)
+        push.changesets.add(Changeset.objects.get(revision__startswith=c1))
+        lookups = [('central', c1), ('l10n/de', de1), ('l10n/fr', 'default')]
+        shortrevs = revisions.ShortRevisions()
+        with CaptureQueriesContext(connection) as queries:
+            ids, srctime = revisions.resolveRun(lookups, shortrevs=shortrevs)
+        # one for the changesets, one for the push dates
+        self.assertEqual(len(queries), 2)
+        self.assertEqual(sorted(ids), [c1, de1])
+        self.assertEqual(ids[c1],
+                         Changeset.objects.get(revision__startswith=c1).id)
+        # the earliest push of c1, the one of de1 is later
+        self.assertEqual(srctime, self.start + timedelta(minutes=2))
+        # the change source keeps the map up to date
+        shortrevs.add(Changeset.objects.get(revision__startswith=c2).revision,
+                      Changeset.objects.get(revision__startswith=c2).id)
+        with CaptureQueriesContext(connection) as queries:
+            ids, srctime = revisions.resolveRun([('central', c1),
+                                                 ('central', c2)],
+                                                shortrevs=shortrevs)
+        self.assertEqual(len(queries), 1)
+        self.assertEqual(sorted(ids), sorted([c1, c2]))
+        self.assertEqual(srctime, self.start + timedelta(minutes=4))
+
+
+class ShortRevisions(unittest.TestCase):
+    def test_ambiguous(self):
+        shortrevs = revisions.ShortRevisions(maxsize=2)
+        shortrevs.add('a' * 40, 1)
+        shortrevs.add('a' * 40, 1)
+        self.assertEqual(shortrevs.get('a' * 12), (True, 1))
+        shortrevs.add('a' * 12 + 'b' * 28, 2)
+        self.assertEqual(shortrevs.get('a' * 12), (True, None))
+        shortrevs.add('b' * 40, 3)
+        shortrevs.add('c' * 40, 4)
+        self.assertEqual(shortrevs.get('a' * 12), (False, None))
+        self.assertEqual(shortrevs.get('c' * 12), (True, 4))
+
+
+class RevisionCache(unittest.TestCase):
+    def test_lru(self):
+        cache = revisions.RevisionCache(maxsize=3)
+        cache.set('a', 'default', 1, 'rev-a1')
+        cache.set('a', 'default', 2, 'rev-a2')
+        cache.set('b', 'default', 1, None)
+        self.assertEqual(cache.get('a', 'default', 1), (True, 'rev-a1'))
+        self.assertEqual(cache.get('b', 'default', 1), (True, None))
+        self.assertEqual(cache.get('b', 'default', 2), (False, None))
+        # 'a' was used before 'b', so it goes
+        cache.set('c', 'default', 1, 'rev-c1')
+        self.assertEqual(cache.get('a', 'default', 1), (False, None))
+        self.assertEqual(cache.get('c', 'default', 1), (True, 'rev-c1'))
+        stats = cache.stats()
+        self.assertEqual(stats['evictions'], 1)
+        self.assertEqual(stats['size'], 2)
+        self.assertEqual(stats['hits'], 3)
+        self.assertEqual(stats['misses'], 2)
+        cache.invalidate('b')
+        self.assertEqual(cache.stats()['size'], 1)
+        self.assertEqual(cache.stats()['invalidations'], 1)
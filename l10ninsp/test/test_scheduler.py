@@ -2,14 +2,16 @@
 # License, v. 2.0. If a copy of the MPL was not distributed with this
 # file, You can obtain one at http://mozilla.org/MPL/2.0/.
 
+import os
 import pdb
 
 from buildbot.changes.changes import Change
 from buildbot.status import builder as builderstatus
 from twisted.trial import unittest
 from twisted.application import service
-from twisted.internet import reactor, defer
-from twisted.python import util, log
+from twisted.internet import reactor, defer, task
+from twisted.python import util, log, failure
+from collections import defaultdict
 from twisted.spread import pb
 
 from l10ninsp import scheduler
@@ -34,6 +36,14 @@ class FakeBuilder:
         self.requests = []
     def submitBuildRequest(self, req):
         self.requests.append(req)
+    def cancelBuildRequest(self, req):
+        if req in self.requests:
+            self.requests.remove(req)
+            return True
+        return False
+class FakeBotMaster:
+    def __init__(self, *builders):
+        self.builders = dict((b.name, b) for b in builders)
 
 
 class AppScheduler(unittest.TestCase):
@@ -46,8 +56,10 @@ class AppScheduler(unittest.TestCase):
         d = self.master.stopService()
         return d
 
-    def addScheduler(self, name, builderNames, inipath, treebuildername):
-        s = scheduler.AppScheduler(name, builderNames, inipath, treebuildername)
+    def addScheduler(self, name, builderNames, inipath, treebuildername,
+                     **kw):
+        s = scheduler.AppScheduler(name, builderNames, inipath, treebuildername,
+                                   **kw)
         s.setServiceParent(self.master)
         self.scheduler = s
 
@@ -65,6 +77,8 @@ class AppScheduler(unittest.TestCase):
         c = Change('author', ['test-app/file.dtd'], 'comment',
                    branch='l10n-test', properties={'locale':'de'})
         c.number = 1
+        # don't look up revisions
+        c.when = None
         self.scheduler.addChange(c)
         self.failUnless(self.scheduler.dSubmitBuildsets)
         self.scheduler.dSubmitBuildsets.cancel()
@@ -76,6 +90,8 @@ class AppScheduler(unittest.TestCase):
         c = Change('author', ['test-app/locales/en-US/file.dtd'], 'comment',
                    branch='test-branch')
         c.number = 1
+        # don't look up revisions
+        c.when = None
         self.scheduler.addChange(c)
         self.failUnless(self.scheduler.dSubmitBuildsets)
         self.scheduler.dSubmitBuildsets.cancel()
@@ -87,10 +103,13 @@ class AppScheduler(unittest.TestCase):
         c = Change('author', ['test-app/locales/en-US/file.dtd'], 'comment',
                    branch='test-branch')
         c.number = 1
+        # don't look up revisions
+        c.when = None
         self.scheduler.addChange(c)
         c = Change('author', ['test-app/file.dtd'], 'comment',
                    branch='l10n-test', properties={'locale':'de'})
         c.number = 2
+        c.when = None
         self.scheduler.addChange(c)
         self.failUnless(self.scheduler.dSubmitBuildsets)
         self.scheduler.dSubmitBuildsets.cancel()
@@ -104,10 +123,13 @@ class AppScheduler(unittest.TestCase):
         c = Change('author', ['test-app/locales/l10n.ini'], 'comment',
                    branch='test-branch')
         c.number = 1
+        # don't look up revisions
+        c.when = None
         self.scheduler.addChange(c)
         c = Change('author', ['test-app/locales/en-US/app.dtd'], 'comment',
                    branch='test-branch')
         c.number = 2
+        c.when = None
         self.scheduler.addChange(c)
         self.failUnlessEqual(len(self.master.sets), 1)
         bset = self.master.sets[0]
@@ -129,6 +151,758 @@ class AppScheduler(unittest.TestCase):
         self.failUnlessEqual(len(pendings[('test','de')]), 1)
         self.failUnlessEqual(len(pendings[('test','fr')]), 1)
 
+    def test_e_gating(self):
+        self.setupSimple()
+        other = scheduler.Tree('other', 'http://localhost/', 'other-branch',
+                               'l10n-other', 'other-app/locales/l10n.ini')
+        other.addData('other-branch', 'other-app/locales/l10n.ini',
+                      ['other-app'])
+        other.locales += ['de']
+        self.scheduler.addTree(other)
+        c = Change('author', ['test-app/locales/l10n.ini'], 'comment',
+                   branch='test-branch')
+        c.number = 1
+        # don't look up revisions
+        c.when = None
+        self.scheduler.addChange(c)
+        self.failUnlessEqual(len(self.master.sets), 1)
+        # l10n change for the tree being loaded waits
+        c = Change('author', ['test-app/file.dtd'], 'comment',
+                   branch='l10n-test', properties={'locale':'de'})
+        c.number = 2
+        c.when = None
+        self.scheduler.addChange(c)
+        # l10n change for the other tree doesn't
+        c = Change('author', ['other-app/file.dtd'], 'comment',
+                   branch='l10n-other', properties={'locale':'de'})
+        c.number = 3
+        c.when = None
+        self.scheduler.addChange(c)
+        pendings = self.scheduler.pendings
+        self.failUnlessEqual(pendings.keys(), [('other', 'de')])
+        stats = self.scheduler.getPendingStats()
+        self.failUnlessEqual(stats['depth'], 1)
+        self.failUnlessEqual(stats['queued'], 1)
+        # finish the tree build
+        bset = self.master.sets[0]
+        ftb = FakeBuilder('tree-builds')
+        bset.start([ftb])
+        builder = builderstatus.BuilderStatus('tree-builds')
+        build = builderstatus.BuildStatus(builder, 1)
+        build.setResults(builderstatus.SUCCESS)
+        ftb.requests[0].finished(build)
+        self.failUnlessEqual(sorted(pendings.keys()),
+                             [('other', 'de'), ('test', 'de')])
+        self.failUnlessEqual(self.scheduler.getPendingStats()['depth'], 0)
+        self.failIf(self.scheduler.loadingTrees)
+        self.scheduler.dSubmitBuildsets.cancel()
+
+    def test_e_trees_to_do(self):
+        self.setupSimple()
+        other = scheduler.Tree('other', 'http://localhost/', 'other-branch',
+                               'l10n-other', 'other-app/locales/l10n.ini')
+        other.addData('other-branch', 'other-app/locales/l10n.ini',
+                      ['other-app'])
+        other.locales += ['de']
+        self.scheduler.addTree(other)
+        c = Change('author', ['test-app/locales/l10n.ini'], 'comment',
+                   branch='test-branch')
+        c.number = 1
+        # don't look up revisions
+        c.when = None
+        self.scheduler.addChange(c)
+        # the tree build updates the tree
+        t = scheduler.Tree('test', 'http://localhost/', 'test-branch',
+                           'l10n-test', 'test-app/locales/l10n.ini')
+        t.addData('test-branch', 'test-app/locales/l10n.ini',
+                  ['test-app'])
+        t.locales += ['de', 'fr', 'it']
+        self.scheduler.addTree(t)
+        # an en-US change for the other tree doesn't pick that up
+        c = Change('author', ['other-app/locales/en-US/file.dtd'], 'comment',
+                   branch='other-branch')
+        c.number = 2
+        c.when = None
+        self.scheduler.addChange(c)
+        pendings = self.scheduler.pendings
+        self.failUnlessEqual(pendings.keys(), [('other', 'de')])
+        self.failUnlessEqual(self.scheduler.treesToDo, set(['test']))
+        # finish the tree build, the change that loaded it fans out
+        bset = self.master.sets[0]
+        ftb = FakeBuilder('tree-builds')
+        bset.start([ftb])
+        builder = builderstatus.BuilderStatus('tree-builds')
+        build = builderstatus.BuildStatus(builder, 1)
+        build.setResults(builderstatus.SUCCESS)
+        ftb.requests[0].finished(build)
+        self.failUnlessEqual(self.scheduler.treesToDo, set())
+        self.failUnlessEqual(
+            dict((key, [c.number for c in changes])
+                 for key, changes in pendings.iteritems()),
+            {('other', 'de'): [2],
+             ('test', 'de'): [1], ('test', 'fr'): [1], ('test', 'it'): [1]})
+        self.scheduler.dSubmitBuildsets.cancel()
+
+    def test_f_coalesce(self):
+        self.addScheduler('test-sched', ['compare'], None, 'tree-builds',
+                          coalesceWindow=.2, maxDelay=.5)
+        t = scheduler.Tree('test', 'http://localhost/', 'test-branch',
+                           'l10n-test', 'test-app/locales/l10n.ini')
+        t.addData('test-branch', 'test-app/locales/l10n.ini',
+                  ['test-app'])
+        t.locales += ['de', 'fr']
+        self.scheduler.addTree(t)
+        for i in xrange(3):
+            c = Change('author', ['test-app/file%d.dtd' % i], 'comment',
+                       branch='l10n-test', properties={'locale':'de'})
+            c.number = i + 1
+            c.when = None
+            self.scheduler.addChange(c)
+        self.failIf(self.scheduler.dSubmitBuildsets)
+        self.failUnlessEqual(len(self.scheduler.pendings[('test', 'de')]), 3)
+        self.failUnlessEqual(self.scheduler.coalesceStats['merged'], 2)
+        def check(_):
+            self.failUnlessEqual(len(self.master.sets), 1)
+            self.failUnlessEqual(len(self.master.sets[0].source.changes), 3)
+            self.failUnlessEqual(self.scheduler.coalesceStats['submitted'], 1)
+            self.failIf(self.scheduler.pendings)
+        return task.deferLater(reactor, .4, check, None)
+
+    def test_stop(self):
+        self.setupSimple()
+        c = Change('author', ['test-app/file.dtd'], 'comment',
+                   branch='l10n-test', properties={'locale': 'de'})
+        c.number = 1
+        # don't look up revisions
+        c.when = None
+        self.scheduler.addChange(c)
+        self.failUnless(self.scheduler.dSubmitBuildsets)
+        # a fan-out that gets stopped
+        self.scheduler.fanOuts += 1
+        self.scheduler.disownServiceParent()
+        # ready builds get submitted right away
+        self.failUnlessEqual(self.scheduler.dSubmitBuildsets, None)
+        self.failUnlessEqual([bs.getProperties()['locale']
+                              for bs in self.master.sets], ['de'])
+        self.failUnlessEqual(self.scheduler.ready, set())
+        # nothing gets scheduled anymore
+        self.scheduler.fanOutDone(None)
+        self.scheduler.compareBuild('test', 'fr', [])
+        self.failUnlessEqual(self.scheduler.dSubmitBuildsets, None)
+
+    def test_stop_coalesce(self):
+        self.addScheduler('test-sched', ['compare'], None, 'tree-builds',
+                          coalesceWindow=10)
+        t = scheduler.Tree('test', 'http://localhost/', 'test-branch',
+                           'l10n-test', 'test-app/locales/l10n.ini')
+        t.addData('test-branch', 'test-app/locales/l10n.ini',
+                  ['test-app'])
+        t.locales += ['de', 'fr']
+        self.scheduler.addTree(t)
+        for i, locale in enumerate(('de', 'de', 'fr')):
+            c = Change('author', ['test-app/file.dtd'], 'comment',
+                       branch='l10n-test', properties={'locale': locale})
+            c.number = i + 1
+            # don't look up revisions
+            c.when = None
+            self.scheduler.addChange(c)
+        self.failUnlessEqual(len(self.scheduler.debounce), 2)
+        # stopping doesn't wait for the coalesce window
+        self.scheduler.disownServiceParent()
+        self.failUnlessEqual(self.scheduler.debounce, {})
+        self.failUnlessEqual(
+            sorted((bs.getProperties()['locale'], len(bs.source.changes))
+                   for bs in self.master.sets),
+            [('de', 2), ('fr', 1)])
+
+    @defer.inlineCallbacks
+    def test_supersede(self):
+        self.setupSimple()
+        ftb = FakeBuilder('compare')
+        self.master.botmaster = FakeBotMaster(ftb)
+        def change(number):
+            c = Change('author', ['test-app/file.dtd'], 'comment',
+                       branch='l10n-test', properties={'locale': 'de'})
+            c.number = number
+            # don't look up revisions
+            c.when = None
+            self.scheduler.addChange(c)
+            self.scheduler.dSubmitBuildsets.cancel()
+            return c, self.scheduler.submitBuildsets()
+        c1, d = change(1)
+        yield d
+        first = self.master.sets[0]
+        first.start([ftb])
+        finished = []
+        first.waitUntilFinished().addCallback(finished.append)
+        c2, d = change(2)
+        yield d
+        # the first request got cancelled, and its set finished
+        self.failUnlessEqual(ftb.requests, [])
+        self.failUnlessEqual(finished, [first.status])
+        self.failUnlessEqual(first.status.getResults(), builderstatus.SKIPPED)
+        self.failUnlessEqual(list(self.master.sets[1].source.changes),
+                             [c1, c2])
+        self.failUnlessEqual(self.scheduler.unclaimed.superseded, 1)
+        self.failIf(('test', 'de') in self.scheduler.policy.lastBuilt)
+        # the builder claims the next request before a build started
+        second = self.master.sets[1]
+        second.start([ftb])
+        ftb.requests.pop()
+        c3, d = change(3)
+        yield d
+        self.failUnlessEqual(list(self.master.sets[2].source.changes), [c3])
+        self.failIf(second.status.isFinished())
+        self.failUnlessEqual(self.scheduler.unclaimed.superseded, 1)
+
+    def branchCaches(self):
+        '''Normalized view of the branch data caches, skipping
+        empty entries.
+        '''
+        branches = {}
+        for b, bd in self.scheduler.branches.iteritems():
+            if bd.isEmpty():
+                continue
+            branches[b] = (
+                dict((k, sorted(v)) for k, v in bd.inis.iteritems() if v),
+                dict((k, sorted(v)) for k, v in bd.dirs.iteritems() if v),
+                sorted(bd.topleveltrees),
+                dict((k, sorted(v))
+                     for k, v in bd.all_locales.iteritems() if v))
+        l10nbranches = {}
+        for b, dirs in self.scheduler.l10nbranches.iteritems():
+            dirs = dict((k, sorted(v)) for k, v in dirs.iteritems() if v)
+            if dirs:
+                l10nbranches[b] = dirs
+        return branches, l10nbranches
+
+    def createTrees(self):
+        app = scheduler.Tree('app', 'http://localhost/', 'central',
+                             'l10n-central', 'app/locales/l10n.ini')
+        app.addData('central', 'app/locales/l10n.ini', ['app', 'shared'])
+        app.addData('central', 'toolkit/locales/l10n.ini', ['toolkit'])
+        app.all_locales = 'app/locales/all-locales'
+        mobile = scheduler.Tree('mobile', 'http://localhost/', 'central',
+                                'l10n-central', 'mobile/locales/l10n.ini')
+        mobile.addData('central', 'mobile/locales/l10n.ini', ['mobile'])
+        mobile.addData('mobile-repo', 'mobile/locales/l10n.ini', [],
+                       tld='mobile')
+        mobile.addData('central', 'toolkit/locales/l10n.ini', ['toolkit'])
+        # updated app tree
+        app2 = scheduler.Tree('app', 'http://localhost/', 'central',
+                              'l10n-central', 'app/locales/l10n.ini')
+        app2.addData('central', 'app/locales/l10n.ini', ['app', 'other'])
+        app2.addData('aurora', 'toolkit/locales/l10n.ini', ['toolkit'])
+        return app, mobile, app2
+
+    def test_incremental_caches(self):
+        app, mobile, app2 = self.createTrees()
+        self.addScheduler('full', ['compare'], None, 'tree-builds')
+        self.scheduler.addTree(mobile)
+        self.scheduler.addTree(app2)
+        full = self.branchCaches()
+        self.addScheduler('incremental', ['compare'], None, 'tree-builds')
+        self.scheduler.addTree(app)
+        self.scheduler.addTree(mobile)
+        self.scheduler.addTree(app2)
+        self.assertEqual(self.branchCaches(), full)
+        self.failIf('shared' in self.scheduler.branches['central'].dirs)
+        self.assertEqual(self.scheduler.treesToDo, set(['app']))
+
+    def test_retract_all(self):
+        app, mobile, app2 = self.createTrees()
+        self.addScheduler('test-sched', ['compare'], None, 'tree-builds')
+        self.scheduler.addTree(app)
+        self.scheduler.addTree(mobile)
+        self.scheduler.retractTree(mobile)
+        self.scheduler.retractTree(app)
+        self.assertEqual(self.branchCaches(), ({}, {}))
+        self.assertEqual(len(self.scheduler.branches), 0)
+        self.assertEqual(len(self.scheduler.l10nbranches), 0)
+
+    def test_snapshot(self):
+        app, mobile, app2 = self.createTrees()
+        f = open('l10nbuilds.ini', 'w')
+        f.write('[app]\n[mobile]\n')
+        f.close()
+        self.addScheduler('cold', ['compare'], 'l10nbuilds.ini', 'tree-builds',
+                          snapshotFile='trees.json')
+        # no snapshot yet, changes wait for the tree builds
+        self.failIfEqual(self.scheduler.waitOnTree, None)
+        self.failUnlessEqual(len(self.master.sets), 2)
+        self.scheduler.addTree(app)
+        self.scheduler.addTree(mobile)
+        caches = self.branchCaches()
+        # written once, when the tree builds are done
+        self.failIf(os.path.exists('trees.json'))
+        self.scheduler.onTreesBuilt(None)
+        self.failUnless(os.path.exists('trees.json'))
+        self.addScheduler('warm', ['compare'], 'l10nbuilds.ini', 'tree-builds',
+                          snapshotFile='trees.json')
+        self.failUnlessEqual(self.scheduler.waitOnTree, None)
+        self.failUnlessEqual(self.scheduler.trees,
+                             {'app': app, 'mobile': mobile})
+        self.failUnlessEqual(self.branchCaches(), caches)
+        # still revalidating in the background
+        self.failUnlessEqual(len(self.master.sets), 4)
+        self.scheduler.addTree(app)
+        self.failUnlessEqual(self.scheduler.treesToDo, set())
+        app2.locales = ['de']
+        self.scheduler.addTree(app2)
+        self.failUnlessEqual(self.scheduler.treesToDo, set(['app']))
+        # changed trees get compared when the revalidation is done
+        self.scheduler.onTreesBuilt(None)
+        self.failUnlessEqual(self.scheduler.treesToDo, set())
+        self.failUnlessEqual(dict(self.scheduler.pendings), {('app', 'de'): []})
+        self.scheduler.dSubmitBuildsets.cancel()
+        # removed trees don't get restored, new trees need to load
+        f = open('l10nbuilds.ini', 'w')
+        f.write('[app]\n[new]\n')
+        f.close()
+        self.addScheduler('new', ['compare'], 'l10nbuilds.ini', 'tree-builds',
+                          snapshotFile='trees.json')
+        self.failUnlessEqual(self.scheduler.trees.keys(), ['app'])
+        self.failUnlessEqual(self.scheduler.trees['app'], app2)
+        self.failIfEqual(self.scheduler.waitOnTree, None)
+
+    def test_snapshot_on_stop(self):
+        app, mobile, app2 = self.createTrees()
+        f = open('l10nbuilds.ini', 'w')
+        f.write('[app]\n[mobile]\n')
+        f.close()
+        self.addScheduler('stop', ['compare'], 'l10nbuilds.ini',
+                          'tree-builds', snapshotFile='stopped.json')
+        self.scheduler.addTree(app)
+        # mobile is still loading, the write waits for it
+        self.failUnlessEqual(self.scheduler.dSaveSnapshot, None)
+        self.failUnless(self.scheduler.snapshotDirty)
+        self.scheduler.disownServiceParent()
+        self.failUnless(os.path.exists('stopped.json'))
+        self.failIf(self.scheduler.snapshotDirty)
+
+    def test_reload(self):
+        app, mobile, app2 = self.createTrees()
+        f = open('l10nbuilds.ini', 'w')
+        f.write('[app]\nrepo = a\n[mobile]\nrepo = b\n')
+        f.close()
+        self.addScheduler('reload', ['compare'], 'l10nbuilds.ini',
+                          'tree-builds')
+        self.failUnlessEqual(len(self.master.sets), 2)
+        self.scheduler.addTree(app)
+        self.scheduler.addTree(mobile)
+        c = Change('author', ['mobile/file.dtd'], 'comment',
+                   branch='l10n-central', properties={'locale': 'de'})
+        c.number = 1
+        self.scheduler.compareBuild('mobile', 'de', [c])
+        self.scheduler.dSubmitBuildsets.cancel()
+        # a new priority for app doesn't need a tree build
+        f = open('l10nbuilds.ini', 'w')
+        f.write('[app]\nrepo = a\npriority = 5\n[new]\nrepo = c\n')
+        f.close()
+        self.scheduler.reloadIni()
+        self.failUnlessEqual(len(self.master.sets), 3)
+        self.failUnlessEqual(self.master.sets[2].getProperties()['tree'],
+                             'new')
+        self.failUnlessEqual(self.scheduler.policy.priority(('app', 'de')), 5)
+        self.failUnlessEqual(self.scheduler.trees.keys(), ['app'])
+        self.failUnlessEqual(dict(self.scheduler.pendings), {})
+        self.failUnlessEqual(self.scheduler.ready, set())
+        self.failUnlessEqual(dict(self.scheduler.loadingTrees), {'new': 1})
+        self.failIf('mobile' in self.scheduler.branches['central'].dirs)
+        # changing a section rebuilds just that tree
+        f = open('l10nbuilds.ini', 'w')
+        f.write('[app]\nrepo = a2\npriority = 5\n[new]\nrepo = c\n')
+        f.close()
+        self.scheduler.reloadIni()
+        self.failUnlessEqual(len(self.master.sets), 4)
+        self.failUnlessEqual(self.master.sets[3].getProperties()['tree'],
+                             'app')
+
+    @defer.inlineCallbacks
+    def test_drop_tree(self):
+        app, mobile, app2 = self.createTrees()
+        f = open('l10nbuilds.ini', 'w')
+        f.write('[app]\nrepo = a\n[mobile]\nrepo = b\n')
+        f.close()
+        self.addScheduler('drop', ['compare'], 'l10nbuilds.ini',
+                          'tree-builds', journalFile='drop.db')
+        self.scheduler.addTree(app)
+        self.scheduler.addTree(mobile)
+        sets = len(self.master.sets)
+        for n, tree in ((1, 'app'), (2, 'mobile')):
+            c = Change('author', ['%s/file.dtd' % tree], 'comment',
+                       branch='l10n-central', properties={'locale': 'de'})
+            c.number = n
+            # don't look up revisions
+            c.when = None
+            self.scheduler.compareBuild(tree, 'de', [c])
+        self.scheduler.dSubmitBuildsets.cancel()
+        d = self.scheduler.submitBuildsets()
+        # mobile goes away while the buildsets are being submitted
+        f = open('l10nbuilds.ini', 'w')
+        f.write('[app]\nrepo = a\n')
+        f.close()
+        self.scheduler.reloadIni()
+        yield d
+        self.failUnlessEqual([bs.getProperties()['tree']
+                              for bs in self.master.sets[sets:]], ['app'])
+        self.failUnlessEqual(self.scheduler.journal.load(), ({}, []))
+        # a tree build for mobile finishing late doesn't bring it back
+        self.scheduler.addTree(mobile)
+        self.failUnlessEqual(self.scheduler.trees.keys(), ['app'])
+        self.failIf('mobile' in self.scheduler.branches['central'].dirs)
+
+    def test_load_trees(self):
+        f = open('l10nbuilds.ini', 'w')
+        for name in ('fx', 'fennec', 'tb'):
+            f.write('''[%s]
+repo = http://hg
+mozilla = central
+l10n.ini = %s/locales/l10n.ini
+l10n = l10n-central
+locales = %s
+''' % (name, name, 'all' if name == 'fx' else 'de fr'))
+        f.close()
+        pages = {
+            'fx/locales/l10n.ini': '''[general]
+all = fx/locales/all-locales
+[compare]
+dirs = fx
+[includes]
+toolkit = toolkit/locales/l10n.ini
+''',
+            'fx/locales/all-locales': 'de\nja-JP-mac osx\n',
+            'fennec/locales/l10n.ini': '[compare]\ndirs = mobile\n',
+            'tb/locales/l10n.ini': '[compare]\ndirs = mail\n',
+            'toolkit/locales/l10n.ini': '[compare]\ndirs = toolkit\n',
+            }
+        requests = []
+        self.concurrent = 0
+        def getPage(url):
+            prefix = 'http://hg/central/raw-file/default/'
+            self.failUnless(url.startswith(prefix))
+            d = defer.Deferred()
+            requests.append((d, url[len(prefix):]))
+            return d
+        s = scheduler.AppScheduler('loader', ['compare'], 'l10nbuilds.ini',
+                                   'tree-builds', treeConcurrency=2)
+        s.getPage = getPage
+        s.setServiceParent(self.master)
+        self.scheduler = s
+        self.failIfEqual(s.waitOnTree, None)
+        # no tree builds, at most two trees loading at a time
+        self.failUnlessEqual(self.master.sets, [])
+        while requests:
+            loading = set(path.split('/')[0] for d, path in requests)
+            loading = set('fx' if t == 'toolkit' else t for t in loading)
+            self.failUnless(len(loading) <= 2)
+            d, path = requests.pop(0)
+            d.callback(pages[path])
+        self.failUnlessEqual(self.scheduler.waitOnTree, None)
+        self.failUnlessEqual(sorted(self.scheduler.trees),
+                             ['fennec', 'fx', 'tb'])
+        fx = self.scheduler.trees['fx']
+        self.failUnlessEqual(fx.locales, ['de', 'ja-JP-mac'])
+        self.failUnlessEqual(fx.branch2dirs, {'central': ['fx', 'toolkit']})
+        self.failUnlessEqual(self.scheduler.trees['tb'].locales, ['de', 'fr'])
+        self.failIfEqual(self.scheduler.treeLoadTime, None)
+
+    def test_audit_trees(self):
+        f = open('l10nbuilds.ini', 'w')
+        f.write('[fx]\nrepo = http://hg\nmozilla = central\n'
+                'l10n.ini = fx/locales/l10n.ini\nl10n = l10n-central\n'
+                'locales = de\n')
+        f.close()
+        s = scheduler.AppScheduler('audit', ['compare'], 'l10nbuilds.ini',
+                                   'tree-builds', treeConcurrency=1,
+                                   auditTrees=True)
+        s.getPage = lambda url: defer.Deferred()
+        s.setServiceParent(self.master)
+        self.scheduler = s
+        # the tree builds are just a record
+        self.failUnlessEqual(len(self.master.sets), 1)
+        props = self.master.sets[0].getProperties()
+        self.failUnlessEqual(props['tree'], 'fx')
+        self.failUnlessEqual(props['audit'], True)
+
+    def test_all_locales(self):
+        self.addScheduler('all-locales', ['compare'], None, 'tree-builds')
+        for name in ('fx', 'fx-beta'):
+            t = scheduler.Tree(name, 'http://hg', 'central', 'l10n-central',
+                               'browser/locales/l10n.ini')
+            t.addData('central', 'browser/locales/l10n.ini', ['browser'])
+            t.all_locales = 'browser/locales/all-locales'
+            t.locales = ['de', 'fr']
+            self.scheduler.addTree(t)
+        pages = []
+        def getPage(url):
+            pages.append((url, defer.Deferred()))
+            return pages[-1][1]
+        self.scheduler.getPage = getPage
+        def change(number, revision):
+            c = Change('author', ['browser/locales/all-locales'], 'comment',
+                       branch='central', revision=revision)
+            c.number = number
+            self.scheduler.addChange(c)
+            if self.scheduler.dSubmitBuildsets is not None:
+                self.scheduler.dSubmitBuildsets.cancel()
+                self.scheduler.dSubmitBuildsets = None
+        rev = 'a' * 40
+        change(1, rev)
+        # both trees share one fetch
+        self.failUnlessEqual(len(pages), 1)
+        self.failUnlessEqual(pages[0][0],
+                             'http://hg/central/raw-file/%s/'
+                             'browser/locales/all-locales' % rev)
+        pages[0][1].callback('de\nfr\nit\n')
+        self.failUnlessEqual(sorted(self.scheduler.pendings),
+                             [('fx', 'it'), ('fx-beta', 'it')])
+        self.failUnlessEqual(self.scheduler.trees['fx'].locales,
+                             ['de', 'fr', 'it'])
+        # same revision again, no fetch, no new comparisons
+        self.scheduler.pendings.clear()
+        self.scheduler.ready.clear()
+        change(2, rev)
+        self.failUnlessEqual(len(pages), 1)
+        self.failUnlessEqual(dict(self.scheduler.pendings), {})
+        self.failUnlessEqual(self.scheduler.allLocales.hits, 3)
+        self.failUnlessEqual(self.scheduler.allLocales.fetches, 1)
+
+    def test_journal(self):
+        def setup(name):
+            self.addScheduler(name, ['compare'], None, 'tree-builds',
+                              journalFile='pending.db')
+            t = scheduler.Tree('test', 'http://localhost/', 'test-branch',
+                               'l10n-test', 'test-app/locales/l10n.ini')
+            t.addData('test-branch', 'test-app/locales/l10n.ini',
+                      ['test-app'])
+            t.locales += ['de', 'fr']
+            self.scheduler.addTree(t)
+        setup('before')
+        changes = {}
+        for n, locale in ((1, 'de'), (2, 'de'), (3, 'fr')):
+            c = Change('author', ['test-app/file.dtd'], 'comment',
+                       branch='l10n-test', properties={'locale': locale})
+            c.number = n
+            # don't look up revisions
+            c.when = None
+            changes[n] = c
+        self.scheduler.addChange(changes[1])
+        self.scheduler.addChange(changes[2])
+        self.scheduler.dSubmitBuildsets.cancel()
+        # a change waiting for tree builds
+        self.scheduler.loadingTrees['test'] += 1
+        self.scheduler.addChange(changes[3])
+        # work for a tree that goes away, and a change that does
+        self.scheduler.journal.addPending('gone', 'de', [1])
+        self.scheduler.journal.addPending('test', 'fr', [4])
+        journalled = ({('gone', 'de'): [1], ('test', 'de'): [1, 2],
+                       ('test', 'fr'): [4]}, [3])
+        self.failUnlessEqual(self.scheduler.journal.load(), journalled)
+        self.scheduler.disownServiceParent()
+        # stopping submitted the ready work, the rest stays
+        self.failUnlessEqual([bs.getProperties()['locale']
+                              for bs in self.master.sets], ['de'])
+        journalled = ({('gone', 'de'): [1], ('test', 'fr'): [4]}, [3])
+        # restart, with a change store
+        class ChangeSvc:
+            def getChangeNumbered(self, n):
+                return changes.get(n)
+        self.master.change_svc = ChangeSvc()
+        setup('after')
+        self.failUnlessEqual(self.scheduler.pendings, {})
+        # the work survives a restart before the replay
+        self.failUnlessEqual(self.scheduler.journal.load(), journalled)
+        self.scheduler.disownServiceParent()
+        setup('again')
+        self.scheduler.replayJournal()
+        self.failUnlessEqual(dict(self.scheduler.pendings),
+                             {('test', 'fr'): [changes[3]]})
+        self.failUnlessEqual(self.scheduler.journal.load(),
+                             ({('test', 'fr'): [3]}, []))
+        # submitting compacts the journal
+        self.scheduler.dSubmitBuildsets.cancel()
+        d = self.scheduler.submitBuildsets()
+        def check(_):
+            self.failUnlessEqual(len(self.master.sets), 2)
+            self.failUnlessEqual(self.scheduler.journal.load(), ({}, []))
+        d.addCallback(check)
+        return d
+
+    def test_router(self):
+        router = scheduler.PathRouter(prefixKinds=('l10n',))
+        router.add('browser', 'l10n', ['fx'])
+        router.add('mobile/android', 'l10n', ['fennec'])
+        router.add('mobile', 'en-US', ['fennec'])
+        router.add('browser/locales/all-locales', 'all_locales', ['fx'])
+        routes, toplevel = router.route('browser/chrome/file.dtd')
+        self.assertEqual(dict(routes), {'l10n': set(['fx'])})
+        self.failIf(toplevel)
+        routes, toplevel = router.route('mobile/android/file.dtd')
+        self.assertEqual(dict(routes), {'l10n': set(['fennec'])})
+        routes, toplevel = router.route('mobile/locales/en-US/a.dtd')
+        self.assertEqual(dict(routes), {'en-US': set(['fennec'])})
+        routes, toplevel = router.route('browser/locales/all-locales')
+        self.assertEqual(routes['all_locales'], set(['fx']))
+        routes, toplevel = router.route('locales/en-US/a.dtd')
+        self.failUnless(toplevel)
+        routes, toplevel = router.route('browserfoo/file.dtd')
+        self.assertEqual(dict(routes), {})
+
+    def setupBig(self, modules=100):
+        self.addScheduler('test-sched', ['compare'], None, 'tree-builds')
+        self.modules = ['app/mod%d' % i for i in xrange(modules)]
+        for name in ('big1', 'big2'):
+            t = scheduler.Tree(name, 'http://localhost/', 'test-branch',
+                               'l10n-test', 'app/locales/l10n.ini')
+            t.addData('test-branch', 'app/locales/l10n.ini', self.modules)
+            t.locales += ['de', 'fr', 'it']
+            self.scheduler.addTree(t)
+
+    def test_route_10k(self):
+        '''Benchmark routing of a 10k-file push, l10n and en-US.'''
+        import time
+        self.setupBig()
+        files = ['%s/sub/file%d.dtd' % (self.modules[i % len(self.modules)],
+                                        i)
+                 for i in xrange(10000)]
+        c = Change('author', files, 'comment',
+                   branch='l10n-test', properties={'locale':'de'})
+        c.number = 1
+        # don't look up revisions
+        c.when = None
+        start = time.time()
+        self.scheduler.addChange(c)
+        l10n = time.time() - start
+        self.scheduler.dSubmitBuildsets.cancel()
+        self.scheduler.dSubmitBuildsets = None
+        self.assertEqual(sorted(self.scheduler.pendings.keys()),
+                         [('big1', 'de'), ('big2', 'de')])
+        self.scheduler.pendings.clear()
+        self.scheduler.ready.clear()
+        files = ['%s/locales/en-US/file%d.dtd' %
+                 (self.modules[i % len(self.modules)], i)
+                 for i in xrange(10000)]
+        c = Change('author', files, 'comment', branch='test-branch')
+        c.number = 2
+        c.when = None
+        start = time.time()
+        self.scheduler.addChange(c)
+        enUS = time.time() - start
+        self.scheduler.dSubmitBuildsets.cancel()
+        self.assertEqual(len(self.scheduler.pendings), 6)
+        log.msg('routing 10k files took %.3fs for l10n, %.3fs for en-US' %
+                (l10n, enUS))
+
+    def test_cooperative_fanout(self):
+        self.addScheduler('test-sched', ['compare'], None, 'tree-builds')
+        t = scheduler.Tree('big', 'http://localhost/', 'test-branch',
+                           'l10n-test', 'app/locales/l10n.ini')
+        t.addData('test-branch', 'app/locales/l10n.ini', ['app'])
+        t.locales += ['l%02d' % i for i in xrange(30)]
+        self.scheduler.addTree(t)
+        self.scheduler.workBudget = 5
+        c = Change('author', ['app/locales/en-US/file.dtd'], 'comment',
+                   branch='test-branch')
+        c.number = 1
+        # don't look up revisions
+        c.when = None
+        self.scheduler.addChange(c)
+        # only the first slice is done right away
+        self.failUnlessEqual(len(self.scheduler.pendings), 5)
+        def check(_):
+            self.failUnlessEqual(len(self.master.sets), 30)
+            locales = sorted(bs.getProperties()['locale']
+                             for bs in self.master.sets)
+            self.failUnlessEqual(locales, t.locales)
+        return task.deferLater(reactor, 1, check, None)
+
+    def test_fanout_priority(self):
+        self.addScheduler('test-sched', ['compare'], None, 'tree-builds')
+        t = scheduler.Tree('big', 'http://localhost/', 'test-branch',
+                           'l10n-test', 'app/locales/l10n.ini')
+        t.addData('test-branch', 'app/locales/l10n.ini', ['app'])
+        t.locales += ['l%02d' % i for i in xrange(49)] + ['ja-JP-mac']
+        self.scheduler.addTree(t)
+        self.scheduler.policy.localePriority[('big', 'ja-jp-mac')] = 20
+        c = Change('author', ['app/locales/en-US/file.dtd'], 'comment',
+                   branch='test-branch')
+        c.number = 1
+        # don't look up revisions
+        c.when = None
+        self.scheduler.addChange(c)
+        # nothing gets submitted before the fan-out is done
+        self.failIf(self.scheduler.dSubmitBuildsets)
+        def check(_):
+            self.failUnlessEqual(len(self.master.sets), 50)
+            locales = [bs.getProperties()['locale']
+                       for bs in self.master.sets]
+            self.failUnlessEqual(locales[0], 'ja-JP-mac')
+        return task.deferLater(reactor, 1, check, None)
+
+
+class PriorityPolicy(unittest.TestCase):
+    '''Test the ordering of comparisons with a simulated pool of
+    builders, measuring the time to a fresh result per priority.
+    '''
+    ini = '''[fx]
+priority = 10
+priority.ja-JP-mac = 20
+
+[tb]
+
+[sm]
+'''
+    trees = ('fx', 'tb', 'sm')
+    locales = ['l%02d' % i for i in xrange(30)] + ['ja-JP-mac']
+
+    def createPolicy(self):
+        from ConfigParser import ConfigParser
+        from StringIO import StringIO
+        cp = ConfigParser()
+        cp.readfp(StringIO(self.ini))
+        policy = scheduler.PriorityPolicy()
+        policy.configure(cp)
+        return policy
+
+    def simulate(self, order, builders=4, duration=1):
+        '''Run the builds in order on a pool of builders, and return
+        the time each one finished.
+        '''
+        free = [0] * builders
+        done = {}
+        for key in order:
+            start = min(free)
+            i = free.index(start)
+            free[i] = done[key] = start + duration
+        return done
+
+    def test_priorities(self):
+        policy = self.createPolicy()
+        keys = [(t, l) for t in self.trees for l in self.locales]
+        order = policy.order(keys)
+        self.failUnlessEqual(sorted(order), sorted(keys))
+        self.failUnlessEqual(order[0], ('fx', 'ja-JP-mac'))
+        done = self.simulate(order)
+        byclass = defaultdict(list)
+        for key, when in done.iteritems():
+            byclass[policy.priority(key)].append(when)
+        mean = dict((prio, float(sum(times)) / len(times))
+                    for prio, times in byclass.iteritems())
+        log.msg('time to fresh result per priority: %r' % mean)
+        self.failUnless(mean[20] < mean[10] < mean[0])
+        self.failUnless(max(byclass[10]) <= min(byclass[0]))
+
+    def test_fair_and_stale(self):
+        policy = self.createPolicy()
+        # tb/l00 and sm/l01 got compared recently
+        policy.built(('tb', 'l00'), 100)
+        policy.built(('sm', 'l01'), 50)
+        keys = [(t, l) for t in ('tb', 'sm') for l in ('l00', 'l01')]
+        order = policy.order(keys)
+        self.failUnlessEqual(order, [('sm', 'l00'), ('tb', 'l01'),
+                                     ('sm', 'l01'), ('tb', 'l00')])
+
 '''
 import os
 os.environ['DJANGO_SETTINGS_MODULE'] = 'l10n_site.settings'
@@ -156,14 +930,24 @@ class DirScheduler(unittest.TestCase):
         s.getPage = self.getPage
         self.scheduler = s
 
-    def getPage(self, url):
-        d = defer.succeed('''dir/ab
+    index = '''dir/ab
 dir/en-US
 dir/fr
 dir/x-testing
-''')
+'''
+
+    def getPage(self, url):
+        d = defer.succeed(self.index)
         return d
 
+    def flush(self):
+        '''Submit the queued builds now, instead of in the next
+        reactor turn.
+        '''
+        if self.scheduler.dSubmitBuildsets is not None:
+            self.scheduler.dSubmitBuildsets.cancel()
+            self.scheduler.submitBuildsets()
+
     def setupSimple(self):
         self.addScheduler('test-sched', 'dir-compare', 'dir', ['dir-compare'], 'http://127.0.0.1:%i/' % 8080)
 
@@ -173,6 +957,7 @@ dir/x-testing
                    branch='dir', properties={'locale': 'ab'})
         c.number = 1
         self.scheduler.addChange(c)
+        self.flush()
         self.failUnlessEqual(len(self.master.sets), 1)
         bset = self.master.sets[0]
         props = bset.getProperties()
@@ -197,11 +982,103 @@ dir/x-testing
                    branch='dir', properties={'locale': 'en-US'})
         c.number = 1
         self.scheduler.addChange(c)
+        self.flush()
         self.failUnlessEqual(len(self.master.sets), 3)
         locs = sorted(map(lambda bset: bset.getProperties()['locale'],
                           self.master.sets))
         self.assertEqual(locs, ['ab', 'fr', 'x-testing'])
 
+    def test_supersede(self):
+        self.setupSimple()
+        ftb = FakeBuilder('dir-compare')
+        self.master.botmaster = FakeBotMaster(ftb)
+        c1 = Change('author', ['some/file.dtd'], 'comment',
+                    branch='dir', properties={'locale': 'ab'})
+        c1.number = 1
+        self.scheduler.addChange(c1)
+        self.flush()
+        self.master.sets[0].start([ftb])
+        self.failUnlessEqual(len(ftb.requests), 1)
+        c2 = Change('author', ['some/other.dtd'], 'comment',
+                    branch='dir', properties={'locale': 'ab'})
+        c2.number = 2
+        self.scheduler.addChange(c2)
+        self.flush()
+        self.failUnlessEqual(len(self.master.sets), 2)
+        # the first request got cancelled, the new set has both changes
+        self.failUnlessEqual(ftb.requests, [])
+        self.failUnlessEqual(list(self.master.sets[1].source.changes),
+                             [c1, c2])
+        self.failUnlessEqual(self.scheduler.unclaimed.superseded, 1)
+        # once a build started, the next change gets its own build
+        self.master.sets[1].start([ftb])
+        builder = builderstatus.BuilderStatus('dir-compare')
+        build = builderstatus.BuildStatus(builder, 1)
+        ftb.requests[0].status.buildStarted(build)
+        c3 = Change('author', ['some/file.dtd'], 'comment',
+                    branch='dir', properties={'locale': 'ab'})
+        c3.number = 3
+        self.scheduler.addChange(c3)
+        self.flush()
+        self.failUnlessEqual(len(ftb.requests), 1)
+        self.failUnlessEqual(list(self.master.sets[2].source.changes), [c3])
+
+    def test_coalesce(self):
+        self.setupSimple()
+        changes = []
+        for i, locale in enumerate(('ab', 'fr', 'ab', 'en-US')):
+            c = Change('author', ['some/file.dtd'], 'comment',
+                       branch='dir', properties={'locale': locale})
+            c.number = i + 1
+            changes.append(c)
+            self.scheduler.addChange(c)
+        self.failUnlessEqual(len(self.master.sets), 0)
+        self.flush()
+        # one set per locale, with all changes for it
+        self.failUnlessEqual(len(self.master.sets), 3)
+        sets = dict((bset.getProperties()['locale'], bset)
+                    for bset in self.master.sets)
+        self.failUnlessEqual(list(sets['ab'].source.changes),
+                             [changes[0], changes[2], changes[3]])
+        self.failUnlessEqual(list(sets['fr'].source.changes),
+                             [changes[1], changes[3]])
+        self.failUnlessEqual(list(sets['x-testing'].source.changes),
+                             [changes[3]])
+
+    def test_index_cache(self):
+        self.setupSimple()
+        pages = []
+        def getPage(url):
+            pages.append(defer.Deferred())
+            return pages[-1]
+        self.scheduler.getPage = getPage
+        def en_US(number):
+            c = Change('author', ['some/file.dtd'], 'comment',
+                       branch='dir', properties={'locale': 'en-US'})
+            c.number = number
+            self.scheduler.addChange(c)
+        # concurrent changes share one fetch
+        en_US(1)
+        en_US(2)
+        self.failUnlessEqual(len(pages), 1)
+        pages[0].callback(self.index)
+        self.flush()
+        self.failUnlessEqual(len(self.master.sets), 3)
+        self.failUnlessEqual(len(self.master.sets[0].source.changes), 2)
+        # later changes use the cached index
+        en_US(3)
+        self.failUnlessEqual(len(pages), 1)
+        self.failUnlessEqual(self.scheduler.indexStats,
+                             {'fetches': 1, 'hits': 1, 'waits': 1})
+        # until it expires, failures aren't cached
+        self.scheduler.indexLoaded -= self.scheduler.indexTTL
+        en_US(4)
+        self.failUnlessEqual(len(pages), 2)
+        pages[1].errback(failure.Failure(IOError('no index')))
+        self.flushLoggedErrors(IOError)
+        en_US(5)
+        self.failUnlessEqual(len(pages), 3)
+
 class PartialDirScheduler(DirScheduler):
 
     def addScheduler(self, name, tree, branch, builderNames, repourl):
@@ -216,15 +1093,44 @@ class PartialDirScheduler(DirScheduler):
                    branch='dir', properties={'locale': 'en-US'})
         c.number = 1
         self.scheduler.addChange(c)
+        self.flush()
         self.failUnlessEqual(len(self.master.sets), 2)
         locs = sorted(map(lambda bset: bset.getProperties()['locale'],
                           self.master.sets))
         self.assertEqual(locs, ['ab', 'fr'])
 
+    def test_coalesce(self):
+        self.setupSimple()
+        for i, locale in enumerate(('ab', 'de', 'ab', 'en-US')):
+            c = Change('author', ['some/file.dtd'], 'comment',
+                       branch='dir', properties={'locale': locale})
+            c.number = i + 1
+            self.scheduler.addChange(c)
+        self.flush()
+        changes = dict((bset.getProperties()['locale'],
+                        [c.number for c in bset.source.changes])
+                       for bset in self.master.sets)
+        self.failUnlessEqual(changes, {'ab': [1, 3, 4], 'fr': [4]})
+
+    def test_index_cache(self):
+        # known locales don't need the index
+        self.setupSimple()
+        def getPage(url):
+            self.fail('unexpected index fetch')
+        self.scheduler.getPage = getPage
+        c = Change('author', ['some/file.dtd'], 'comment',
+                   branch='dir', properties={'locale': 'en-US'})
+        c.number = 1
+        self.scheduler.addChange(c)
+        self.flush()
+        self.failUnlessEqual(len(self.master.sets), 2)
+        self.failUnlessEqual(self.scheduler.indexStats['fetches'], 0)
+
     def testDE(self):
         self.setupSimple()
         c = Change('author', ['some/file.dtd'], 'comment',
                    branch='dir', properties={'locale': 'de'})
         c.number = 1
         self.scheduler.addChange(c)
+        self.flush()
         self.failUnlessEqual(len(self.master.sets), 0)
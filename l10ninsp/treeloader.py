@@ -0,0 +1,138 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+'''Load the data for the trees in l10nbuilds.ini from the l10n.ini
+files in the remote repositories.
+
+This is mostly async network traffic, so it's done directly on the
+master, either by the TreeLoader build step, or by AppScheduler itself.
+'''
+
+from ConfigParser import ConfigParser, NoSectionError, NoOptionError
+from cStringIO import StringIO
+
+from twisted.internet import defer
+
+import fetch, logger, util
+
+
+class TreeLoader(object):
+    '''Load the Tree for a section of l10nbuilds.ini.
+
+    The includes of an l10n.ini and the all-locales file are loaded in
+    parallel, through the master-wide fetcher by default.
+    Progress messages go to the optional log callable.
+    '''
+    def __init__(self, cp, name, getPage=None, log=None):
+        self.cp = cp
+        self.name = name
+        if getPage is None:
+            getPage = fetch.fetcher.getPage
+        self.getPage = getPage
+        self.log = log if log is not None else lambda msg: None
+        self.tree = None
+
+    def load(self):
+        '''Returns a Deferred firing with the Tree.'''
+        from scheduler import Tree
+        cp, name = self.cp, self.name
+        repo = cp.get(name, 'repo')
+        branch = cp.get(name, 'mozilla')
+        path = cp.get(name, 'l10n.ini')
+        l10nbranch = cp.get(name, 'l10n')
+        locales = cp.get(name, 'locales')
+        self.tree = Tree(name, repo, branch, l10nbranch, path)
+        alllocales = locales == 'all'
+        if not alllocales:
+            self.tree.locales = filter(None, locales.split())
+        self.log('Loading l10n.inis for %s\n' % name)
+        logger.debug('scheduler.l10n.tree',
+                     'Loading l10n.inis for %s, alllocales: %s' %
+                     (name, alllocales))
+        d = self.loadIni(repo, branch, path, alllocales)
+        d.addCallback(lambda _: self.tree)
+        return d
+
+    def loadIni(self, repo, branch, path, alllocales=False):
+        url = repo + '/' + branch + '/raw-file/default/' + path
+        self.log('\nloading %s\n' % url)
+        d = self.getPage(url)
+        d.addCallback(self.onL10niniLoad, repo, branch, path, alllocales)
+        return d
+
+    def onL10niniLoad(self, inicontent, repo, branch, path, alllocales):
+        logger.debug('scheduler.l10n.tree',
+                     'Loaded %s, alllocales: %s' % (path, alllocales))
+        cp = ConfigParser()
+        cp.readfp(StringIO(inicontent), path)
+        try:
+            dirs = cp.get('compare', 'dirs').split()
+        except (NoOptionError, NoSectionError):
+            dirs = []
+        try:
+            dirs += cp.get('extras', 'dirs').split()
+        except (NoOptionError, NoSectionError):
+            pass
+        try:
+            tld = cp.get('compare', 'tld')
+            # remove tld from comparison dirs
+            if tld in dirs:
+                dirs.remove(tld)
+        except (NoOptionError, NoSectionError):
+            tld = None
+
+        if dirs:
+            self.log("adding %s on branch %s for %s\n" %
+                     (", ".join(dirs), branch, self.name))
+        if tld is not None:
+            self.log("adding a tld compare for %s on %s\n" % (tld, branch))
+
+        self.tree.addData(branch, path, dirs, tld)
+
+        _ds = []
+        try:
+            for title, _path in cp.items('includes'):
+                try:
+                    # check if the load details are overloaded
+                    details = dict(cp.items('include_%s' % title))
+                    if details['type'] != 'hg':
+                        continue
+                    self.log("need to load %s from %s on %s, %s\n" %
+                             (title, details['l10n.ini'], details['repo'],
+                              details['mozilla']))
+                    # check if we got the en-US branch already, if not
+                    # we're likely loading toolkit off a different repo
+                    enbranch = details['mozilla']
+                    if enbranch not in self.tree.branches.values():
+                        self.tree.branches[title] = enbranch
+                    _ds.append(self.loadIni(details['repo'],
+                                            details['mozilla'],
+                                            details['l10n.ini']))
+                except NoSectionError:
+                    self.log("need to load %s from %s\n" % (title, _path))
+                    _ds.append(self.loadIni(repo, branch, _path))
+        except NoSectionError:
+            pass
+        try:
+            if alllocales:
+                allpath = cp.get('general','all')
+                self.tree.all_locales = allpath
+                logger.debug('scheduler.l10n.tree',
+                             'loading all-locales for %s from %s' %
+                             (self.name, allpath))
+                d = self.getPage(repo + '/' + branch + '/raw-file/default/' +
+                                 allpath)
+                d.addCallback(self.allLocalesLoaded)
+                _ds.append(d)
+        except NoSectionError:
+            pass
+        d = defer.DeferredList(_ds, fireOnOneErrback=True, consumeErrors=True)
+        d.addErrback(lambda f: f.value.subFailure)
+        return d
+
+    def allLocalesLoaded(self, page):
+        self.tree.locales = util.parseLocales(page)
+        logger.debug('scheduler.l10n.tree',
+                     'all-locales loaded, found %s' %
+                     str(self.tree.locales))